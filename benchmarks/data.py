@@ -0,0 +1,106 @@
+"""Synthetic satellite data, forecasts and archives for the benchmarks
+
+The data has the coords and attributes of the real satellite data, taken from the shell used in
+the tests, and is filled with random values so that it compresses like real data rather than
+like zeros.
+"""
+
+import icechunk
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from icechunk.xarray import to_icechunk
+
+from cloudcasting_metrics.app import FORECAST_STEPS
+from tests.utils import make_sat_data
+
+
+def make_random_sat_data(
+    times: pd.DatetimeIndex,
+    grid_stride: int = 1,
+    seed: int = 0,
+) -> xr.Dataset:
+    """Make satellite data filled with random values
+
+    Args:
+        times: The timestamps of the data
+        grid_stride: Only every nth pixel of the full grid is kept in each direction
+        seed: The random seed
+
+    Returns:
+        xr.Dataset: The satellite data with dims (time, variable, y, x)
+    """
+    ds = make_sat_data(times).isel(
+        x_geostationary=slice(None, None, grid_stride),
+        y_geostationary=slice(None, None, grid_stride),
+    )
+    rng = np.random.default_rng(seed)
+    ds["data"] = ds.data.copy(data=rng.random(ds.data.shape, dtype=np.float32))
+    return ds
+
+
+def make_sat_zip(path: str, times: pd.DatetimeIndex, seed: int = 0) -> None:
+    """Save random satellite data on the full grid to a zipped zarr, as used in production"""
+    ds = make_random_sat_data(times, seed=seed)
+    with zarr.storage.ZipStore(path, mode="w") as store:
+        ds.to_zarr(store)
+
+
+def make_sat_icechunk(path: str, times: pd.DatetimeIndex, grid_stride: int = 1) -> None:
+    """Save random satellite data to an icechunk archive, as used by the metrics
+
+    The data is written one day at a time to limit the memory used.
+    """
+    repo = icechunk.Repository.create(icechunk.local_filesystem_storage(path))
+
+    for i, day_times in enumerate(_split_days(times)):
+        session = repo.writable_session(branch="main")
+        ds = make_random_sat_data(day_times, grid_stride=grid_stride, seed=i)
+        to_icechunk(ds, session, append_dim=None if i == 0 else "time")
+        session.commit(f"Add satellite data for {day_times[0].date()}")
+
+
+def make_forecast(init_time: pd.Timestamp, grid_stride: int = 1, seed: int = 0) -> xr.Dataset:
+    """Make a random forecast in the format saved by the inference app"""
+    ds = make_random_sat_data(init_time + FORECAST_STEPS, grid_stride=grid_stride, seed=seed)
+    ds = ds.assign_coords(step=("time", FORECAST_STEPS)).swap_dims({"time": "step"})
+    ds = ds.drop_vars("time").expand_dims(init_time=[init_time])
+    return ds.rename({"data": "sat_pred"}).transpose(
+        "init_time", "variable", "step", "y_geostationary", "x_geostationary",
+    )
+
+
+def make_forecast_directory(
+    directory: str,
+    init_times: pd.DatetimeIndex,
+    grid_stride: int = 1,
+) -> None:
+    """Save a random forecast for each init-time to the directory, as saved by the inference app"""
+    for i, init_time in enumerate(init_times):
+        make_forecast(init_time, grid_stride=grid_stride, seed=i).to_zarr(
+            init_time.strftime(f"{directory}/%Y-%m-%dT%H:%M.zarr"),
+        )
+
+
+def make_forecast_icechunk(path: str, init_times: pd.DatetimeIndex, grid_stride: int = 1) -> None:
+    """Save a random forecast for each init-time to an icechunk archive of forecasts
+
+    The forecasts are written one day at a time to limit the memory used.
+    """
+    repo = icechunk.Repository.create(icechunk.local_filesystem_storage(path))
+
+    for i, day_times in enumerate(_split_days(init_times)):
+        session = repo.writable_session(branch="main")
+        ds = xr.concat(
+            [make_forecast(t, grid_stride=grid_stride, seed=j) for j, t in enumerate(day_times)],
+            dim="init_time",
+        )
+        to_icechunk(ds, session, append_dim=None if i == 0 else "init_time")
+        session.commit(f"Add forecasts for {day_times[0].date()}")
+
+
+def _split_days(times: pd.DatetimeIndex) -> list[pd.DatetimeIndex]:
+    """Split the times into the days they fall on"""
+    days = times.floor("1D")
+    return [times[days == day] for day in days.unique()]
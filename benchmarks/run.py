@@ -0,0 +1,341 @@
+"""Offline benchmarks of the inference and metrics apps on synthetic data
+
+The benchmarks run fully offline using synthetic satellite data and forecasts, and a small random
+model in place of the model from huggingface. Run them from the root of the repo with e.g.
+
+    python -m benchmarks.run --days 1 7 30 --compare benchmark_results/<previous results>.json
+
+The time, peak memory and bytes read and written of each stage of the apps are taken from the
+summaries the apps write (see cloudcasting_inference.instrumentation). The results are saved as
+JSON named by the package version, or by `git describe` if the package is not installed, so they
+can be compared between versions.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import pandas as pd
+import torch
+from loguru import logger
+
+from benchmarks.data import (
+    make_forecast_directory,
+    make_forecast_icechunk,
+    make_sat_icechunk,
+    make_sat_zip,
+)
+from cloudcasting_inference.app import __version__
+from cloudcasting_inference.app import app as inference_app
+from cloudcasting_inference.cache import INPUT_WINDOW
+from cloudcasting_metrics.app import FORECAST_FREQ, FORECAST_STEPS, backfill
+
+# The fields of each stage which are measured rather than counted
+MEASUREMENTS = ("seconds", "peak_rss_mb", "read_mb", "written_mb")
+
+# Stages which take this much longer or use this much more memory are reported as regressions
+REGRESSION_RATIO = 1.2
+
+
+class RandomModel(torch.nn.Module):
+    """A small randomly initialised model with the input and output shapes of the real model"""
+
+    def __init__(self, num_channels: int = 11, seed: int = 0):
+        """A small randomly initialised model with the input and output shapes of the real model
+
+        Args:
+            num_channels: The number of satellite channels
+            seed: The random seed of the weights
+        """
+        super().__init__()
+        torch.manual_seed(seed)
+        self.conv = torch.nn.Conv3d(num_channels, num_channels, kernel_size=3, padding=1)
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        """Map the 12 input frames with dims (batch, variable, time, y, x) to the 12 steps"""
+        return torch.sigmoid(self.conv(X))
+
+
+@contextmanager
+def _environ(**env: str | None) -> Iterator[None]:
+    """Temporarily set environmental variables, or unset them if their value is None"""
+    old_env = {key: os.environ.get(key) for key in env}
+
+    def update(env: dict[str, str | None]) -> None:
+        for key, value in env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    update(env)
+    try:
+        yield
+    finally:
+        update(old_env)
+
+
+def summarise_stages(summary_path: str) -> dict:
+    """Load the summary of a run and combine the stages with the same name
+
+    The times and bytes of the stages are summed, and the peak memory is the peak of the stages.
+    """
+    with open(summary_path, encoding="utf-8") as f:
+        summary = json.load(f)
+
+    stages: dict[str, dict] = {}
+
+    for stage in summary["stages"]:
+        combined = stages.setdefault(stage["stage"], {})
+        for key, value in stage.items():
+            if not isinstance(value, int | float):
+                continue
+            if key == "peak_rss_mb":
+                combined[key] = max(combined.get(key, 0), value)
+            else:
+                combined[key] = round(combined.get(key, 0) + value, 3)
+
+    return {
+        "total_seconds": summary["total_seconds"],
+        "peak_rss_mb": summary["peak_rss_mb"],
+        "stages": stages,
+    }
+
+
+def benchmark_inference(workdir: str, num_init_times: int = 1, direct_read: bool = False) -> dict:
+    """Benchmark the inference app on synthetic 5 and 15-minutely satellite data
+
+    Args:
+        workdir: The directory to save the synthetic data and forecasts in
+        num_init_times: The number of init-times to make forecasts for in one run
+        direct_read: Whether to read the satellite data directly rather than through the cache
+
+    Returns:
+        dict: The summary of the stages of the run
+    """
+    init_times = pd.date_range(end="2024-06-01 12:00", periods=num_init_times, freq=FORECAST_FREQ)
+    sat_start = init_times[0] - INPUT_WINDOW
+
+    # The 15-minutely data lags the 5-minutely data, so the 5-minutely data is used
+    make_sat_zip(
+        f"{workdir}/sat.zarr.zip",
+        pd.date_range(sat_start, init_times[-1], freq="5min"),
+    )
+    make_sat_zip(
+        f"{workdir}/sat_15.zarr.zip",
+        pd.date_range(sat_start, init_times[-1] - pd.Timedelta("15min"), freq="15min"),
+        seed=1,
+    )
+    os.makedirs(f"{workdir}/predictions")
+
+    with _environ(
+        SATELLITE_ZARR_PATH=f"{workdir}/sat.zarr.zip",
+        SATELLITE_15_ZARR_PATH=f"{workdir}/sat_15.zarr.zip",
+        SATELLITE_CACHE_DIR=f"{workdir}/sat_cache",
+        SATELLITE_DIRECT_READ=str(direct_read).lower(),
+        SATELLITE_DEBUG_SAVE_PATH=None,
+        PREDICTION_SAVE_DIRECTORY=f"{workdir}/predictions",
+        PREDICTION_ICECHUNK_ARCHIVE=None,
+        INFERENCE_SUMMARY_PATH=f"{workdir}/summary.json",
+    ):
+        inference_app(init_times, model=RandomModel())
+
+    return summarise_stages(f"{workdir}/summary.json")
+
+
+def benchmark_metrics(
+    workdir: str,
+    num_days: int = 1,
+    grid_stride: int = 16,
+    forecast_source: str = "files",
+    stream_satellite: bool = False,
+) -> dict:
+    """Benchmark scoring a range of days of synthetic forecasts
+
+    Args:
+        workdir: The directory to save the synthetic data and metrics in
+        num_days: The number of days of forecasts to score
+        grid_stride: Only every nth pixel of the full grid is used in each direction
+        forecast_source: Whether the forecasts are saved as "files" or in an "icechunk" archive
+        stream_satellite: Whether to stream the satellite data rather than preload it
+
+    Returns:
+        dict: The summary of the stages of the run
+    """
+    start = pd.Timestamp("2024-01-01")
+    end = start + pd.Timedelta(days=num_days)
+
+    init_times = pd.date_range(start, end, freq=FORECAST_FREQ, inclusive="left")
+    sat_times = pd.date_range(start, end + FORECAST_STEPS.max(), freq="15min")
+
+    make_sat_icechunk(f"{workdir}/sat.icechunk", sat_times, grid_stride=grid_stride)
+
+    if forecast_source == "icechunk":
+        make_forecast_icechunk(f"{workdir}/forecasts.icechunk", init_times, grid_stride=grid_stride)
+        forecast_archive_path = f"{workdir}/forecasts.icechunk"
+    elif forecast_source == "files":
+        os.makedirs(f"{workdir}/predictions")
+        make_forecast_directory(f"{workdir}/predictions", init_times, grid_stride=grid_stride)
+        forecast_archive_path = None
+    else:
+        raise ValueError(f"Unknown forecast source {forecast_source}")
+
+    with _environ(
+        SATELLITE_ICECHUNK_ARCHIVE=f"{workdir}/sat.icechunk",
+        PREDICTION_SAVE_DIRECTORY=f"{workdir}/predictions",
+        PREDICTION_ICECHUNK_ARCHIVE=forecast_archive_path,
+        METRIC_ZARR_PATH=f"{workdir}/metrics.zarr",
+        METRIC_STREAM_SATELLITE=str(stream_satellite).lower(),
+        METRIC_ROLLUP_ZARR_PATH=None,
+        METRIC_SUMMARY_PATH=f"{workdir}/summary.json",
+    ):
+        backfill(start, end - pd.Timedelta("1D"))
+
+    return summarise_stages(f"{workdir}/summary.json")
+
+
+def compare_results(old_results: dict, new_results: dict) -> list[str]:
+    """Find the stages which have got slower or use more memory between two sets of results
+
+    Args:
+        old_results: The earlier results
+        new_results: The later results
+
+    Returns:
+        list: A description of each regression
+    """
+    regressions = []
+
+    for app_name in ["inference", "metrics"]:
+        for name, new in new_results.get(app_name, {}).items():
+            old = old_results.get(app_name, {}).get(name)
+            if old is None:
+                continue
+
+            for stage, new_stage in new["stages"].items():
+                old_stage = old["stages"].get(stage)
+                if old_stage is None:
+                    continue
+
+                for key in ["seconds", "peak_rss_mb"]:
+                    old_value, new_value = old_stage.get(key), new_stage.get(key)
+                    if old_value and new_value and new_value > old_value * REGRESSION_RATIO:
+                        regressions.append(
+                            f"{app_name} {name} {stage} {key}: {old_value} -> {new_value}",
+                        )
+
+    return regressions
+
+
+def _log_results(results: dict) -> None:
+    for app_name in ["inference", "metrics"]:
+        for name, result in results[app_name].items():
+            logger.info(
+                f"{app_name} {name}: {result['total_seconds']:.1f}s, "
+                f"peak memory {result['peak_rss_mb']:.0f}MB",
+            )
+            for stage, measurements in result["stages"].items():
+                logger.info(
+                    f"    {stage:<20s} "
+                    + " ".join(f"{k}={measurements.get(k)}" for k in MEASUREMENTS),
+                )
+
+
+def get_version() -> str:
+    """Get the version of the package, or describe the git commit if it is not installed"""
+    if __version__ != "v?":
+        return __version__
+    try:
+        return subprocess.run(
+            ["git", "describe", "--tags", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return __version__
+
+
+def get_results_path(output_dir: str, results: dict) -> str:
+    """Get the path the results are saved to, named by their version and time"""
+    timestamp = pd.Timestamp(results["time"]).strftime("%Y%m%dT%H%M%S")
+    return f"{output_dir}/{results['version']}_{timestamp}.json"
+
+
+def main() -> None:
+    """Run the benchmarks and save the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--init-times", type=int, nargs="+", default=[1, 4],
+        help="The numbers of init-times to forecast in one inference run",
+    )
+    parser.add_argument(
+        "--days", type=int, nargs="+", default=[1, 7, 30],
+        help="The numbers of days of forecasts to score",
+    )
+    parser.add_argument(
+        "--grid-stride", type=int, default=16,
+        help="Only every nth pixel of the full grid is used in the metrics benchmarks",
+    )
+    parser.add_argument("--forecast-source", choices=["files", "icechunk"], default="files")
+    parser.add_argument("--stream-satellite", action="store_true")
+    parser.add_argument("--output-dir", default="benchmark_results")
+    parser.add_argument("--workdir", default=None, help="Where to save the synthetic data")
+    parser.add_argument("--compare", default=None, help="A previous results file to compare to")
+    args = parser.parse_args()
+
+    results = {
+        "version": get_version(),
+        "time": pd.Timestamp.now(tz="UTC").isoformat(),
+        "config": vars(args),
+        "inference": {},
+        "metrics": {},
+    }
+
+    for num_init_times in args.init_times:
+        for direct_read in [False, True]:
+            name = f"{num_init_times}_init_times" + ("_direct_read" if direct_read else "")
+            logger.info(f"Running inference benchmark {name}")
+            with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+                results["inference"][name] = benchmark_inference(
+                    workdir, num_init_times=num_init_times, direct_read=direct_read,
+                )
+
+    for num_days in args.days:
+        name = f"{num_days}_days"
+        logger.info(f"Running metrics benchmark {name}")
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            results["metrics"][name] = benchmark_metrics(
+                workdir,
+                num_days=num_days,
+                grid_stride=args.grid_stride,
+                forecast_source=args.forecast_source,
+                stream_satellite=args.stream_satellite,
+            )
+
+    _log_results(results)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = get_results_path(args.output_dir, results)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved results to {output_path}")
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            old_results = json.load(f)
+
+        regressions = compare_results(old_results, results)
+        for regression in regressions:
+            logger.warning(f"Regression from {old_results['version']}: {regression}")
+        if not regressions:
+            logger.info(f"No regressions from {old_results['version']}")
+
+
+if __name__ == "__main__":
+    main()
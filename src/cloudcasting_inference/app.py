@@ -3,114 +3,287 @@
 This app expects these environmental variables to be available:
     SATELLITE_ZARR_PATH (str): The path of the input satellite data
     PREDICTION_SAVE_DIRECTORY (str): The path of the directory to save the predictions to
+
+Optionally:
+    SATELLITE_DEBUG_SAVE_PATH (str): If set, the prepared satellite inputs are also saved here
+    PREDICTION_ICECHUNK_ARCHIVE (str): If set, each forecast is also appended to this icechunk
+        archive. Forecasts made from the 15-minutely data are saved in the "0-deg" group
+    PREDICTION_PYRAMID_FACTORS (str): If set, e.g. to "2,4,8", the forecast is also saved coarsened
+        by each of these factors in the "pyramid_<factor>" groups of the same store
+    INFERENCE_BATCH_SIZE (int): The number of init-times to run through the model at once
+    INFERENCE_BACKEND (str): One of "eager", "torchscript" or "onnx". Defaults to "eager"
+    INFERENCE_INTRAOP_THREADS (int): The number of threads used within each model operation
+    INFERENCE_INTEROP_THREADS (int): The number of threads used to run model operations in parallel
+    INFERENCE_PRECISION (str): One of "fp32", "bf16" or "int8". Defaults to "fp32". "int8" only
+        reduces the memory of the convolution weights, which are still computed in fp32
+    INFERENCE_PRECISION_MAX_MAE (float): The maximum MAE allowed between the reduced precision and
+        fp32 model outputs on the reference input
+    INFERENCE_REFERENCE_INPUT (str): Path to a numpy file of the reference input. Required if the
+        precision is not "fp32"
+    INFERENCE_MODEL_CACHE_DIR (str): The directory the model files are cached in
+    INFERENCE_MODEL_OFFLINE (bool): If "true", huggingface is never contacted for the model
+    INFERENCE_MODEL_VERIFY (bool): If "false", the checksums of the cached model files are not
+        checked on their first load, only their sizes. Defaults to "true"
+    INFERENCE_DOMAIN (str): If set, forecasts are made over this "lon_min,lat_min,lon_max,lat_max"
+        domain by tiled inference, instead of over the fixed UK area the model was trained on
+    INFERENCE_TILE_OVERLAP (int): The minimum number of pixels the tiles overlap by. Defaults to 64
+    INFERENCE_SUMMARY_PATH (str): If set, a JSON summary of the time, memory and I/O of each stage
+        of the run is written to this path
 """
 
+import json
 import os
+import shutil
+from collections.abc import Callable
 from importlib.metadata import PackageNotFoundError, version
 
 import fsspec
-import hydra
+import numpy as np
 import pandas as pd
 import torch
 import xarray as xr
-import yaml
-from huggingface_hub import snapshot_download
-from safetensors.torch import load_model
+import zarr
+from fsspec.implementations.local import LocalFileSystem
 from loguru import logger
 
-from cloudcasting_inference.data import SatelliteDownloader, sat_path, get_input_data
+from cloudcasting_inference.archive import append_forecast
+from cloudcasting_inference.data import SatelliteDownloader, get_batched_input_data, parse_domain
+from cloudcasting_inference.instrumentation import StageRecorder
+from cloudcasting_inference.model import device, get_model
+from cloudcasting_inference.pyramid import (
+    get_multiscales_metadata,
+    make_pyramid,
+    parse_pyramid_factors,
+)
+from cloudcasting_inference.tiling import TILE_OVERLAP, TileGrid, get_tile_grid, predict_tiled
 
 # Get package version
 try:
-    __version__ = version("cloudcasting-inference")
+    __version__ = version("cloudcasting-app")
 except PackageNotFoundError:
     __version__ = "v?"
 
 
 # ---------------------------------------------------------------------------
 
-# Model will use GPU if available
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# The forecast produces these horizon steps
+FORECAST_STEPS = pd.timedelta_range(start="15min", end="180min", freq="15min")
 
-# Model revision on huggingface
-REPO_ID = "openclimatefix/cloudcasting_uk"
-REVISION = "47643e89000e64e0150f7359ccc0cb6524948712"
 
+def get_forecast_encoding(ds_y_hat: xr.Dataset) -> dict:
+    """Get the zarr encoding used to save the forecast
 
-def app(t0=None):
-    """Inference function for production
+    The forecast is chunked so each chunk holds one step of one variable, which is how downstream
+    readers usually access it.
+    """
+    return {
+        "sat_pred": {
+            "chunks": (
+                1, 1, 1, len(ds_y_hat.y_geostationary), len(ds_y_hat.x_geostationary),
+            ),
+            "compressors": [
+                zarr.codecs.BloscCodec(cname="zstd", clevel=5, shuffle="bitshuffle"),
+            ],
+        },
+    }
+
+
+def get_latest_pointer_path(latest_path: str) -> str:
+    """Get the path of the pointer object which names the forecast published to the latest path"""
+    return f"{latest_path.rstrip('/').removesuffix('.zarr')}.json"
+
+
+def read_latest_pointer(fs: fsspec.AbstractFileSystem, latest_path: str) -> dict | None:
+    """Read the pointer to the forecast published to the latest path, or None if there is none"""
+    pointer_path = get_latest_pointer_path(latest_path)
+    if not fs.exists(pointer_path):
+        return None
+    return json.loads(fs.cat_file(pointer_path))
+
+
+def open_latest_forecast(latest_path: str) -> xr.Dataset:
+    """Lazily open the forecast published to the latest path
 
     Args:
-        t0 (datetime): Datetime at which forecast is made
+        latest_path: The latest path, e.g. "<PREDICTION_SAVE_DIRECTORY>/latest.zarr"
     """
-    logger.info(f"Using `cloudcasting-app` version: {__version__}", version=__version__)
+    fs, _ = fsspec.core.url_to_fs(latest_path)
+    pointer = read_latest_pointer(fs, latest_path)
+    if pointer is None:
+        raise FileNotFoundError(f"No forecast has been published to {latest_path}")
 
-    # ---------------------------------------------------------------------------
-    # 0. If inference datetime is None, round down to last 30 minutes
-    if t0 is None:
-        t0 = pd.Timestamp.now(tz="UTC").replace(tzinfo=None).floor("30min")
-    else:
-        t0 = pd.to_datetime(t0).floor("30min")
+    return xr.open_zarr(f"{latest_path.rstrip('/').rsplit('/', 1)[0]}/{pointer['path']}")
 
-    logger.info(f"Making forecast for init time: {t0}")
 
-    # ---------------------------------------------------------------------------
-    # 1. Prepare the input data
-    logger.info("Downloading satellite data")
-    satellite_downloader = SatelliteDownloader()
-    satellite_downloader.prepare_satellite_data(t0)
+def get_published_init_time(
+    fs: fsspec.AbstractFileSystem, latest_path: str,
+) -> pd.Timestamp | None:
+    """Get the init-time of the forecast published to the latest path, or None if there is none"""
+    pointer = read_latest_pointer(fs, latest_path)
+    if pointer is not None:
+        return pd.Timestamp(pointer["init_time"])
 
-    # ---------------------------------------------------------------------------
-    # 2. Load model
-    logger.info("Loading model")
+    # The latest path may have been published before the pointer was written
+    if fs.exists(latest_path):
+        return pd.Timestamp(xr.open_zarr(latest_path).init_time.values.max())
+    return None
 
-    hf_download_dir = snapshot_download(
-        repo_id=REPO_ID,
-        revision=REVISION,
-    )
 
-    with open(f"{hf_download_dir}/model_config.yaml", encoding="utf-8") as f:
-        model = hydra.utils.instantiate(yaml.safe_load(f))
+def _is_zarr_metadata(path: str) -> bool:
+    """Check if a file of a zarr store holds metadata rather than chunk data"""
+    return os.path.basename(path) in {"zarr.json", ".zarray", ".zattrs", ".zgroup", ".zmetadata"}
+
 
-    model = model.to(device)
+def _copy_store_in_place(fs: fsspec.AbstractFileSystem, source_path: str, dest_path: str) -> None:
+    """Copy a zarr store over another without the destination ever being missing
 
-    load_model(
-        model,
-        filename=f"{hf_download_dir}/model.safetensors",
-        strict=True,
+    The objects are overwritten one by one, each with a single atomic PUT. The chunks are copied
+    before the metadata, and any objects which are not in the source are removed afterwards.
+
+    Args:
+        fs: The filesystem the stores are on
+        source_path: The path of the store to copy
+        dest_path: The path of the store to overwrite. This is created if it does not exist
+    """
+    source_root = fs._strip_protocol(source_path).rstrip("/")
+    dest_root = fs._strip_protocol(dest_path).rstrip("/")
+
+    source_keys = [f.removeprefix(f"{source_root}/") for f in fs.find(source_root)]
+    dest_keys = (
+        [f.removeprefix(f"{dest_root}/") for f in fs.find(dest_root)]
+        if fs.exists(dest_root) else []
     )
 
-    model.eval()
+    chunk_keys = [k for k in source_keys if not _is_zarr_metadata(k)]
+    # Copy the metadata of the root last, so it is only updated once the rest of the store is
+    metadata_keys = sorted(
+        [k for k in source_keys if _is_zarr_metadata(k)], key=lambda k: -k.count("/"),
+    )
 
-    # ---------------------------------------------------------------------------
-    # 3. Get inference inputs
-    logger.info("Preparing inputs")
+    for keys in [chunk_keys, metadata_keys]:
+        if keys:
+            fs.copy(
+                [f"{source_root}/{k}" for k in keys],
+                [f"{dest_root}/{k}" for k in keys],
+            )
 
-    # Get inputs
-    ds = xr.open_zarr(sat_path).compute()
+    stale_keys = sorted(set(dest_keys) - set(source_keys))
+    if stale_keys:
+        fs.rm([f"{dest_root}/{k}" for k in stale_keys])
 
-    X = get_input_data(ds, t0)
 
-    # Convert to tensor, expand into batch dimension, and move to device
-    X = X[None, ...].to(device)
+def publish_latest(
+    fs: fsspec.AbstractFileSystem, source_path: str, latest_path: str, t0: pd.Timestamp,
+) -> None:
+    """Publish a saved forecast to the latest path without readers seeing it missing
 
-    # ---------------------------------------------------------------------------
-    # 4. Make predictions
-    logger.info("Making predictions")
+    A small JSON pointer next to the latest path, e.g. "latest.json", names the saved forecast and
+    its init-time. The pointer is replaced atomically with a single write, so readers of the
+    pointer always see a complete forecast (see `open_latest_forecast`).
 
-    with torch.no_grad():
-        y_hat = model(X).cpu().numpy()
+    The latest path also remains a zarr store which can be opened directly. On a local filesystem
+    it is a symlink to the saved forecast, which is swapped atomically. On object stores the
+    forecast is copied over it object by object, so it is never missing, although a reader may
+    briefly see chunks of both the old and new forecasts.
 
-    # ---------------------------------------------------------------------------
-    # 5. Save predictions
-    logger.info("Saving predictions")
+    Args:
+        fs: The filesystem the forecasts are saved on
+        source_path: The path of the saved forecast
+        latest_path: The latest path to publish to
+        t0: The init-time of the forecast
+    """
+    pointer = json.dumps(
+        {"path": os.path.basename(source_path.rstrip("/")), "init_time": t0.isoformat()},
+    ).encode()
+    pointer_path = get_latest_pointer_path(latest_path)
+
+    if isinstance(fs, LocalFileSystem):
+        # Remove any latest path saved as a directory before symlinks were used
+        if os.path.isdir(latest_path) and not os.path.islink(latest_path):
+            shutil.rmtree(latest_path)
+
+        tmp_link = f"{latest_path}.tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(source_path), tmp_link)
+        os.replace(tmp_link, latest_path)
+
+        with open(f"{pointer_path}.tmp", "wb") as f:
+            f.write(pointer)
+        os.replace(f"{pointer_path}.tmp", pointer_path)
+        return
+
+    # Object stores replace an object atomically with a single PUT
+    fs.pipe_file(pointer_path, pointer)
+
+    _copy_store_in_place(fs, source_path, latest_path)
+
+
+def get_forecast_paths(t0: pd.Timestamp, use_5_minute: bool) -> tuple[str, str]:
+    """Get the path a forecast is saved to and the latest path it is published to
+
+    Args:
+        t0: The init-time of the forecast
+        use_5_minute: Whether the forecast was made from the 5-minutely satellite data
+
+    Returns:
+        tuple: The path of the forecast and the latest path
+    """
+    out_dir = os.environ["PREDICTION_SAVE_DIRECTORY"]
+
+    if use_5_minute:
+        return t0.strftime(f"{out_dir}/%Y-%m-%dT%H:%M.zarr"), f"{out_dir}/latest.zarr"
+    else:
+        return t0.strftime(f"{out_dir}/%Y-%m-%dT%H:%M_0-deg.zarr"), f"{out_dir}/latest_0-deg.zarr"
+
+
+def write_forecast(ds_y_hat: xr.Dataset, path: str, pyramid_factors: list[int]) -> None:
+    """Write a forecast, and any coarsened pyramid levels of it, to a new zarr store
+
+    Args:
+        ds_y_hat: The forecast for a single init-time
+        path: The path of the store to write
+        pyramid_factors: The factors to coarsen the forecast by for the pyramid levels
+    """
+    ds_y_hat_saved = ds_y_hat
+    if pyramid_factors:
+        ds_y_hat_saved = ds_y_hat.assign_attrs(
+            multiscales=get_multiscales_metadata(pyramid_factors),
+        )
+
+    ds_y_hat_saved.to_zarr(path, encoding=get_forecast_encoding(ds_y_hat))
+
+    for group, ds_level in make_pyramid(ds_y_hat, pyramid_factors).items():
+        ds_level.to_zarr(path, group=group, encoding=get_forecast_encoding(ds_level))
+
+
+def save_forecast(
+    y_hat: np.ndarray,
+    t0: pd.Timestamp,
+    ds: xr.Dataset,
+    use_5_minute: bool,
+    update_latest: bool = True,
+) -> None:
+    """Save the forecast for a single init-time
+
+    The forecast is written once to a path named by its init-time, and then published to the
+    latest path. If a forecast has already been saved for the init-time it is replaced.
+
+    Args:
+        y_hat: The prediction with dims (variable, step, y, x)
+        t0: The init-time of the forecast
+        ds: The prepared satellite data the forecast was made from
+        use_5_minute: Whether the forecast was made from the 5-minutely satellite data
+        update_latest: Whether to also publish the forecast to the latest path. It is only
+            published if the forecast already at the latest path is not for a later init-time
+    """
     da_y_hat = xr.DataArray(
-        y_hat,
+        y_hat[None],
         dims=["init_time", "variable", "step", "y_geostationary", "x_geostationary"],
         coords={
             "init_time": [t0],
             "variable": ds.variable,
-            "step": pd.timedelta_range(start="15min", end="180min", freq="15min"),
+            "step": FORECAST_STEPS,
             "y_geostationary": ds.y_geostationary,
             "x_geostationary": ds.x_geostationary,
         },
@@ -119,22 +292,195 @@ def app(t0=None):
     ds_y_hat = da_y_hat.to_dataset(name="sat_pred")
     ds_y_hat.sat_pred.attrs.update(ds.data.attrs)
 
-    # Save predictions to the latest path and to path with timestring
-    out_dir = os.environ["PREDICTION_SAVE_DIRECTORY"]
+    # Save predictions to the path with timestring and publish it to the latest path
+    t0_string_zarr_path, latest_zarr_path = get_forecast_paths(t0, use_5_minute)
+
+    fs = fsspec.open(os.environ["PREDICTION_SAVE_DIRECTORY"]).fs
 
-    if satellite_downloader.use_5_minute:
-        latest_zarr_path = f"{out_dir}/latest.zarr"
-        t0_string_zarr_path = t0.strftime(f"{out_dir}/%Y-%m-%dT%H:%M.zarr")
+    # Optionally save coarsened pyramid levels of the forecast as groups in the same store
+    pyramid_factors = parse_pyramid_factors(os.getenv("PREDICTION_PYRAMID_FACTORS"))
+
+    if not fs.exists(t0_string_zarr_path):
+        write_forecast(ds_y_hat, t0_string_zarr_path, pyramid_factors)
     else:
-        latest_zarr_path = f"{out_dir}/latest_0-deg.zarr"
-        t0_string_zarr_path = t0.strftime(f"{out_dir}/%Y-%m-%dT%H:%M_0-deg.zarr")
+        # The forecast is being made again, and the old one may be published to the latest path.
+        # So the new forecast is written to a staging path, which is published while the old
+        # forecast is replaced, so the latest path never names a missing or half-written forecast.
+        # The staging path does not end in ".zarr" so it is not picked up as a forecast
+        staging_path = f"{t0_string_zarr_path.rstrip('/')}.staging"
+        if fs.exists(staging_path):
+            fs.rm(staging_path, recursive=True)
+        write_forecast(ds_y_hat, staging_path, pyramid_factors)
+
+        pointer = read_latest_pointer(fs, latest_zarr_path)
+        is_published = (
+            pointer is not None
+            and pointer["path"] == os.path.basename(t0_string_zarr_path.rstrip("/"))
+        )
+        if is_published:
+            publish_latest(fs, staging_path, latest_zarr_path, t0)
+
+        logger.info(f"Replacing path: {t0_string_zarr_path}")
+        fs.rm(t0_string_zarr_path, recursive=True)
+        fs.copy(staging_path, t0_string_zarr_path, recursive=True)
+
+        if is_published:
+            publish_latest(fs, t0_string_zarr_path, latest_zarr_path, t0)
+        fs.rm(staging_path, recursive=True)
+
+    if update_latest:
+        # Don't replace a newer forecast, e.g. when catching up on older init-times
+        published_t0 = get_published_init_time(fs, latest_zarr_path)
+        if published_t0 is not None and published_t0 > t0:
+            logger.info(f"Not publishing {t0_string_zarr_path} as {published_t0} is newer")
+        else:
+            logger.info(f"Publishing {t0_string_zarr_path} to {latest_zarr_path}")
+            publish_latest(fs, t0_string_zarr_path, latest_zarr_path, t0)
+
+    # Optionally append to the icechunk archive of all forecasts
+    archive_path = os.getenv("PREDICTION_ICECHUNK_ARCHIVE")
+    if archive_path is not None:
+        logger.info(f"Appending forecast to archive {archive_path}")
+        try:
+            append_forecast(
+                ds_y_hat,
+                archive_path,
+                group=None if use_5_minute else "0-deg",
+                encoding=get_forecast_encoding(ds_y_hat),
+            )
+        except ValueError:
+            # e.g. the init-time is before the last init-time in the archive
+            logger.exception(f"Forecast for init time {t0} was not added to the archive")
+
+
+def make_predictions(
+    model: Callable[[torch.Tensor], torch.Tensor],
+    X: torch.Tensor,
+    batch_size: int,
+    tile_grid: TileGrid | None = None,
+) -> np.ndarray:
+    """Run the inputs through the model in batches
 
-    fs = fsspec.open(out_dir).fs
-    for path in [latest_zarr_path, t0_string_zarr_path]:
+    Args:
+        model: The model
+        X: The inputs with dims (init_time, variable, time, y, x)
+        batch_size: The number of init-times, or tiles if tiling, to run through the model at once
+        tile_grid: If not None, the inputs cover a larger domain and are split into these tiles
+
+    Returns:
+        np.ndarray: The predictions with dims (init_time, variable, step, y, x)
+    """
+    with torch.no_grad():
+        if tile_grid is not None:
+            return predict_tiled(model, X, tile_grid, batch_size, device)
 
-        # Remove the path if it exists already
-        if fs.exists(path):
-            logger.info(f"Removing path: {path}")
-            fs.rm(path, recursive=True)
+        y_hats = []
+        for i in range(0, len(X), batch_size):
+            y_hats.append(model(X[i:i+batch_size].to(device)).cpu().numpy())
+        return np.concatenate(y_hats)
 
-        ds_y_hat.to_zarr(path)
+
+def get_domain_tile_grid(ds: xr.Dataset) -> TileGrid:
+    """Get the grid of tiles covering the domain of the prepared satellite data"""
+    return get_tile_grid(
+        (len(ds.y_geostationary), len(ds.x_geostationary)),
+        overlap=int(os.getenv("INFERENCE_TILE_OVERLAP", TILE_OVERLAP)),
+    )
+
+
+def app(
+    t0: pd.Timestamp | str | list[pd.Timestamp] | pd.DatetimeIndex | None = None,
+    model: Callable[[torch.Tensor], torch.Tensor] | None = None,
+    batch_size: int | None = None,
+) -> None:
+    """Inference function for production
+
+    Args:
+        t0: Datetime at which forecast is made. If multiple datetimes are given, a forecast is
+            made for each and they share the loaded satellite data. Only the forecast for the
+            latest of these is saved to the latest path, and only if it is newer than the forecast
+            already there.
+        model: A preloaded model to use. If None, the model is loaded from huggingface
+        batch_size: The number of init-times, or tiles in tiled inference, to run through the model
+            at once. Defaults to the environmental variable INFERENCE_BATCH_SIZE, or 4 if that is
+            not set.
+    """
+    logger.info(f"Using `cloudcasting-app` version: {__version__}", version=__version__)
+
+    if batch_size is None:
+        batch_size = int(os.getenv("INFERENCE_BATCH_SIZE", "4"))
+
+    # If a domain is given, the forecast is made over it by tiled inference
+    domain = parse_domain(os.getenv("INFERENCE_DOMAIN"))
+
+    # Measure the time, memory and I/O of each stage
+    recorder = StageRecorder(summary_path=os.getenv("INFERENCE_SUMMARY_PATH"))
+
+    # ---------------------------------------------------------------------------
+    # 0. If inference datetime is None, round down to last 30 minutes
+    if t0 is None:
+        init_times = pd.DatetimeIndex([pd.Timestamp.now(tz="UTC").replace(tzinfo=None)])
+    else:
+        init_times = pd.DatetimeIndex(np.atleast_1d(pd.to_datetime(t0)))
+
+    init_times = init_times.floor("30min").unique().sort_values()
+
+    logger.info(f"Making forecast for init times: {list(init_times.astype(str))}")
+
+    # ---------------------------------------------------------------------------
+    # 1. Prepare the input data
+    logger.info("Downloading satellite data")
+    with recorder.stage("prepare_data") as stage:
+        satellite_downloader = SatelliteDownloader(recorder=recorder, domain=domain)
+        ds = satellite_downloader.prepare_satellite_data(
+            init_times, save_path=os.getenv("SATELLITE_DEBUG_SAVE_PATH"),
+        )
+        init_times = satellite_downloader.init_times
+        stage.add(frames=len(ds.time))
+
+    # ---------------------------------------------------------------------------
+    # 2. Load model
+    if model is None:
+        logger.info("Loading model")
+        with recorder.stage("load_model"):
+            model = get_model()
+
+    # ---------------------------------------------------------------------------
+    # 3. Get inference inputs
+    logger.info("Preparing inputs")
+
+    # Inputs with dims (init_time, variable, time, y, x)
+    with recorder.stage("prepare_inputs") as stage:
+        X = get_batched_input_data(ds, init_times)
+        stage.add(frames=len(ds.time))
+
+    # ---------------------------------------------------------------------------
+    # 4. Make predictions
+    logger.info("Making predictions")
+
+    with recorder.stage("predict") as stage:
+        tile_grid = None if domain is None else get_domain_tile_grid(ds)
+        y_hat = make_predictions(model, X, batch_size, tile_grid)
+        if tile_grid is not None:
+            stage.add(tiles=len(init_times) * len(tile_grid))
+        stage.add(forecasts=len(init_times), frames=len(init_times) * len(FORECAST_STEPS))
+
+    # ---------------------------------------------------------------------------
+    # 5. Save predictions
+    logger.info("Saving predictions")
+
+    with recorder.stage("save") as stage:
+        for i, init_time in enumerate(init_times):
+            save_forecast(
+                y_hat[i],
+                init_time,
+                ds,
+                use_5_minute=satellite_downloader.use_5_minute,
+                update_latest=init_time == init_times.max(),
+            )
+        stage.add(forecasts=len(init_times))
+
+    logger.info(
+        f"Forecast for init times {list(init_times.astype(str))} complete", **recorder.timings,
+    )
+    recorder.write_summary()
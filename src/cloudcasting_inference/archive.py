@@ -0,0 +1,134 @@
+"""An append-only icechunk archive of the forecasts, and reading from icechunk archives
+
+Each forecast is appended along the `init_time` dimension of a single icechunk repository in its
+own transactional commit, so readers only ever see complete forecasts and the whole archive can be
+opened lazily in one go.
+"""
+
+import icechunk
+import xarray as xr
+from icechunk.xarray import to_icechunk
+from loguru import logger
+
+
+def get_icechunk_storage(path: str) -> icechunk.Storage:
+    """Get the storage for a local or s3 icechunk repository
+
+    Args:
+        path: The path to the local or s3 icechunk store
+    """
+    if path.startswith("s3://"):
+        bucket, _, prefix = path.removeprefix("s3://").partition("/")
+        return icechunk.s3_storage(bucket=bucket, prefix=prefix, from_env=True)
+    return icechunk.local_filesystem_storage(path=path)
+
+
+def open_icechunk(path: str, group: str | None = None) -> xr.Dataset:
+    """Lazily open the main branch of a local or s3 icechunk repository
+
+    Args:
+        path: The path to the local or s3 icechunk store
+        group: The group within the repository to open
+    """
+    repo = icechunk.Repository.open(get_icechunk_storage(path))
+    session = repo.readonly_session("main")
+    return xr.open_zarr(session.store, group=group)
+
+
+def append_forecast(
+    ds_y_hat: xr.Dataset,
+    path: str,
+    group: str | None = None,
+    encoding: dict | None = None,
+    max_tries: int = 5,
+) -> str:
+    """Append a forecast to the icechunk archive and commit it
+
+    If the archive already contains a forecast for the same init-time, it is overwritten in place.
+    Otherwise the init-time must be after the last init-time in the archive, so the init-times of
+    the archive stay in order and it can be sliced by init-time.
+
+    If another writer commits to the archive at the same time, the commit is rebased onto theirs.
+    If the changes conflict, e.g. both appended a forecast, the forecast is written again on top of
+    the new commit.
+
+    Args:
+        ds_y_hat: The forecast for a single init-time
+        path: The path to the local or s3 icechunk archive. This is created if it does not exist
+        group: The group within the archive to save to
+        encoding: The encoding to use if this is the first forecast in the group
+        max_tries: The number of times to try to write and commit the forecast
+
+    Returns:
+        str: The ID of the commit
+    """
+    init_time = ds_y_hat.init_time.values[0]
+
+    repo = icechunk.Repository.open_or_create(get_icechunk_storage(path))
+
+    for attempt in range(1, max_tries + 1):
+        session = repo.writable_session("main")
+        _write_forecast(ds_y_hat, session, path, group, encoding)
+
+        try:
+            return session.commit(
+                f"Add forecast for init time {init_time}",
+                rebase_with=icechunk.ConflictDetector(),
+            )
+        except (icechunk.ConflictError, icechunk.RebaseFailedError):
+            logger.warning(
+                f"Conflicting commit to {path} while adding init time {init_time} "
+                f"(attempt {attempt} of {max_tries})",
+            )
+
+    raise Exception(f"Failed to commit forecast for init time {init_time} to {path}")
+
+
+def _write_forecast(
+    ds_y_hat: xr.Dataset,
+    session: icechunk.Session,
+    path: str,
+    group: str | None,
+    encoding: dict | None,
+) -> None:
+    """Write a forecast into a writable session of the archive, without committing it"""
+    init_time = ds_y_hat.init_time.values[0]
+
+    try:
+        ds_archive = xr.open_zarr(session.store, group=group)
+    except FileNotFoundError:
+        ds_archive = xr.Dataset()
+
+    if "sat_pred" not in ds_archive:
+        # Fix the time units so later init-times are not truncated when they are appended
+        encoding = {
+            **(encoding or {}),
+            "init_time": {"units": "minutes since 1970-01-01", "dtype": "int64"},
+        }
+        # Use append mode so that any other groups in the archive are not removed
+        to_icechunk(ds_y_hat, session, group=group, mode="a", encoding=encoding)
+
+    elif init_time in ds_archive.init_time.values:
+        logger.info(f"Overwriting forecast for init time {init_time} in {path}")
+        index = int((ds_archive.init_time.values == init_time).argmax())
+        to_icechunk(
+            ds_y_hat.drop_vars(
+                [v for v in ds_y_hat.variables if "init_time" not in ds_y_hat[v].dims],
+            ),
+            session,
+            group=group,
+            region={"init_time": slice(index, index + 1)},
+        )
+
+    elif init_time < ds_archive.init_time.values.max():
+        raise ValueError(
+            f"Cannot add the forecast for init time {init_time} to {path} as it is before the last "
+            f"init time {ds_archive.init_time.values.max()} in the archive",
+        )
+
+    else:
+        for coord in ["variable", "step", "x_geostationary", "y_geostationary"]:
+            if not (ds_archive[coord].values == ds_y_hat[coord].values).all():
+                raise Exception(f"Found differences in coord: {coord}")
+
+        to_icechunk(ds_y_hat, session, group=group, append_dim="init_time")
@@ -0,0 +1,478 @@
+"""A persistent local cache of satellite frames which is synced incrementally from the remote
+satellite archives, and a cache of the frames after they are prepared for the model.
+
+Each cached timestamp is stored as its own small zarr so that syncing only needs to fetch the
+frames which are not already held locally, and eviction is a cheap directory removal.
+
+Each prepared frame is stored as its own numpy file, which is memory-mapped when it is loaded, so
+the frames shared by consecutive runs are only prepared once.
+
+The files of the model are stored in a content-addressed cache keyed by their checksums, with a
+manifest for each model revision, so a cached revision is loaded without contacting the hub.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import fsspec
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+
+logger = logging.getLogger(__name__)
+
+# The model uses 12 timestamps of 15 minutely data up to and including t0
+INPUT_WINDOW = pd.Timedelta("165min")
+
+# Frames are kept for this long beyond the input window so late runs can still be made
+CACHE_MARGIN = pd.Timedelta("60min")
+
+_MANIFEST_NAME = "manifest.json"
+_FRAME_FORMAT = "%Y-%m-%dT%H%M.zarr"
+_PREPARED_FRAME_FORMAT = "%Y-%m-%dT%H%M.npy"
+
+# Model files are read in blocks of this many bytes to compute their checksums
+_CHECKSUM_BLOCK_SIZE = 2**24
+
+
+def open_sat_zarr(path: str) -> xr.Dataset:
+    """Lazily open a local or remote satellite zarr, which may be zipped
+
+    Only the metadata and coordinates are read here. Zipped stores are read through fsspec so that
+    individual chunks can be fetched from the remote zip without downloading the whole archive.
+
+    Args:
+        path: The path to the satellite zarr
+
+    Returns:
+        xr.Dataset: The lazily loaded satellite data
+    """
+    if path.endswith(".zip"):
+        fs = fsspec.filesystem("zip", fo=path)
+        store = zarr.storage.FsspecStore(
+            AsyncFileSystemWrapper(fs, asynchronous=True),
+            path="",
+            read_only=True,
+            # The zip filesystem raises KeyError for missing keys
+            allowed_exceptions=(FileNotFoundError, IsADirectoryError, NotADirectoryError, KeyError),
+        )
+        return xr.open_zarr(store)
+    return xr.open_zarr(path)
+
+
+class SatelliteCache:
+    """A local cache of satellite frames synced incrementally from a remote archive
+
+    The timestamps held are recorded in a manifest file in the cache directory.
+    """
+
+    def __init__(self, cache_dir: str, max_age: pd.Timedelta = INPUT_WINDOW + CACHE_MARGIN):
+        """A local cache of satellite frames synced incrementally from a remote archive
+
+        Args:
+            cache_dir: The local directory to store the cached frames in
+            max_age: Frames older than this relative to the init-time are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return f"{self.cache_dir}/{_MANIFEST_NAME}"
+
+    def frame_path(self, timestamp: pd.Timestamp) -> str:
+        return f"{self.cache_dir}/{timestamp.strftime(_FRAME_FORMAT)}"
+
+    @property
+    def timestamps(self) -> pd.DatetimeIndex:
+        """The timestamps currently held in the cache"""
+        if not os.path.exists(self.manifest_path):
+            return pd.DatetimeIndex([])
+        with open(self.manifest_path, encoding="utf-8") as f:
+            return pd.DatetimeIndex(json.load(f)["timestamps"])
+
+    def _write_manifest(self, timestamps: pd.DatetimeIndex) -> None:
+        # Write to a temporary file and swap it in so a crash never leaves a corrupt manifest
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"timestamps": [t.isoformat() for t in timestamps.sort_values()]}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def sync(
+        self,
+        remote_path: str,
+        t0: pd.Timestamp,
+        timestamps: pd.DatetimeIndex | None = None,
+        ds_remote: xr.Dataset | None = None,
+    ) -> pd.DatetimeIndex:
+        """Fetch the frames from the remote archive which are needed and not already cached
+
+        Args:
+            remote_path: The path to the remote satellite zarr
+            t0: The init-time of the forecast. Frames older than `max_age` before this are not
+                fetched
+            timestamps: If given, only these timestamps are fetched
+            ds_remote: The remote data if it has already been lazily opened
+
+        Returns:
+            pd.DatetimeIndex: The timestamps which were newly fetched
+        """
+        ds = open_sat_zarr(remote_path) if ds_remote is None else ds_remote
+
+        remote_times = pd.DatetimeIndex(ds.time.values)
+        cached_times = self.timestamps
+
+        needed = (remote_times >= t0 - self.max_age) & ~remote_times.isin(cached_times)
+        if timestamps is not None:
+            needed &= remote_times.isin(timestamps)
+
+        new_times = remote_times[needed]
+
+        if len(new_times) == 0:
+            logger.info(f"No new frames to sync from {remote_path}")
+            return new_times
+
+        logger.info(f"Syncing {len(new_times)} new frames from {remote_path}")
+
+        # Load all the new frames at once so that chunks shared between frames are read once
+        ds_new = ds.sel(time=new_times).compute()
+
+        for t in new_times:
+            ds_frame = ds_new.sel(time=[t])
+
+            # Clear the remote encoding since it may not match the single frame chunking
+            for v in ds_frame.variables:
+                ds_frame[v].encoding.clear()
+
+            ds_frame.to_zarr(self.frame_path(t), mode="w")
+
+            # Update the manifest after each frame so an interrupted sync is not repeated
+            cached_times = cached_times.append(pd.DatetimeIndex([t]))
+            self._write_manifest(cached_times)
+
+        return new_times
+
+    def evict(self, t0: pd.Timestamp) -> pd.DatetimeIndex:
+        """Remove frames which are too old to be used for forecasts at or after t0
+
+        Args:
+            t0: The init-time of the forecast
+
+        Returns:
+            pd.DatetimeIndex: The timestamps which were evicted
+        """
+        cached_times = self.timestamps
+        old_times = cached_times[cached_times < t0 - self.max_age]
+
+        if len(old_times) > 0:
+            logger.info(f"Evicting {len(old_times)} old frames from {self.cache_dir}")
+            self._write_manifest(cached_times.difference(old_times))
+
+            for t in old_times:
+                if os.path.exists(self.frame_path(t)):
+                    shutil.rmtree(self.frame_path(t))
+
+        return old_times
+
+    def open(self) -> xr.Dataset:
+        """Lazily open all the cached frames as a single dataset"""
+        cached_times = self.timestamps.sort_values()
+
+        if len(cached_times) == 0:
+            raise FileNotFoundError(f"No satellite frames found in cache {self.cache_dir}")
+
+        return xr.concat(
+            [xr.open_zarr(self.frame_path(t)) for t in cached_times],
+            dim="time",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+            combine_attrs="override",
+        )
+
+
+def get_frame_key(ds: xr.Dataset) -> str:
+    """Get a key of the grid and channels of the prepared frames
+
+    Prepared frames with different keys cannot be used together.
+
+    Args:
+        ds: The prepared satellite data
+    """
+    key = hashlib.sha256()
+    for coord in ["variable", "y_geostationary", "x_geostationary"]:
+        key.update(np.ascontiguousarray(ds[coord].values).tobytes())
+    key.update(str(FrameCache.version).encode())
+    return key.hexdigest()
+
+
+class FrameCache:
+    """A local cache of satellite frames which have been prepared for the model
+
+    Each frame is stored as a float32 numpy file with dims (variable, y, x). The timestamps held and
+    the key of the grid and channels of the frames are recorded in a manifest file in the cache
+    directory.
+    """
+
+    # Increment this if the preparation of the frames changes, to invalidate the cached frames
+    version = 1
+
+    def __init__(self, cache_dir: str, max_age: pd.Timedelta = INPUT_WINDOW + CACHE_MARGIN):
+        """A local cache of satellite frames which have been prepared for the model
+
+        Args:
+            cache_dir: The local directory to store the prepared frames in
+            max_age: Frames older than this relative to the init-time are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return f"{self.cache_dir}/{_MANIFEST_NAME}"
+
+    def frame_path(self, timestamp: pd.Timestamp) -> str:
+        return f"{self.cache_dir}/{timestamp.strftime(_PREPARED_FRAME_FORMAT)}"
+
+    def _read_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"key": None, "timestamps": []}
+        with open(self.manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, key: str | None, timestamps: pd.DatetimeIndex) -> None:
+        # Write to a temporary file and swap it in so a crash never leaves a corrupt manifest
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"key": key, "timestamps": [t.isoformat() for t in timestamps.sort_values()]}, f,
+            )
+        os.replace(tmp_path, self.manifest_path)
+
+    @property
+    def key(self) -> str | None:
+        """The key of the grid and channels of the cached frames"""
+        return self._read_manifest()["key"]
+
+    @property
+    def timestamps(self) -> pd.DatetimeIndex:
+        """The timestamps currently held in the cache"""
+        return pd.DatetimeIndex(self._read_manifest()["timestamps"])
+
+    def validate(self, key: str) -> None:
+        """Remove all the cached frames if they were prepared with a different grid or channels
+
+        Args:
+            key: The key of the grid and channels of the frames which will be loaded
+        """
+        if self.key == key:
+            return
+
+        cached_times = self.timestamps
+        if len(cached_times) > 0:
+            logger.info(f"Removing {len(cached_times)} frames with a different grid or channels")
+
+        self._write_manifest(key, pd.DatetimeIndex([]))
+        for t in cached_times:
+            if os.path.exists(self.frame_path(t)):
+                os.remove(self.frame_path(t))
+
+    def put(self, timestamp: pd.Timestamp, frame: np.ndarray) -> None:
+        """Add a prepared frame to the cache
+
+        Args:
+            timestamp: The timestamp of the frame
+            frame: The prepared frame with dims (variable, y, x)
+        """
+        # Write to a temporary file and move it into place so a partial frame is never loaded
+        tmp_path = f"{self.frame_path(timestamp)}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, frame.astype(np.float32, copy=False))
+        os.replace(tmp_path, self.frame_path(timestamp))
+
+        manifest = self._read_manifest()
+        timestamps = pd.DatetimeIndex(manifest["timestamps"])
+        if timestamp not in timestamps:
+            self._write_manifest(manifest["key"], timestamps.append(pd.DatetimeIndex([timestamp])))
+
+    def load(self, timestamps: pd.DatetimeIndex) -> list[np.ndarray]:
+        """Memory-map the prepared frames of the timestamps
+
+        Args:
+            timestamps: The timestamps to load. These must all be held in the cache
+
+        Returns:
+            list: The read-only memory-mapped frames, each with dims (variable, y, x)
+        """
+        return [np.load(self.frame_path(t), mmap_mode="r") for t in timestamps]
+
+    def evict(self, t0: pd.Timestamp) -> pd.DatetimeIndex:
+        """Remove frames which are too old to be used for forecasts at or after t0
+
+        Args:
+            t0: The init-time of the forecast
+
+        Returns:
+            pd.DatetimeIndex: The timestamps which were evicted
+        """
+        manifest = self._read_manifest()
+        cached_times = pd.DatetimeIndex(manifest["timestamps"])
+        old_times = cached_times[cached_times < t0 - self.max_age]
+
+        if len(old_times) > 0:
+            logger.info(f"Evicting {len(old_times)} old prepared frames from {self.cache_dir}")
+            self._write_manifest(manifest["key"], cached_times.difference(old_times))
+
+            for t in old_times:
+                if os.path.exists(self.frame_path(t)):
+                    os.remove(self.frame_path(t))
+
+        return old_times
+
+
+def _copy_with_checksum(source_path: str, destination_path: str) -> str:
+    """Copy a file and return the sha256 checksum of its contents"""
+    checksum = hashlib.sha256()
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        while block := source.read(_CHECKSUM_BLOCK_SIZE):
+            checksum.update(block)
+            destination.write(block)
+    return checksum.hexdigest()
+
+
+def _file_checksum(path: str) -> str:
+    """Get the sha256 checksum of the contents of a file"""
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(_CHECKSUM_BLOCK_SIZE):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+class ModelCache:
+    """A local content-addressed cache of the files of model revisions
+
+    Each file is stored once under the sha256 checksum of its contents. The manifest of each
+    revision maps the names of its files to their checksums and sizes, so once a revision is cached
+    it can be loaded without contacting the hub.
+    """
+
+    def __init__(self, cache_dir: str):
+        """A local content-addressed cache of the files of model revisions
+
+        Args:
+            cache_dir: The local directory to store the model files in
+        """
+        self.cache_dir = cache_dir
+
+    def manifest_path(self, repo_id: str, revision: str) -> str:
+        return f"{self.cache_dir}/revisions/{repo_id.replace('/', '--')}/{revision}.json"
+
+    def blob_path(self, checksum: str) -> str:
+        return f"{self.cache_dir}/blobs/{checksum}"
+
+    def compiled_dir(self, repo_id: str, revision: str) -> str:
+        """The directory the compiled versions of the model revision are cached in"""
+        return f"{self.cache_dir}/compiled/{repo_id.replace('/', '--')}/{revision}"
+
+    def verified_path(self, checksum: str) -> str:
+        return f"{self.cache_dir}/verified/{checksum}.json"
+
+    def _verify(self, path: str, checksum: str) -> bool:
+        """Check the checksum of a cached file, unless it was verified since it was last modified
+
+        When the checksum matches, the size and modification time of the file are recorded in a
+        marker, so each file is only read in full on its first load.
+        """
+        stat = os.stat(path)
+        signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+        verified_path = self.verified_path(checksum)
+        if os.path.exists(verified_path):
+            with open(verified_path, encoding="utf-8") as f:
+                if json.load(f) == signature:
+                    return True
+
+        if _file_checksum(path) != checksum:
+            return False
+
+        os.makedirs(os.path.dirname(verified_path), exist_ok=True)
+        with open(f"{verified_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(signature, f)
+        os.replace(f"{verified_path}.tmp", verified_path)
+        return True
+
+    def get(self, repo_id: str, revision: str, verify: bool = True) -> dict[str, str] | None:
+        """Get the paths of the cached files of a model revision
+
+        The sizes of the files are always checked against the manifest. If `verify` is True their
+        checksums are also checked, the first time each file is loaded after it was last modified.
+
+        Args:
+            repo_id: The huggingface repo of the model
+            revision: The revision of the model
+            verify: Whether to also check the checksums of the files
+
+        Returns:
+            dict: The paths of the files keyed by their names, or None if the revision is not cached
+                or any of its files are missing or corrupt
+        """
+        manifest_path = self.manifest_path(repo_id, revision)
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        paths = {}
+        for name, entry in manifest["files"].items():
+            path = self.blob_path(entry["sha256"])
+            if (
+                not os.path.exists(path)
+                or os.path.getsize(path) != entry["size"]
+                or (verify and not self._verify(path, entry["sha256"]))
+            ):
+                logger.warning(f"Cached file {name} of {repo_id}@{revision} is missing or corrupt")
+                return None
+            paths[name] = path
+
+        return paths
+
+    def put(self, repo_id: str, revision: str, files: dict[str, str]) -> dict[str, str]:
+        """Add the files of a model revision to the cache
+
+        Args:
+            repo_id: The huggingface repo of the model
+            revision: The revision of the model
+            files: The local paths of the files keyed by their names
+
+        Returns:
+            dict: The paths of the cached files keyed by their names
+        """
+        os.makedirs(f"{self.cache_dir}/blobs", exist_ok=True)
+
+        entries = {}
+        for name, source_path in files.items():
+            # Copy to a temporary file and move it into place once its checksum is known
+            tmp_path = f"{self.cache_dir}/blobs/{name}.tmp"
+            checksum = _copy_with_checksum(source_path, tmp_path)
+            os.replace(tmp_path, self.blob_path(checksum))
+            entries[name] = {"sha256": checksum, "size": os.path.getsize(self.blob_path(checksum))}
+
+        # The manifest is written last so the revision is only cached once all its files are
+        manifest_path = self.manifest_path(repo_id, revision)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"repo_id": repo_id, "revision": revision, "files": entries}, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+        logger.info(f"Cached {len(entries)} files of {repo_id}@{revision} in {self.cache_dir}")
+
+        return {name: self.blob_path(entry["sha256"]) for name, entry in entries.items()}
@@ -0,0 +1,195 @@
+"""A single command line interface to the inference and metrics apps
+
+The subcommands are:
+    run: Make the forecasts for one or more init-times
+    daemon: Keep the model resident and make a forecast every 30 minutes
+    hindcast: Make the forecasts for a historical period from the icechunk satellite archive
+    score: Score the forecasts of a single day
+    backfill: Score the forecasts of a range of days
+    validate-inputs: Check the configuration and that the satellite inputs are available, without
+        loading the model or downloading any satellite data
+
+Each subcommand is configured by the same environmental variables as the app it runs. The heavy
+dependencies (torch, the model libraries, icechunk etc) are only imported by the subcommands which
+use them, so `--help` and the pre-flight checks start quickly.
+"""
+
+import argparse
+import os
+import sys
+
+from loguru import logger
+
+# The environmental variables which must be set to make forecasts
+REQUIRED_INFERENCE_ENV_VARS = ("SATELLITE_ZARR_PATH", "PREDICTION_SAVE_DIRECTORY")
+
+
+def validate_inputs(init_times: list[str] | None = None) -> bool:
+    """Check the inference app is configured and the satellite inputs are available
+
+    Only the timestamps of the satellite data are read, and the model is not loaded.
+
+    Args:
+        init_times: The init-times to check. Defaults to the latest init-time
+
+    Returns:
+        bool: Whether forecasts can be made for all of the init-times
+    """
+    import pandas as pd
+
+    from cloudcasting_inference.data import SatelliteDownloader, get_required_timestamps
+
+    missing_env_vars = [v for v in REQUIRED_INFERENCE_ENV_VARS if os.getenv(v) is None]
+    if missing_env_vars:
+        logger.error(f"Missing environmental variables: {missing_env_vars}")
+        return False
+
+    if init_times:
+        init_times = pd.DatetimeIndex(init_times)
+    else:
+        init_times = pd.DatetimeIndex([pd.Timestamp.now(tz="UTC").replace(tzinfo=None)])
+
+    init_times = init_times.floor("30min").unique().sort_values()
+
+    downloader = SatelliteDownloader()
+    try:
+        _, available_timestamps = downloader.combine_5_and_15_sat_data()
+    except FileNotFoundError as e:
+        logger.error(str(e))
+        return False
+
+    valid = True
+    for t0 in init_times:
+        missing_timestamps = get_required_timestamps(t0).difference(available_timestamps)
+        if len(missing_timestamps) > 0:
+            logger.error(
+                f"Init-time {t0} is missing satellite timestamps: "
+                f"{list(missing_timestamps.astype(str))}",
+            )
+            valid = False
+        else:
+            logger.info(f"All satellite inputs are available for init-time {t0}")
+
+    return valid
+
+
+def _run(args: argparse.Namespace) -> None:
+    from cloudcasting_inference.app import app
+
+    app(args.init_time or None, batch_size=args.batch_size)
+
+
+def _daemon(args: argparse.Namespace) -> None:
+    from cloudcasting_inference.daemon import run_daemon
+
+    run_daemon(max_cycles=args.max_cycles)
+
+
+def _hindcast(args: argparse.Namespace) -> None:
+    from cloudcasting_inference.hindcast import hindcast
+
+    hindcast(args.start, args.end, batch_size=args.batch_size, use_5_minute=not args.zero_deg)
+
+
+def _score(args: argparse.Namespace) -> None:
+    import pandas as pd
+
+    from cloudcasting_metrics.app import app
+
+    app(None if args.date is None else pd.Timestamp(args.date))
+
+
+def _backfill(args: argparse.Namespace) -> None:
+    import pandas as pd
+
+    from cloudcasting_metrics.app import backfill
+
+    backfill(
+        start_date=None if args.start_date is None else pd.Timestamp(args.start_date),
+        end_date=None if args.end_date is None else pd.Timestamp(args.end_date),
+    )
+
+
+def _validate_inputs(args: argparse.Namespace) -> None:
+    if not validate_inputs(args.init_time):
+        sys.exit(1)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Build the parser of the command line arguments and subcommands"""
+    parser = argparse.ArgumentParser(
+        prog="cloudcasting", description=__doc__.split("\n")[0],
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Make the forecasts for one or more init-times")
+    run.add_argument(
+        "--init-time", nargs="+", default=None,
+        help="The init-times to forecast. Defaults to the latest init-time",
+    )
+    run.add_argument(
+        "--batch-size", type=int, default=None,
+        help="The number of init-times run through the model at once",
+    )
+    run.set_defaults(func=_run)
+
+    daemon = subparsers.add_parser("daemon", help="Make a forecast every 30 minutes")
+    daemon.add_argument(
+        "--max-cycles", type=int, default=None,
+        help="Stop after this many forecasts. Defaults to running forever",
+    )
+    daemon.set_defaults(func=_daemon)
+
+    hindcast = subparsers.add_parser(
+        "hindcast",
+        help="Make the forecasts for a historical period from the icechunk satellite archive",
+    )
+    hindcast.add_argument("--start", required=True, help="The first init-time to forecast")
+    hindcast.add_argument("--end", required=True, help="The last init-time to forecast")
+    hindcast.add_argument(
+        "--batch-size", type=int, default=None,
+        help="The number of init-times run through the model at once",
+    )
+    hindcast.add_argument(
+        "--0-deg", dest="zero_deg", action="store_true",
+        help="The archive holds the 15-minutely 0-degree data, so the forecasts are saved as such",
+    )
+    hindcast.set_defaults(func=_hindcast)
+
+    score = subparsers.add_parser("score", help="Score the forecasts of a single day")
+    score.add_argument("--date", default=None, help="The day to score. Defaults to yesterday")
+    score.set_defaults(func=_score)
+
+    backfill = subparsers.add_parser("backfill", help="Score the forecasts of a range of days")
+    backfill.add_argument(
+        "--start-date", default=None,
+        help="The first day to score. Defaults to METRIC_START_DATE, or yesterday",
+    )
+    backfill.add_argument(
+        "--end-date", default=None,
+        help="The last day to score. Defaults to METRIC_END_DATE, or the start date",
+    )
+    backfill.set_defaults(func=_backfill)
+
+    validate = subparsers.add_parser(
+        "validate-inputs",
+        aliases=["dry-run"],
+        help="Check the configuration and that the satellite inputs are available",
+    )
+    validate.add_argument(
+        "--init-time", nargs="+", default=None,
+        help="The init-times to check. Defaults to the latest init-time",
+    )
+    validate.set_defaults(func=_validate_inputs)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Run the subcommand given on the command line"""
+    args = get_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
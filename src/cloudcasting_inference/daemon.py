@@ -0,0 +1,145 @@
+"""Long-running scheduler which keeps the model resident and makes a forecast every 30 minutes
+
+This uses the same environmental variables as the app, and optionally:
+    DAEMON_RUN_DELAY (str): How long after each init-time to keep waiting for its satellite data
+        and retrying a failed forecast, e.g. "20min". Defaults to "25min"
+    DAEMON_POLL_INTERVAL (str): The interval the remote satellite data is polled at from the
+        init-time, and a failed forecast is retried at. Defaults to "30s"
+
+The forecast for each init-time is made as soon as the satellite frame at the init-time lands.
+"""
+
+import os
+import time
+from collections.abc import Callable
+
+import pandas as pd
+import torch
+from loguru import logger
+
+from cloudcasting_inference.app import app
+from cloudcasting_inference.data import get_satellite_timestamps, remote_sat_exists
+from cloudcasting_inference.model import get_model
+
+# The forecast is run at this frequency
+FORECAST_FREQ = pd.Timedelta("30min")
+
+
+def _now() -> pd.Timestamp:
+    return pd.Timestamp.now(tz="UTC").replace(tzinfo=None)
+
+
+def satellite_frame_available(t0: pd.Timestamp) -> bool:
+    """Check whether either of the remote satellite sources contains the frame at t0
+
+    Only the time coordinate of the remote data is read.
+    """
+    for remote_path in [os.getenv("SATELLITE_ZARR_PATH"), os.getenv("SATELLITE_15_ZARR_PATH")]:
+        if remote_sat_exists(remote_path) and t0 in get_satellite_timestamps(remote_path):
+            return True
+    return False
+
+
+def wait_for_init_time(
+    t0: pd.Timestamp,
+    deadline: pd.Timestamp,
+    poll_interval: pd.Timedelta,
+) -> bool:
+    """Sleep until the satellite frame at init-time t0 has landed
+
+    The remote satellite data is polled from t0 until the deadline. If polling fails, e.g. due to a
+    transient network error, the error is logged and the frame is treated as not landed yet.
+
+    Args:
+        t0: The init-time of the forecast
+        deadline: The time to stop waiting for the frame at
+        poll_interval: The interval the satellite data is polled at
+
+    Returns:
+        bool: Whether the frame landed before the deadline
+    """
+    while True:
+        now = _now()
+        if now >= t0:
+            try:
+                if satellite_frame_available(t0):
+                    return True
+            except Exception:
+                logger.exception(f"Failed to poll the satellite data for init time {t0}")
+        if now >= deadline:
+            return False
+
+        sleep_until = t0 if now < t0 else min(deadline, now + poll_interval)
+        time.sleep(max((sleep_until - now).total_seconds(), 0))
+
+
+def run_cycle(
+    t0: pd.Timestamp,
+    model: Callable[[torch.Tensor], torch.Tensor],
+    deadline: pd.Timestamp,
+    poll_interval: pd.Timedelta,
+) -> bool:
+    """Make the forecast for init-time t0 once its satellite data has landed
+
+    A failed forecast is retried every poll interval until the deadline.
+
+    Args:
+        t0: The init-time of the forecast
+        model: The resident model
+        deadline: The time to stop waiting for the satellite data and retrying at
+        poll_interval: The interval the satellite data is polled and the forecast retried at
+
+    Returns:
+        bool: Whether the forecast was made
+    """
+    while wait_for_init_time(t0, deadline, poll_interval):
+        try:
+            app(t0, model=model)
+            return True
+        except Exception:
+            logger.exception(f"Forecast for init time {t0} failed")
+
+        if _now() + poll_interval >= deadline:
+            break
+        time.sleep(poll_interval.total_seconds())
+
+    logger.error(f"Gave up on the forecast for init time {t0} at {deadline}")
+    return False
+
+
+def run_daemon(max_cycles: int | None = None) -> None:
+    """Load the model once and make a forecast for every init-time
+
+    Args:
+        max_cycles: Stop after this many forecast cycles. If None, run forever
+    """
+    run_delay = pd.Timedelta(os.getenv("DAEMON_RUN_DELAY", "25min"))
+    poll_interval = pd.Timedelta(os.getenv("DAEMON_POLL_INTERVAL", "30s"))
+
+    logger.info("Loading model")
+    load_start = time.perf_counter()
+    model = get_model()
+    logger.info(
+        f"Loaded model in {time.perf_counter() - load_start:.1f}s",
+        load_model_seconds=round(time.perf_counter() - load_start, 3),
+    )
+
+    t0 = _now().floor(FORECAST_FREQ)
+    cycles = 0
+
+    while max_cycles is None or cycles < max_cycles:
+        cycle_start = time.perf_counter()
+        success = run_cycle(t0, model, t0 + run_delay, poll_interval)
+
+        cycle_seconds = time.perf_counter() - cycle_start
+        logger.info(
+            f"Cycle for init time {t0} took {cycle_seconds:.1f}s",
+            init_time=str(t0),
+            success=success,
+            cycle_seconds=round(cycle_seconds, 3),
+            end_delay_seconds=round((_now() - t0).total_seconds(), 3),
+        )
+        cycles += 1
+
+        # If the cycle overran, skip straight to the latest init-time
+        t0 = max(t0 + FORECAST_FREQ, _now().floor(FORECAST_FREQ))
@@ -1,23 +1,43 @@
+"""Loading the satellite data and preparing it as inputs for the model
+
+The 5-minutely or 15-minutely satellite source is chosen using only the timestamps of the remote
+archives. The input frames are then read through the local satellite cache, or lazily straight
+from the remote archive, cropped to the model domain, reordered to the model channels and stacked
+into the input windows of the init-times.
+"""
+
 import logging
-import shutil
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
+import dask.array
 import fsspec
 import numpy as np
 import pandas as pd
-import zarr
-import torch
 import xarray as xr
-from ocf_data_sampler.select.geospatial import lon_lat_to_geostationary_area_coords
+
+from cloudcasting_inference.cache import (
+    INPUT_WINDOW,
+    FrameCache,
+    SatelliteCache,
+    get_frame_key,
+    open_sat_zarr,
+)
+from cloudcasting_inference.instrumentation import StageRecorder
+
+# torch and ocf_data_sampler are slow to import, so they are only imported when they are used.
+# This keeps checks which only read the satellite metadata fast
+if TYPE_CHECKING:
+    import torch
 
 
 xr.set_options(keep_attrs=True)
 
 logger = logging.getLogger(__name__)
 
-sat_5_path = "sat_5_min.zarr.zip"
-sat_15_path = "sat_15_min.zarr.zip"
-sat_path = "sat.zarr"
+sat_cache_dir = "sat_cache"
 
 lon_min = -16
 lon_max = 10
@@ -50,40 +70,103 @@ def get_satellite_timestamps(sat_zarr_path: str) -> pd.DatetimeIndex:
     Returns:
         pd.DatetimeIndex: All available satellite timestamps
     """
-    with zarr.storage.ZipStore(sat_zarr_path) as store:
-        ds = xr.open_zarr(store)
+    ds = open_sat_zarr(sat_zarr_path)
     return pd.to_datetime(ds.time.values)
 
 
-def crop_input_area(ds: xr.Dataset) -> xr.Dataset:
+def parse_domain(domain: str | None) -> tuple[float, float, float, float] | None:
+    """Parse a domain given as "lon_min,lat_min,lon_max,lat_max", or return None if not given"""
+    if domain is None:
+        return None
+    lon_0, lat_0, lon_1, lat_1 = (float(v) for v in domain.split(","))
+    return lon_0, lat_0, lon_1, lat_1
 
-    x_min, y_min = lon_lat_to_geostationary_area_coords(lon_min, lat_min, ds.data.attrs["area"])
+
+def get_domain_bounds(
+    domain: tuple[float, float, float, float],
+    area_string: str,
+) -> tuple[float, float, float, float]:
+    """Get the bounding box of a lon-lat domain in geostationary coords
+
+    Args:
+        domain: The (lon_min, lat_min, lon_max, lat_max) of the domain
+        area_string: The yaml geostationary area definition of the satellite data
+
+    Returns:
+        tuple: The (x_min, y_min, x_max, y_max) of the domain
+    """
+    from ocf_data_sampler.select.geospatial import lon_lat_to_geostationary_area_coords
+
+    lon_0, lat_0, lon_1, lat_1 = domain
+
+    # Lines of constant longitude and latitude are curved in the geostationary projection, so
+    # points all along the edges of the domain are projected
+    lons = np.linspace(lon_0, lon_1, 32)
+    lats = np.linspace(lat_0, lat_1, 32)
+    edge_lons = np.concatenate([lons, lons, np.full(32, lon_0), np.full(32, lon_1)])
+    edge_lats = np.concatenate([np.full(32, lat_0), np.full(32, lat_1), lats, lats])
+
+    x, y = lon_lat_to_geostationary_area_coords(edge_lons, edge_lats, area_string)
+    return float(np.min(x)), float(np.min(y)), float(np.max(x)), float(np.max(y))
+
+
+def crop_input_area(
+    ds: xr.Dataset,
+    domain: tuple[float, float, float, float] | None = None,
+) -> xr.Dataset:
+    """Crop the satellite data to the area the model was trained on, or to a larger domain
+
+    Args:
+        ds: The satellite data
+        domain: The (lon_min, lat_min, lon_max, lat_max) of the domain to crop to, for tiled
+            inference. If None, the data is cropped to the fixed UK area of the model input
+
+    Returns:
+        xr.Dataset: The cropped satellite data
+    """
+    from ocf_data_sampler.select.geospatial import lon_lat_to_geostationary_area_coords
 
     # x-axis is expected to be in decreasing order
     # y-axis is expected to be in ascending order
     assert ds.x_geostationary.values[0] > ds.x_geostationary.values[1]
     assert ds.y_geostationary.values[0] < ds.y_geostationary.values[1]
-    
-    ds = ds.isel(x_geostationary=slice(None, None, -1))
 
-    ds = (
-        ds
-        .sel(x_geostationary=slice(x_min, None), y_geostationary=slice(y_min, None))
-        .isel(x_geostationary=slice(0, x_size), y_geostationary=slice(0, y_size))
-    )
+    ds = ds.isel(x_geostationary=slice(None, None, -1))
 
-    assert len(ds.x_geostationary)==x_size
-    assert len(ds.y_geostationary)==y_size
+    if domain is None:
+        x_min, y_min = lon_lat_to_geostationary_area_coords(
+            lon_min, lat_min, ds.data.attrs["area"],
+        )
+
+        ds = (
+            ds
+            .sel(x_geostationary=slice(x_min, None), y_geostationary=slice(y_min, None))
+            .isel(x_geostationary=slice(0, x_size), y_geostationary=slice(0, y_size))
+        )
+
+        assert len(ds.x_geostationary)==x_size
+        assert len(ds.y_geostationary)==y_size
+    else:
+        # The domain is clipped to the extent of the satellite data
+        x_min, y_min, x_max, y_max = get_domain_bounds(domain, ds.data.attrs["area"])
+        ds = ds.sel(
+            x_geostationary=slice(x_min, x_max), y_geostationary=slice(y_min, y_max),
+        )
 
     return ds.isel(x_geostationary=slice(None, None, -1))  # flip back
 
 
-def get_input_data(ds: xr.Dataset, t0: pd.Timestamp) -> torch.Tensor:
+def get_required_timestamps(t0: pd.Timestamp) -> pd.DatetimeIndex:
+    """Get the 12 timestamps of 15 minutely data up to and including t0 used by the model"""
+    return pd.date_range(t0-INPUT_WINDOW, t0, freq="15min")
+
+
+def get_input_data(ds: xr.Dataset, t0: pd.Timestamp) -> "torch.Tensor":
     """Get the input data required to run the model for init-time t0"""
+    import torch
 
     # Slice the data
-    required_timestamps = pd.date_range(t0-pd.Timedelta("165min"), t0, freq="15min")
-    ds = ds.reindex(time=required_timestamps)
+    ds = ds.reindex(time=get_required_timestamps(t0))
 
     # Convert to arrays
     X = ds.data.values.astype(np.float32)
@@ -94,24 +177,153 @@ def get_input_data(ds: xr.Dataset, t0: pd.Timestamp) -> torch.Tensor:
     return torch.Tensor(X)
 
 
+def prepare_frames(ds: xr.Dataset) -> np.ndarray:
+    """Convert the satellite data to the model inputs, as float32 with NaNs set to -1"""
+    return np.nan_to_num(ds.data.values.astype(np.float32), nan=-1)
+
+
+def get_batched_input_data(ds: xr.Dataset, init_times: pd.DatetimeIndex) -> "torch.Tensor":
+    """Get the input data required to run the model for multiple init-times as one batch
+
+    Each satellite frame is read once and copied straight into the windows of the init-times which
+    use it, so no intermediate copies of the frames are made. The frames may be memory-mapped.
+
+    Args:
+        ds: The prepared satellite data
+        init_times: The init-times to get the inputs for
+
+    Returns:
+        torch.Tensor: The inputs with dims (init_time, variable, time, y, x)
+    """
+    import torch
+
+    da = ds.data.transpose("variable", "time", "y_geostationary", "x_geostationary")
+    available_timestamps = pd.DatetimeIndex(da.time.values)
+
+    windows = pd.DatetimeIndex(
+        np.stack([get_required_timestamps(t0) for t0 in init_times]).ravel(),
+    )
+    window_shape = (len(init_times), len(windows) // len(init_times))
+
+    X = np.empty(
+        (window_shape[0], len(da.variable), window_shape[1], *da.shape[2:]), dtype=np.float32,
+    )
+
+    for t in windows.unique():
+        if t in available_timestamps:
+            frame = da.isel(time=available_timestamps.get_loc(t)).values
+        else:
+            frame = np.nan
+
+        for i, j in zip(*np.unravel_index(np.flatnonzero(windows == t), window_shape), strict=True):
+            X[i, :, j] = frame
+
+    # Convert NaNs to -1
+    np.nan_to_num(X, copy=False, nan=-1)
+
+    return torch.from_numpy(X)
+
+
+def remote_sat_exists(remote_path: str | None) -> bool:
+    """Check whether the remote satellite data is configured and exists"""
+    if remote_path is None:
+        return False
+    fs, _ = fsspec.core.url_to_fs(remote_path)
+    return fs.exists(remote_path)
+
+
 class SatelliteDownloader:
 
-    def __init__(self):
+    def __init__(
+        self,
+        recorder: StageRecorder | None = None,
+        domain: tuple[float, float, float, float] | None = None,
+    ):
+        """Prepares the satellite inputs from the 5 or 15-minutely satellite data
+
+        Args:
+            recorder: The recorder the stages of syncing and loading the data are measured with
+            domain: The (lon_min, lat_min, lon_max, lat_max) of the domain to crop to, for tiled
+                inference. If None, the data is cropped to the fixed UK area of the model input
+        """
+        self.recorder = StageRecorder() if recorder is None else recorder
+        self.domain = domain
         self.use_5_minute = None
+        self.init_times = None
+
+        self.sat_5_remote_path = os.getenv("SATELLITE_ZARR_PATH")
+        self.sat_15_remote_path = os.getenv("SATELLITE_15_ZARR_PATH")
+
+        # If true, the satellite data is read straight from the remote archives without using
+        # the local cache
+        self.direct_read = os.getenv("SATELLITE_DIRECT_READ", "false").lower() == "true"
+
+        cache_dir = os.getenv("SATELLITE_CACHE_DIR", sat_cache_dir)
+        self.sat_5_cache = SatelliteCache(f"{cache_dir}/5min")
+        self.sat_15_cache = SatelliteCache(f"{cache_dir}/15min")
+
+        # The frames prepared for the model are cached so they are only prepared once
+        self.frame_5_cache = FrameCache(f"{cache_dir}/prepared_5min")
+        self.frame_15_cache = FrameCache(f"{cache_dir}/prepared_15min")
+
+    def prepare_satellite_data(
+        self,
+        t0: pd.Timestamp | pd.DatetimeIndex,
+        save_path: str | None = None,
+    ) -> xr.Dataset:
+        """Prepare the satellite data required to make forecasts for one or more init-times
+
+        When multiple init-times are given, any whose required timestamps are not all available
+        are skipped. The init-times which can be forecast are stored in `self.init_times`.
+
+        Only the crop and channels of the required timestamps are loaded into memory. But by
+        default the local satellite cache holds whole frames, so all channels over the full area of
+        each new frame are still synced before it is cropped. Only with direct reads
+        (SATELLITE_DIRECT_READ) are just the chunks of the crop and channels read from the remote.
 
-    def prepare_satellite_data(self, t0: pd.Timestamp) -> None:
+        Args:
+            t0: The init-time(s) of the forecast
+            save_path: If not None, the prepared data is also saved to this path for debugging
 
-        # Download the 5 and/or 15 minutely satellite data
-        self.download_all_sat_data()
+        Returns:
+            xr.Dataset: The cropped satellite data with dims (variable, time, y, x)
+        """
+        init_times = pd.DatetimeIndex(np.atleast_1d(t0)).sort_values()
 
-        # Select between the 5/15 minute satellite data sources
-        ds = self.combine_5_and_15_sat_data()
+        # Select between the 5/15 minute satellite data sources using only their timestamps
+        with self.recorder.stage("combine_satellite"):
+            ds_remote, available_timestamps = self.combine_5_and_15_sat_data()
 
         # Check the required expected timestamps are available
-        self.check_required_timestamps_available(ds, t0)
+        if len(init_times) == 1:
+            self.check_required_timestamps_available(available_timestamps, init_times[0])
+        else:
+            complete = np.array(
+                [get_required_timestamps(t).isin(available_timestamps).all() for t in init_times],
+            )
+            if not complete.any():
+                raise Exception(f"None of the init-times {init_times} have all required timestamps")
+            for t in init_times[~complete]:
+                logger.warning(f"Skipping init-time {t} due to missing satellite data")
+            init_times = init_times[complete]
+
+        self.init_times = init_times
+
+        # Select only the timestamps, area and channels required before loading any data
+        required_timestamps = pd.DatetimeIndex(
+            np.unique(np.concatenate([get_required_timestamps(t) for t in init_times])),
+        )
+
+        if self.direct_read:
+            ds = ds_remote
+        else:
+            # Sync only the required frames of the chosen source into the local cache
+            ds = self.download_sat_data(ds_remote, init_times.min(), required_timestamps)
+
+        ds = ds.sel(time=required_timestamps)
 
         # Crop the input area to expected
-        ds = crop_input_area(ds)
+        ds = crop_input_area(ds, self.domain)
 
         # Reorder channels
         ds = ds.sel(variable=channel_order)
@@ -119,53 +331,149 @@ class SatelliteDownloader:
         # Reshape to (channel, time, height, width)
         ds = ds.transpose("variable", "time", "y_geostationary", "x_geostationary")
 
-        # Resave
-        ds.to_zarr(sat_path)
-
-    def download_all_sat_data(self) -> None:
-        """Download the sat data"""
-        # Clean out old files
-        logger.info("Cleaning out old satellite data")
-        for loc in [sat_path, sat_5_path, sat_15_path]:
-            if os.path.exists(loc):
-                shutil.rmtree(loc)
-
-        sat_5_dl_path = os.getenv("SATELLITE_ZARR_PATH")
-        sat_15_dl_path = os.getenv("SATELLITE_15_ZARR_PATH")
-
-        for remote_path, local_path, label in [
-            (sat_5_dl_path, sat_5_path, "5-min"), 
-            (sat_15_dl_path, sat_15_path, "15-min"),
-        ]:  
-            if remote_path is not None:
-                fs, _ = fsspec.core.url_to_fs(remote_path)
-                if fs.exists(remote_path):
-                    logger.info(f"Downloading {label} satellite data")
-                    fs.get(remote_path, local_path)
-                else:
-                    logger.info(f"No {label} data available to download")
-
-    def combine_5_and_15_sat_data(self) -> xr.Dataset:
-        """Select and/or combine the 5 and 15-minutely satellite data"""
+        if self.direct_read:
+            # Only the required chunks are read here
+            with self.recorder.stage("load_satellite") as stage:
+                ds = ds.compute()
+                stage.add(frames=len(ds.time))
+        else:
+            ds = self.load_prepared_frames(ds)
+
+        # Optionally resave for debugging
+        if save_path is not None:
+            logger.info(f"Saving prepared satellite data to {save_path}")
+            with self.recorder.stage("save_debug_satellite"):
+                if os.path.exists(save_path):
+                    shutil.rmtree(save_path)
+                ds.to_zarr(save_path)
+
+        return ds
+
+    def load_prepared_frames(self, ds: xr.Dataset) -> xr.Dataset:
+        """Load the prepared frames of the satellite data from the cache
+
+        Only the frames which have not been prepared in a previous run are read and prepared. The
+        frames are memory-mapped from the cache, so they are only read when they are used.
+
+        Args:
+            ds: The lazily loaded satellite data, cropped and with dims (variable, time, y, x)
+
+        Returns:
+            xr.Dataset: The satellite data with the prepared frames
+        """
+        frame_cache = self.frame_5_cache if self.use_5_minute else self.frame_15_cache
+        frame_cache.validate(get_frame_key(ds))
+
+        required_timestamps = pd.DatetimeIndex(ds.time.values)
+        new_timestamps = required_timestamps[~required_timestamps.isin(frame_cache.timestamps)]
+
+        with self.recorder.stage("load_satellite") as stage:
+            ds_new = ds.sel(time=new_timestamps).compute()
+            stage.add(frames=len(new_timestamps))
+
+        with self.recorder.stage("prepare_frames") as stage:
+            X_new = prepare_frames(ds_new)
+            for i, t in enumerate(new_timestamps):
+                frame_cache.put(t, X_new[:, i])
+            stage.add(frames=len(new_timestamps))
+
+        frames = frame_cache.load(required_timestamps)
+        data = dask.array.stack([dask.array.from_array(f, chunks=f.shape) for f in frames], axis=1)
+
+        return ds.assign(data=ds.data.copy(data=data))
+
+    def download_sat_data(
+        self,
+        ds_remote: xr.Dataset | None,
+        t0: pd.Timestamp,
+        timestamps: pd.DatetimeIndex,
+    ) -> xr.Dataset:
+        """Sync the chosen satellite data into the local cache and evict frames which are too old
+
+        Args:
+            ds_remote: The lazily opened remote data of the chosen source, or None if it does not
+                exist
+            t0: The earliest init-time of the forecasts
+            timestamps: The timestamps to sync. Only those not already cached are fetched
+
+        Returns:
+            xr.Dataset: The lazily opened cached data of the chosen source
+        """
+        if self.use_5_minute:
+            remote_path, cache, label = self.sat_5_remote_path, self.sat_5_cache, "5-min"
+        else:
+            remote_path, cache, label = self.sat_15_remote_path, self.sat_15_cache, "15-min"
+
+        if ds_remote is not None:
+            logger.info(f"Syncing {label} satellite data")
+            with self.recorder.stage("sync_satellite", source=label) as stage:
+                new_times = cache.sync(remote_path, t0, timestamps=timestamps, ds_remote=ds_remote)
+                stage.add(frames=len(new_times))
+        else:
+            logger.info(f"No {label} data available to download")
+
+        for cache_to_evict in [
+            self.sat_5_cache, self.sat_15_cache, self.frame_5_cache, self.frame_15_cache,
+        ]:
+            cache_to_evict.evict(t0)
+
+        return cache.open()
+
+    def open_remote_sat_data(self) -> list[xr.Dataset | None]:
+        """Lazily open the remote 5 and 15-minutely satellite data concurrently
+
+        Only the metadata and coordinates are read.
+
+        Returns:
+            list: The 5 and 15-minutely data. Each is None if it is not configured or does not exist
+        """
+
+        def open_remote(remote_path: str | None) -> xr.Dataset | None:
+            return open_sat_zarr(remote_path) if remote_sat_exists(remote_path) else None
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            return list(
+                executor.map(open_remote, [self.sat_5_remote_path, self.sat_15_remote_path]),
+            )
+
+    def combine_5_and_15_sat_data(self) -> tuple[xr.Dataset | None, pd.DatetimeIndex]:
+        """Select between the 5 and 15-minutely satellite data using only their timestamps
+
+        The timestamps are read from the remote data, along with the timestamps already held in
+        the local cache unless the data is read directly. No data is downloaded here.
+
+        Returns:
+            tuple: The lazily opened remote data of the selected source, which is None if it does
+                not exist, and the timestamps available from the source
+        """
+        ds_5_remote, ds_15_remote = self.open_remote_sat_data()
+
         # Check which satellite data exists
-        exists_5_minute = os.path.exists(sat_5_path)
-        exists_15_minute = os.path.exists(sat_15_path)
+        datetimes_5min, datetimes_15min = [
+            pd.DatetimeIndex([]) if ds_remote is None else pd.DatetimeIndex(ds_remote.time.values)
+            for ds_remote in [ds_5_remote, ds_15_remote]
+        ]
+
+        if not self.direct_read:
+            datetimes_5min = datetimes_5min.union(self.sat_5_cache.timestamps)
+            datetimes_15min = datetimes_15min.union(self.sat_15_cache.timestamps)
+
+        exists_5_minute = len(datetimes_5min) > 0
+        exists_15_minute = len(datetimes_15min) > 0
 
         if not (exists_5_minute or exists_15_minute):
             raise FileNotFoundError("Neither 5- nor 15-minutely data was found.")
 
         # Find the delay in the 5- and 15-minutely data
         if exists_5_minute:
-            datetimes_5min = get_satellite_timestamps(sat_5_path)
             logger.info(
                 f"Latest 5-minute timestamp is {datetimes_5min.max()}. "
                 f"All the datetimes are: \n{datetimes_5min}",
             )
 
         if exists_15_minute:
-            datetimes_15min = get_satellite_timestamps(sat_15_path)
             logger.info(
-                f"Latest 5-minute timestamp is {datetimes_15min.max()}. "
+                f"Latest 15-minute timestamp is {datetimes_15min.max()}. "
                 f"All the datetimes are: \n{datetimes_15min}",
             )
 
@@ -179,26 +487,20 @@ class SatelliteDownloader:
         # Store the choice in satellite data
         self.use_5_minute = use_5_minute
 
-        # Move the selected data to the expected path
         if use_5_minute:
             logger.info("Using 5-minutely data.")
-            selected_path = sat_5_path
+            return ds_5_remote, datetimes_5min
         else:
             logger.info("Using 15-minutely data.")
-            selected_path = sat_15_path
-
-        # Open and return the satellite data
-        with zarr.storage.ZipStore(selected_path) as store:
-            ds = xr.open_zarr(store).compute()
-
-        return ds
+            return ds_15_remote, datetimes_15min
 
     @staticmethod
-    def check_required_timestamps_available(ds: xr.Dataset, t0: pd.Timestamp) -> None:
-        available_timestamps =  pd.to_datetime(ds.time.values)
-
+    def check_required_timestamps_available(
+        available_timestamps: pd.DatetimeIndex,
+        t0: pd.Timestamp,
+    ) -> None:
         # Need 12 timestamps of 15 minutely data up to and including time t0
-        expected_timestamps = pd.date_range(t0-pd.Timedelta("165min"), t0, freq="15min")
+        expected_timestamps = get_required_timestamps(t0)
 
         timestamps_available = np.isin(expected_timestamps, available_timestamps)
 
@@ -0,0 +1,492 @@
+"""Compiled and reduced precision inference backends for the cloudcasting model
+
+The eager model can be exported to TorchScript or to ONNX Runtime. The exported artifacts are
+cached alongside the model revision, and are checked against the eager model when they are first
+created. ONNX Runtime is an optional dependency which must be installed separately.
+
+The model can also be run in reduced precision. Since the forecasts are published, a reduced
+precision model is only used if its outputs on a reference input are close to the fp32 outputs.
+The int8 convolutions only store their weights in int8 to save memory, and are still computed in
+fp32.
+
+Running this module benchmarks the forward pass of each backend available:
+
+    python -m cloudcasting_inference.engine
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections.abc import Callable
+
+import numpy as np
+import torch
+from loguru import logger
+
+from cloudcasting_inference.data import channel_order, x_size, y_size
+
+BACKENDS = ("eager", "torchscript", "onnx")
+
+# The maximum absolute difference allowed between the outputs of the compiled and eager models
+EQUIVALENCE_TOLERANCE = 1e-4
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+# The maximum MAE allowed between the outputs of the reduced precision and fp32 models
+PRECISION_MAX_MAE = 5e-3
+
+
+def configure_threads() -> None:
+    """Set the torch thread pool sizes from the environment
+
+    Uses the environmental variables INFERENCE_INTRAOP_THREADS and INFERENCE_INTEROP_THREADS if
+    they are set. Otherwise the torch defaults are used.
+    """
+    intraop_threads = os.getenv("INFERENCE_INTRAOP_THREADS")
+    interop_threads = os.getenv("INFERENCE_INTEROP_THREADS")
+
+    if intraop_threads is not None:
+        torch.set_num_threads(int(intraop_threads))
+
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(int(interop_threads))
+        except RuntimeError:
+            # This can only be set once, before any inter-op parallel work has started
+            logger.warning("Could not set the number of inter-op threads as they are in use")
+
+    logger.info(
+        f"Using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} "
+        "inter-op threads",
+    )
+
+
+def _model_device(model: torch.nn.Module) -> torch.device:
+    """Get the device of the model, which is the CPU if all its weights are quantised"""
+    return next(model.parameters(), torch.empty(0)).device
+
+
+def get_example_input(batch_size: int = 1) -> torch.Tensor:
+    """Get a reproducible random model input of the shape used in production
+
+    Args:
+        batch_size: The size of the batch dimension
+
+    Returns:
+        torch.Tensor: The input with dims (batch, variable, time, y, x)
+    """
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand((batch_size, len(channel_order), 12, y_size, x_size), generator=generator)
+
+
+class OnnxModel:
+    """Callable wrapper around an ONNX Runtime session which takes and returns torch tensors"""
+
+    def __init__(self, path: str):
+        """Callable wrapper around an ONNX Runtime session
+
+        Args:
+            path: The path of the exported ONNX model
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if (intraop_threads := os.getenv("INFERENCE_INTRAOP_THREADS")) is not None:
+            options.intra_op_num_threads = int(intraop_threads)
+        if (interop_threads := os.getenv("INFERENCE_INTEROP_THREADS")) is not None:
+            options.inter_op_num_threads = int(interop_threads)
+
+        self.session = onnxruntime.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"],
+        )
+
+    def __call__(self, X: torch.Tensor) -> torch.Tensor:
+        (y_hat,) = self.session.run(None, {"X": X.cpu().numpy()})
+        return torch.from_numpy(y_hat)
+
+
+class AutocastModel(torch.nn.Module):
+    """Runs the wrapped model under bfloat16 autocast and returns float32 outputs"""
+
+    def __init__(self, model: torch.nn.Module):
+        """Runs the wrapped model under bfloat16 autocast and returns float32 outputs
+
+        Args:
+            model: The fp32 model to wrap
+        """
+        super().__init__()
+        self.model = model
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        device_type = _model_device(self.model).type
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            return self.model(X).float()
+
+
+def get_reference_input() -> torch.Tensor:
+    """Get the reference input used to check the accuracy of reduced precision models
+
+    This is loaded from the numpy file at the environmental variable INFERENCE_REFERENCE_INPUT,
+    e.g. inputs saved from a previous run. This should have dims (variable, time, y, x). A random
+    input is not used since it does not exercise the model like real satellite data.
+
+    Returns:
+        torch.Tensor: The input with dims (batch, variable, time, y, x)
+    """
+    reference_input_path = os.getenv("INFERENCE_REFERENCE_INPUT")
+    if reference_input_path is None:
+        raise ValueError(
+            "INFERENCE_REFERENCE_INPUT must be set to check the accuracy of the reduced precision "
+            "model",
+        )
+    return torch.from_numpy(np.load(reference_input_path).astype(np.float32))[None]
+
+
+class Int8WeightConv(torch.nn.Module):
+    """A convolution whose weights are stored in int8 and dequantised in the forward pass
+
+    The weights are quantised symmetrically with a scale for each output channel. This reduces the
+    memory of the weights by 4x, but the convolution itself is still computed in fp32.
+    """
+
+    def __init__(self, conv: torch.nn.Conv1d | torch.nn.Conv2d | torch.nn.Conv3d):
+        """A convolution whose weights are stored in int8 and dequantised in the forward pass
+
+        Args:
+            conv: The fp32 convolution. Its weights are removed
+        """
+        super().__init__()
+        weight = conv.weight.detach()
+        scale = weight.abs().amax(dim=tuple(range(1, weight.ndim)), keepdim=True) / 127
+        scale = torch.where(scale == 0, torch.ones_like(scale), scale)
+
+        self.register_buffer("weight_int8", torch.round(weight / scale).to(torch.int8))
+        self.register_buffer("scale", scale.float())
+
+        # The convolution is kept for its bias and settings, but not its fp32 weights
+        conv.weight = None
+        self.conv = conv
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        weight = self.weight_int8.to(X.dtype) * self.scale.to(X.dtype)
+        return self.conv._conv_forward(X, weight, self.conv.bias)
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Quantise the weights of the model to int8 in place
+
+    The convolutions get int8 weights which are dequantised in the forward pass, and the linear
+    and recurrent layers are dynamically quantised.
+
+    Args:
+        model: The fp32 model on the CPU
+
+    Returns:
+        torch.nn.Module: The quantised model
+    """
+    num_conv = 0
+    for name, module in list(model.named_modules()):
+        if name and type(module) in (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d):
+            parent_name, _, attr = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), attr, Int8WeightConv(module))
+            num_conv += 1
+
+    model = torch.ao.quantization.quantize_dynamic(
+        model,
+        {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU},
+        dtype=torch.qint8,
+        inplace=True,
+    )
+    num_dynamic = sum(
+        type(m).__module__.startswith("torch.ao.nn.quantized.dynamic") for m in model.modules()
+    )
+
+    if num_conv + num_dynamic == 0:
+        raise ValueError("The model has no layers which can be quantised to int8")
+
+    logger.info(f"Quantised {num_conv} convolutions and {num_dynamic} other layers to int8")
+    return model
+
+
+def check_accuracy(
+    y_fp32: np.ndarray,
+    low_precision_model: torch.nn.Module,
+    X: torch.Tensor,
+    max_mae: float = PRECISION_MAX_MAE,
+) -> float:
+    """Check the reduced precision model makes close predictions to the fp32 model
+
+    Args:
+        y_fp32: The output of the fp32 model on the reference input
+        low_precision_model: The reduced precision model
+        X: The reference input
+        max_mae: The maximum MAE allowed between the model outputs
+
+    Returns:
+        float: The MAE between the model outputs on the reference input
+    """
+    with torch.no_grad():
+        y_low_precision = low_precision_model(X).float().cpu().numpy()
+
+    mae = float(np.abs(y_fp32 - y_low_precision).mean())
+
+    if not mae <= max_mae:
+        raise ValueError(
+            f"The reduced precision model has an MAE of {mae} from the fp32 model on the "
+            f"reference input, which is more than the maximum of {max_mae}",
+        )
+
+    return mae
+
+
+def _read_accuracy_gate(path: str, key: str) -> float | None:
+    """Read the MAE of a reduced precision model which previously passed the accuracy gate"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f).get(key)
+
+
+def _write_accuracy_gate(path: str, key: str, mae: float) -> None:
+    """Record the MAE of a reduced precision model which passed the accuracy gate"""
+    results = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            results = json.load(f)
+    results[key] = mae
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(results, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def set_precision(
+    model: torch.nn.Module,
+    precision: str,
+    max_mae: float = PRECISION_MAX_MAE,
+    cache_dir: str | None = None,
+) -> torch.nn.Module:
+    """Get the model in the given precision, checking its accuracy against the fp32 model
+
+    Args:
+        model: The fp32 model in eval mode. For "int8" this is quantised in place
+        precision: One of "fp32", "bf16" or "int8". "int8" stores the weights of the convolutions
+            in int8, which only saves memory as they are still computed in fp32, and dynamically
+            quantises the linear and recurrent layers. It is only supported on CPU
+        max_mae: The maximum MAE allowed between the outputs of the reduced precision and fp32
+            models on the reference input
+        cache_dir: If given, the result of the accuracy check is cached in this directory, which
+            should be specific to the model revision. The check is then only run again if the
+            reference input or the torch version change
+
+    Returns:
+        torch.nn.Module: The model in the given precision
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}. Must be one of {PRECISIONS}")
+
+    if precision == "fp32":
+        return model
+
+    if precision == "int8" and _model_device(model).type != "cpu":
+        raise ValueError("int8 precision is only supported on CPU")
+
+    X = get_reference_input().to(_model_device(model))
+    key = "_".join(
+        [
+            precision,
+            f"torch-{torch.__version__}",
+            _model_device(model).type,
+            hashlib.sha256(X.cpu().numpy().tobytes()).hexdigest(),
+        ],
+    )
+    gate_path = None if cache_dir is None else f"{cache_dir}/accuracy_gate.json"
+    mae = None if gate_path is None else _read_accuracy_gate(gate_path, key)
+
+    # The fp32 output is needed before the model is quantised in place
+    y_fp32 = None
+    if mae is None:
+        with torch.no_grad():
+            y_fp32 = model(X).cpu().numpy()
+
+    if precision == "bf16":
+        low_precision_model = AutocastModel(model)
+    else:
+        low_precision_model = quantize_int8(model)
+
+    if mae is None:
+        mae = check_accuracy(y_fp32, low_precision_model, X, max_mae)
+        if gate_path is not None:
+            _write_accuracy_gate(gate_path, key, mae)
+    elif not mae <= max_mae:
+        raise ValueError(
+            f"The reduced precision model has an MAE of {mae} from the fp32 model on the "
+            f"reference input, which is more than the maximum of {max_mae}",
+        )
+    else:
+        logger.info(f"Using the cached accuracy check of the {precision} model")
+
+    logger.info(f"Using {precision} model with an MAE of {mae} from the fp32 model")
+
+    return low_precision_model.eval()
+
+
+def _export(model: torch.nn.Module, backend: str, path: str) -> None:
+    """Export the model to the backend format and save it to path"""
+    example_input = get_example_input().to(_model_device(model))
+
+    # Write to a temporary path and move it into place so an interrupted export is not cached
+    tmp_path = f"{path}.tmp"
+
+    with torch.no_grad():
+        if backend == "torchscript":
+            compiled = torch.jit.freeze(torch.jit.trace(model, example_input))
+            torch.jit.save(compiled, tmp_path)
+        elif backend == "onnx":
+            torch.onnx.export(
+                model,
+                (example_input,),
+                tmp_path,
+                input_names=["X"],
+                output_names=["y_hat"],
+                dynamic_axes={"X": {0: "batch"}, "y_hat": {0: "batch"}},
+            )
+
+    os.replace(tmp_path, path)
+
+
+def _load(backend: str, path: str, device: torch.device) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Load an exported model"""
+    if backend == "torchscript":
+        return torch.jit.load(path, map_location=device)
+    return OnnxModel(path)
+
+
+def check_equivalence(
+    model: torch.nn.Module,
+    compiled: Callable[[torch.Tensor], torch.Tensor],
+    tolerance: float = EQUIVALENCE_TOLERANCE,
+) -> float:
+    """Check that the compiled model makes the same predictions as the eager model
+
+    A batch of two is used so that an export which has baked in the batch size is caught.
+
+    Args:
+        model: The eager model
+        compiled: The compiled model
+        tolerance: The maximum absolute difference allowed between the model outputs
+
+    Returns:
+        float: The maximum absolute difference between the model outputs
+    """
+    X = get_example_input(batch_size=2).to(_model_device(model))
+
+    with torch.no_grad():
+        y_eager = model(X).cpu().numpy()
+        y_compiled = compiled(X).cpu().numpy()
+
+    max_diff = float(np.abs(y_eager - y_compiled).max())
+
+    if not max_diff <= tolerance:
+        raise ValueError(
+            f"Compiled model outputs differ from the eager model by {max_diff}, which is more "
+            f"than the tolerance of {tolerance}",
+        )
+
+    return max_diff
+
+
+def compile_model(
+    model: torch.nn.Module,
+    backend: str,
+    cache_dir: str,
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Get the model compiled with the given backend
+
+    The compiled model is loaded from the cache if it exists. Otherwise the model is exported,
+    checked against the eager model and cached. If the export or check fails, the eager model is
+    returned.
+
+    Args:
+        model: The eager model in eval mode
+        backend: One of "eager", "torchscript" or "onnx"
+        cache_dir: The directory to cache the compiled model in
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}. Must be one of {BACKENDS}")
+
+    if backend == "eager":
+        return model
+
+    if backend == "onnx":
+        # Raise an ImportError early if the optional dependency is not installed
+        import onnxruntime  # noqa: F401
+
+    device = _model_device(model)
+    extension = "pt" if backend == "torchscript" else "onnx"
+    path = f"{cache_dir}/model_{backend}_torch-{torch.__version__}_{device.type}.{extension}"
+
+    if os.path.exists(path):
+        logger.info(f"Loading cached {backend} model from {path}")
+        return _load(backend, path, device)
+
+    logger.info(f"Exporting model to {backend}")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    try:
+        _export(model, backend, path)
+        compiled = _load(backend, path, device)
+        max_diff = check_equivalence(model, compiled)
+    except Exception:
+        logger.exception(f"Failed to compile model with {backend}, falling back to eager model")
+        if os.path.exists(path):
+            os.remove(path)
+        return model
+
+    logger.info(f"Cached {backend} model at {path}. Max difference from eager model: {max_diff}")
+    return compiled
+
+
+def benchmark(
+    model: Callable[[torch.Tensor], torch.Tensor],
+    batch_size: int = 1,
+    n_repeats: int = 5,
+) -> float:
+    """Time the forward pass of the model
+
+    Args:
+        model: The model to benchmark
+        batch_size: The batch size to use
+        n_repeats: The number of timed forward passes, run after one warm-up pass
+
+    Returns:
+        float: The median time in seconds of a forward pass
+    """
+    X = get_example_input(batch_size)
+
+    times = []
+    with torch.no_grad():
+        for i in range(n_repeats + 1):
+            start = time.perf_counter()
+            model(X)
+            if i > 0:
+                times.append(time.perf_counter() - start)
+
+    return float(np.median(times))
+
+
+if __name__ == "__main__":
+    from cloudcasting_inference.model import get_model
+
+    for backend in BACKENDS:
+        try:
+            model = get_model(backend=backend)
+        except ImportError:
+            logger.warning(f"Skipping {backend} backend as its dependencies are not installed")
+            continue
+        logger.info(
+            f"{backend} forward pass takes {benchmark(model):.3f}s",
+            backend=backend,
+        )
@@ -0,0 +1,178 @@
+"""Hindcasts for historical init-times made from the long-term icechunk archive of satellite data
+
+This regenerates the forecasts over a historical period, e.g. for a new model revision. The
+init-times are processed in chunks. The satellite inputs of each chunk are read lazily from the
+archive, and the inputs of the next chunk are read while the model runs on the current chunk.
+The forecasts are saved in the same layout as the live forecasts, but the latest path is not
+updated.
+
+This uses the same environmental variables as the app, except that the satellite data is read from:
+    SATELLITE_ICECHUNK_ARCHIVE (str): The path of the icechunk archive of satellite data
+
+Optionally:
+    INFERENCE_HINDCAST_CHUNK_SIZE (int): The number of init-times whose inputs are loaded together.
+        Defaults to 8
+    INFERENCE_HINDCAST_OVERWRITE (bool): If "true", forecasts which have already been saved are
+        made again. Otherwise they are skipped, so an interrupted hindcast can be resumed
+"""
+
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+import numpy as np
+import pandas as pd
+import torch
+import xarray as xr
+from loguru import logger
+
+from cloudcasting_inference.app import (
+    get_domain_tile_grid,
+    get_forecast_paths,
+    make_predictions,
+    save_forecast,
+)
+from cloudcasting_inference.archive import open_icechunk
+from cloudcasting_inference.daemon import FORECAST_FREQ
+from cloudcasting_inference.data import (
+    channel_order,
+    crop_input_area,
+    get_batched_input_data,
+    get_required_timestamps,
+    parse_domain,
+)
+from cloudcasting_inference.instrumentation import StageRecorder
+from cloudcasting_inference.model import get_model
+
+
+def load_hindcast_inputs(
+    ds_sat: xr.Dataset,
+    init_times: pd.DatetimeIndex,
+    domain: tuple[float, float, float, float] | None = None,
+) -> xr.Dataset:
+    """Load the satellite inputs of a chunk of init-times from the lazily opened archive
+
+    Args:
+        ds_sat: The lazily opened satellite archive
+        init_times: The init-times to load the inputs of
+        domain: The domain to crop to for tiled inference. If None, the fixed UK area is used
+
+    Returns:
+        xr.Dataset: The loaded satellite data with dims (variable, time, y, x)
+    """
+    required_timestamps = pd.DatetimeIndex(
+        np.unique(np.concatenate([get_required_timestamps(t) for t in init_times])),
+    )
+
+    ds = ds_sat.sel(time=required_timestamps)
+    ds = crop_input_area(ds, domain)
+    ds = ds.sel(variable=channel_order)
+    ds = ds.transpose("variable", "time", "y_geostationary", "x_geostationary")
+
+    return ds.compute()
+
+
+def hindcast(
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    model: Callable[[torch.Tensor], torch.Tensor] | None = None,
+    batch_size: int | None = None,
+    use_5_minute: bool = True,
+) -> None:
+    """Make and save the forecasts for all the init-times in a historical period
+
+    Init-times whose inputs are not all in the archive are skipped.
+
+    Args:
+        start: The first init-time (inclusive)
+        end: The last init-time (inclusive)
+        model: A preloaded model to use. If None, the model is loaded from huggingface
+        batch_size: The number of init-times, or tiles if tiling, to run through the model at once.
+            Defaults to the environmental variable INFERENCE_BATCH_SIZE, or 4 if that is not set.
+        use_5_minute: Whether the archive holds the 5-minutely satellite data. This decides the
+            paths the forecasts are saved to, as in the live app
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("INFERENCE_BATCH_SIZE", "4"))
+
+    chunk_size = int(os.getenv("INFERENCE_HINDCAST_CHUNK_SIZE", "8"))
+    overwrite = os.getenv("INFERENCE_HINDCAST_OVERWRITE", "false").lower() == "true"
+    domain = parse_domain(os.getenv("INFERENCE_DOMAIN"))
+
+    # Measure the time, memory and I/O of each stage
+    recorder = StageRecorder(summary_path=os.getenv("INFERENCE_SUMMARY_PATH"))
+
+    init_times = pd.date_range(
+        pd.Timestamp(start).ceil(FORECAST_FREQ),
+        pd.Timestamp(end).floor(FORECAST_FREQ),
+        freq=FORECAST_FREQ,
+    )
+
+    # Only the metadata of the archive is read here
+    ds_sat = open_icechunk(os.environ["SATELLITE_ICECHUNK_ARCHIVE"])
+    available_timestamps = pd.DatetimeIndex(ds_sat.time.values)
+
+    complete = np.array(
+        [get_required_timestamps(t).isin(available_timestamps).all() for t in init_times],
+        dtype=bool,
+    )
+    if (~complete).any():
+        logger.warning(f"Skipping {(~complete).sum()} init-times due to missing satellite data")
+    init_times = init_times[complete]
+
+    if not overwrite:
+        fs = fsspec.open(os.environ["PREDICTION_SAVE_DIRECTORY"]).fs
+        saved = np.array(
+            [fs.exists(get_forecast_paths(t, use_5_minute)[0]) for t in init_times], dtype=bool,
+        )
+        if saved.any():
+            logger.info(f"Skipping {saved.sum()} init-times which have already been forecast")
+        init_times = init_times[~saved]
+
+    if len(init_times) == 0:
+        logger.info("There are no hindcasts to make")
+        return
+
+    logger.info(f"Making hindcasts for {len(init_times)} init-times from {init_times[0]}")
+
+    if model is None:
+        with recorder.stage("load_model"):
+            model = get_model()
+
+    chunks = [init_times[i:i + chunk_size] for i in range(0, len(init_times), chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_inputs = executor.submit(load_hindcast_inputs, ds_sat, chunks[0], domain)
+
+        for i, chunk in enumerate(chunks):
+            # This only measures the time spent waiting for the inputs loaded in the background
+            with recorder.stage("load_satellite", chunk=str(chunk[0])) as stage:
+                ds = next_inputs.result()
+                stage.add(frames=len(ds.time))
+
+            # Load the inputs of the next chunk while the model runs on this chunk
+            if i + 1 < len(chunks):
+                next_inputs = executor.submit(load_hindcast_inputs, ds_sat, chunks[i + 1], domain)
+
+            with recorder.stage("prepare_inputs"):
+                X = get_batched_input_data(ds, chunk)
+
+            with recorder.stage("predict") as stage:
+                tile_grid = None if domain is None else get_domain_tile_grid(ds)
+                y_hat = make_predictions(model, X, batch_size, tile_grid)
+                stage.add(forecasts=len(chunk))
+
+            with recorder.stage("save") as stage:
+                for j, init_time in enumerate(chunk):
+                    save_forecast(y_hat[j], init_time, ds, use_5_minute, update_latest=False)
+                stage.add(forecasts=len(chunk))
+
+            logger.info(f"Saved hindcasts for init-times {chunk[0]} to {chunk[-1]}")
+
+    logger.info(
+        f"Hindcasts for {len(init_times)} init-times from {init_times[0]} to {init_times[-1]} "
+        "complete",
+        **recorder.timings,
+    )
+    recorder.write_summary()
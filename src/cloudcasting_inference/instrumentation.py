@@ -0,0 +1,184 @@
+"""Lightweight instrumentation of the stages of the apps
+
+Each stage records its wall time, the peak resident memory of the process during the stage, the
+bytes read and written by the process, and any counts the stage reports, e.g. the number of
+frames processed. The measurements are logged as structured fields as each stage ends, and can
+also be written to a JSON summary file.
+
+The memory and I/O figures are read from /proc on Linux. The bytes read and written include
+network reads and writes, e.g. to object stores. On other platforms the peak memory is the peak
+over the life of the process, and the bytes read and written are not recorded.
+"""
+
+import json
+import resource
+import sys
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import fsspec
+from loguru import logger
+
+
+def _read_io_bytes() -> tuple[int, int] | None:
+    """Get the total bytes read and written by the process, or None if they are not available"""
+    try:
+        with open("/proc/self/io", encoding="utf-8") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(counters["rchar"]), int(counters["wchar"])
+
+
+def _reset_peak_rss() -> None:
+    """Reset the peak resident memory of the process to its current value, where supported"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _read_peak_rss() -> int:
+    """Get the peak resident memory of the process in bytes since it was last reset"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # This is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _to_mb(num_bytes: int | None) -> float | None:
+    return None if num_bytes is None else round(num_bytes / 2**20, 1)
+
+
+class Stage:
+    """The measurements of a single stage"""
+
+    def __init__(self, name: str, **fields: str):
+        """The measurements of a single stage
+
+        Args:
+            name: The name of the stage
+            **fields: Extra fields to label the stage with, e.g. the day being processed
+        """
+        self.name = name
+        self.fields = fields
+        self.seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.bytes_read: int | None = None
+        self.bytes_written: int | None = None
+        self.counts: dict[str, int] = {}
+
+    def add(self, **counts: int) -> None:
+        """Add to the counts of things processed in the stage, e.g. `stage.add(frames=12)`"""
+        for key, count in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + int(count)
+
+    def to_dict(self) -> dict:
+        """Get the measurements as a flat dictionary"""
+        return {
+            "stage": self.name,
+            **self.fields,
+            "seconds": round(self.seconds, 3),
+            "peak_rss_mb": _to_mb(self.peak_rss_bytes),
+            "read_mb": _to_mb(self.bytes_read),
+            "written_mb": _to_mb(self.bytes_written),
+            **self.counts,
+        }
+
+
+class StageRecorder:
+    """Records the measurements of the stages of a run
+
+    Stages may be nested, in which case the measurements of the outer stage include the inner.
+    """
+
+    def __init__(self, summary_path: str | None = None):
+        """Records the measurements of the stages of a run
+
+        Args:
+            summary_path: If not None, the summary of the stages is written to this local or
+                remote path as JSON by `write_summary()`
+        """
+        self.summary_path = summary_path
+        self.stages: list[Stage] = []
+        self._active: list[Stage] = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, **fields: str) -> Iterator[Stage]:
+        """Measure a stage of the run
+
+        Args:
+            name: The name of the stage
+            **fields: Extra fields to label the stage with, e.g. the day being processed
+
+        Yields:
+            Stage: The stage, which the counts of things processed can be added to
+        """
+        stage = Stage(name, **fields)
+
+        # The peak memory is reset for each stage, so record the peak of the outer stage so far
+        if self._active:
+            parent = self._active[-1]
+            parent.peak_rss_bytes = max(parent.peak_rss_bytes, _read_peak_rss())
+
+        self._active.append(stage)
+        io_start = _read_io_bytes()
+        _reset_peak_rss()
+        start = time.perf_counter()
+
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - start
+            stage.peak_rss_bytes = max(stage.peak_rss_bytes, _read_peak_rss())
+
+            io_end = _read_io_bytes()
+            if io_start is not None and io_end is not None:
+                stage.bytes_read = io_end[0] - io_start[0]
+                stage.bytes_written = io_end[1] - io_start[1]
+
+            self._active.pop()
+            if self._active:
+                parent = self._active[-1]
+                parent.peak_rss_bytes = max(parent.peak_rss_bytes, stage.peak_rss_bytes)
+
+            self.stages.append(stage)
+            logger.info(f"Stage {name} took {stage.seconds:.1f}s", **stage.to_dict())
+
+    @property
+    def timings(self) -> dict[str, float]:
+        """The wall time of each stage in seconds, keyed as "<stage>_seconds"
+
+        The times of stages with the same name are summed.
+        """
+        timings: dict[str, float] = {}
+        for stage in self.stages:
+            key = f"{stage.name}_seconds"
+            timings[key] = round(timings.get(key, 0) + stage.seconds, 3)
+        return timings
+
+    def summary(self) -> dict:
+        """Get the summary of the stages, in the order they finished"""
+        return {
+            "total_seconds": round(time.perf_counter() - self._start, 3),
+            "peak_rss_mb": _to_mb(max([s.peak_rss_bytes for s in self.stages], default=0)),
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
+
+    def write_summary(self) -> None:
+        """Write the summary of the stages to the summary path, if it is set"""
+        if self.summary_path is None:
+            return
+
+        with fsspec.open(self.summary_path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
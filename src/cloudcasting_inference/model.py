@@ -0,0 +1,155 @@
+"""Loading of the cloudcasting model from huggingface
+
+The files of the pinned model revision are kept in a local content-addressed cache (see
+cloudcasting_inference.cache.ModelCache), so the hub is only contacted the first time the revision
+is used.
+"""
+
+import itertools
+import os
+from collections.abc import Callable
+
+import hydra
+import torch
+import yaml
+from huggingface_hub import snapshot_download
+from loguru import logger
+from safetensors.torch import load_file
+
+from cloudcasting_inference.cache import ModelCache
+from cloudcasting_inference.engine import (
+    PRECISION_MAX_MAE,
+    compile_model,
+    configure_threads,
+    set_precision,
+)
+
+# Model will use GPU if available
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Model revision on huggingface
+REPO_ID = "openclimatefix/cloudcasting_uk"
+REVISION = "47643e89000e64e0150f7359ccc0cb6524948712"
+
+# The files of the model revision which are used
+MODEL_CONFIG_FILE = "model_config.yaml"
+MODEL_WEIGHTS_FILE = "model.safetensors"
+
+model_cache_dir = "model_cache"
+
+
+def get_model_files(offline: bool | None = None) -> dict[str, str]:
+    """Get the local paths of the files of the pinned model revision
+
+    The files are taken from the local model cache if they are there. Otherwise they are
+    downloaded from huggingface and added to the cache.
+
+    Args:
+        offline: If True, the hub is never contacted, and the files must already be in the model
+            cache or the huggingface cache. Defaults to the environmental variable
+            INFERENCE_MODEL_OFFLINE, or False if that is not set.
+
+    Returns:
+        dict: The paths of the model config and weights keyed by their file names
+    """
+    if offline is None:
+        offline = os.getenv("INFERENCE_MODEL_OFFLINE", "false").lower() == "true"
+
+    cache = ModelCache(os.getenv("INFERENCE_MODEL_CACHE_DIR", model_cache_dir))
+    verify = os.getenv("INFERENCE_MODEL_VERIFY", "true").lower() == "true"
+
+    paths = cache.get(REPO_ID, REVISION, verify=verify)
+
+    if paths is None:
+        logger.info(f"Model revision {REVISION} is not cached, fetching it from {REPO_ID}")
+        hf_download_dir = snapshot_download(
+            repo_id=REPO_ID,
+            revision=REVISION,
+            allow_patterns=[MODEL_CONFIG_FILE, MODEL_WEIGHTS_FILE],
+            local_files_only=offline,
+        )
+        paths = cache.put(
+            REPO_ID,
+            REVISION,
+            {name: f"{hf_download_dir}/{name}" for name in [MODEL_CONFIG_FILE, MODEL_WEIGHTS_FILE]},
+        )
+
+    return paths
+
+
+def load_model(config_path: str, weights_path: str) -> torch.nn.Module:
+    """Instantiate the model and load its weights from memory-mapped safetensors
+
+    The model is instantiated on the meta device so no memory is allocated for its initial weights,
+    and the memory-mapped weights are assigned to it without being copied.
+
+    Args:
+        config_path: The path to the hydra config of the model
+        weights_path: The path to the safetensors weights of the model
+
+    Returns:
+        The model on the CPU
+    """
+    with open(config_path, encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+
+    with torch.device("meta"):
+        model = hydra.utils.instantiate(config)
+
+    # The weights are memory-mapped when they are loaded onto the CPU
+    state_dict = load_file(weights_path, device="cpu")
+    model.load_state_dict(state_dict, strict=True, assign=True)
+
+    # Tensors which are not saved in the weights, e.g. non-persistent buffers, are left on the meta
+    # device. These are only initialised if the model is instantiated on the CPU
+    if any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+        model = hydra.utils.instantiate(config)
+        model.load_state_dict(state_dict, strict=True, assign=True)
+
+    return model
+
+
+def get_model(
+    backend: str | None = None,
+    precision: str | None = None,
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Get the pinned model revision, load its weights and move it to the device
+
+    Args:
+        backend: The inference backend to use. One of "eager", "torchscript" or "onnx". Defaults
+            to the environmental variable INFERENCE_BACKEND, or "eager" if that is not set.
+        precision: The precision of the model. One of "fp32", "bf16" or "int8". Defaults to the
+            environmental variable INFERENCE_PRECISION, or "fp32" if that is not set. A reduced
+            precision model is only used if its MAE from the fp32 model on a reference input is
+            below INFERENCE_PRECISION_MAX_MAE. "int8" only reduces the memory of the convolution
+            weights, which are still computed in fp32.
+
+    Returns:
+        The model in eval mode
+    """
+    if backend is None:
+        backend = os.getenv("INFERENCE_BACKEND", "eager")
+
+    if precision is None:
+        precision = os.getenv("INFERENCE_PRECISION", "fp32")
+
+    configure_threads()
+
+    paths = get_model_files()
+
+    model = load_model(paths[MODEL_CONFIG_FILE], paths[MODEL_WEIGHTS_FILE]).to(device)
+
+    model.eval()
+
+    # The accuracy check and compiled model are cached alongside the model revision
+    cache = ModelCache(os.getenv("INFERENCE_MODEL_CACHE_DIR", model_cache_dir))
+    cache_dir = f"{cache.compiled_dir(REPO_ID, REVISION)}/{precision}"
+
+    model = set_precision(
+        model,
+        precision,
+        max_mae=float(os.getenv("INFERENCE_PRECISION_MAX_MAE", PRECISION_MAX_MAE)),
+        cache_dir=cache_dir,
+    )
+
+    return compile_model(model, backend, cache_dir=cache_dir)
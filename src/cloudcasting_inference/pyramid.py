@@ -0,0 +1,110 @@
+"""Coarsened pyramid levels of the forecasts for zoomed-out views
+
+Each level is the mean of the forecast over blocks of factor x factor pixels, and is saved as a
+group of the forecast store. The blocks at the ends of the y and x dims which are not full are
+averaged over the pixels they contain. The levels are computed from the block sums and pixel counts
+of the previous level, so the full resolution forecast is only reduced once.
+
+The levels are described by the `multiscales` attribute of the root of the forecast store.
+"""
+
+import numpy as np
+import xarray as xr
+
+
+def parse_pyramid_factors(factors: str | None) -> list[int]:
+    """Parse comma separated coarsening factors, e.g. "2,4,8", or return no factors if not given
+
+    Each factor must be a multiple of the one before it.
+    """
+    if not factors:
+        return []
+
+    parsed = [int(f) for f in factors.split(",")]
+    for previous, factor in zip([1, *parsed], parsed, strict=False):
+        if factor <= previous or factor % previous != 0:
+            raise ValueError(f"Each pyramid factor must be a multiple of the last, got {factors}")
+    return parsed
+
+
+def get_pyramid_group(factor: int) -> str:
+    """Get the group of the forecast store the pyramid level is saved in"""
+    return f"pyramid_{factor}"
+
+
+def get_multiscales_metadata(factors: list[int]) -> list[dict]:
+    """Get the metadata of the pyramid levels saved in the root attributes of the forecast store"""
+    return [
+        {
+            "name": "sat_pred",
+            "type": "mean",
+            "datasets": [
+                {"path": "", "factor": 1},
+                *[{"path": get_pyramid_group(f), "factor": f} for f in factors],
+            ],
+        },
+    ]
+
+
+def _block_sum(values: np.ndarray, factor: int, ndim: int = 2) -> np.ndarray:
+    """Sum over blocks of `factor` elements along each of the last `ndim` dims
+
+    The ends of the dims are padded with zeros to fill the last blocks.
+    """
+    lead_shape = values.shape[:values.ndim - ndim]
+    shape = values.shape[values.ndim - ndim:]
+    padded_shape = [n + (-n % factor) for n in shape]
+
+    padded = np.zeros((*lead_shape, *padded_shape), dtype=values.dtype)
+    padded[(..., *[slice(0, n) for n in shape])] = values
+
+    blocks = padded.reshape(*lead_shape, *[m for n in padded_shape for m in (n // factor, factor)])
+    return blocks.sum(axis=tuple(range(len(lead_shape) + 1, len(lead_shape) + 2 * ndim, 2)))
+
+
+def make_pyramid(ds_y_hat: xr.Dataset, factors: list[int]) -> dict[str, xr.Dataset]:
+    """Make the coarsened pyramid levels of a forecast
+
+    Args:
+        ds_y_hat: The forecast with dims (init_time, variable, step, y, x)
+        factors: The coarsening factor of each level. Each must be a multiple of the one before it
+
+    Returns:
+        dict: The forecast at each level keyed by the group it is saved in
+    """
+    sums = ds_y_hat.sat_pred.values.astype(np.float32)
+    counts = np.ones(sums.shape[-2:], dtype=np.float32)
+    coord_sums = {
+        dim: ds_y_hat[dim].values.astype(np.float64)
+        for dim in ["y_geostationary", "x_geostationary"]
+    }
+    coord_counts = {dim: np.ones(len(ds_y_hat[dim])) for dim in coord_sums}
+
+    levels = {}
+    previous_factor = 1
+
+    for factor in factors:
+        step = factor // previous_factor
+        sums = _block_sum(sums, step)
+        counts = _block_sum(counts, step)
+
+        coords = {}
+        for dim in coord_sums:
+            coord_sums[dim] = _block_sum(coord_sums[dim], step, ndim=1)
+            coord_counts[dim] = _block_sum(coord_counts[dim], step, ndim=1)
+            coords[dim] = coord_sums[dim] / coord_counts[dim]
+
+        ds_level = xr.Dataset(
+            {"sat_pred": (ds_y_hat.sat_pred.dims, sums / counts)},
+            coords={
+                **{dim: ds_y_hat[dim] for dim in ["init_time", "variable", "step"]},
+                **coords,
+            },
+        )
+        ds_level.sat_pred.attrs.update(ds_y_hat.sat_pred.attrs)
+        ds_level.attrs["coarsening_factor"] = factor
+
+        levels[get_pyramid_group(factor)] = ds_level
+        previous_factor = factor
+
+    return levels
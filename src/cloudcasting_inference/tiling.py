@@ -0,0 +1,158 @@
+"""Tiled inference over domains larger than the area the model was trained on
+
+The domain is split into overlapping tiles of the model input size. The tiles of all the
+init-times are run through the model as batches, and the predicted tiles are blended back into a
+single mosaic. In the overlaps, each tile is weighted by a ramp which falls towards its edges so
+that there are no seams between the tiles.
+"""
+
+from collections.abc import Callable
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+from cloudcasting_inference.data import x_size, y_size
+
+# The default number of pixels adjacent tiles overlap by
+TILE_OVERLAP = 64
+
+
+def get_tile_starts(length: int, tile_length: int, overlap: int) -> np.ndarray:
+    """Get the start indices of the fewest tiles covering an axis with at least the given overlap
+
+    The tiles are spread evenly so that the first and last tiles are flush with the ends of the
+    axis.
+
+    Args:
+        length: The length of the axis
+        tile_length: The length of each tile
+        overlap: The minimum number of pixels adjacent tiles overlap by
+
+    Returns:
+        np.ndarray: The start index of each tile
+    """
+    if length < tile_length:
+        raise ValueError(f"The domain length {length} is less than the tile length {tile_length}")
+    if not 0 <= overlap < tile_length:
+        raise ValueError(f"The overlap must be between 0 and {tile_length - 1}, not {overlap}")
+
+    num_tiles = 1 + int(np.ceil((length - tile_length) / (tile_length - overlap)))
+    return np.linspace(0, length - tile_length, num_tiles).round().astype(int)
+
+
+def get_blend_weights(tile_length: int, overlap: int) -> np.ndarray:
+    """Get the weights along one axis of a tile, which ramp up over the overlap from each edge"""
+    distance_to_edge = np.minimum(np.arange(tile_length), np.arange(tile_length)[::-1])
+    return np.clip((distance_to_edge + 1) / (overlap + 1), 0, 1).astype(np.float32)
+
+
+class TileGrid:
+    """The overlapping tiles which cover a domain, and the weights they are blended with"""
+
+    def __init__(
+        self,
+        shape: tuple[int, int],
+        tile_shape: tuple[int, int] = (y_size, x_size),
+        overlap: int = TILE_OVERLAP,
+    ):
+        """The overlapping tiles which cover a domain, and the weights they are blended with
+
+        Args:
+            shape: The (y, x) size of the domain in pixels
+            tile_shape: The (y, x) size of each tile in pixels
+            overlap: The minimum number of pixels adjacent tiles overlap by
+        """
+        self.shape = shape
+        self.tile_shape = tile_shape
+
+        y_starts = get_tile_starts(shape[0], tile_shape[0], overlap)
+        x_starts = get_tile_starts(shape[1], tile_shape[1], overlap)
+        self.starts = [(int(y0), int(x0)) for y0 in y_starts for x0 in x_starts]
+
+        # The (y, x) slices of the domain covered by each tile
+        self.tiles = [
+            (slice(y0, y0 + tile_shape[0]), slice(x0, x0 + tile_shape[1]))
+            for y0, x0 in self.starts
+        ]
+
+        # Weights with dims (y, x) applied to each predicted tile
+        self.weights = np.outer(
+            get_blend_weights(tile_shape[0], overlap), get_blend_weights(tile_shape[1], overlap),
+        )
+
+        # The sum of the weights at each pixel of the domain, which the mosaic is divided by
+        total_weight = np.zeros(shape, dtype=np.float32)
+        for tile in self.tiles:
+            total_weight[tile] += self.weights
+        self.inverse_total_weight = 1 / total_weight
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def split(self, X: torch.Tensor) -> torch.Tensor:
+        """Split inputs with dims (batch, ..., y, x) into tiles with dims (batch * tile, ..., y, x)
+
+        The tiles of each sample are adjacent in the output.
+        """
+        return torch.stack([X[..., ys, xs] for ys, xs in self.tiles], dim=1).flatten(0, 1)
+
+    def blend(self, y_tiles: np.ndarray) -> np.ndarray:
+        """Blend predicted tiles with dims (batch * tile, ..., y, x) into a mosaic of the domain
+
+        Returns:
+            np.ndarray: The mosaic with dims (batch, ..., y, x)
+        """
+        y_tiles = y_tiles.reshape(-1, len(self), *y_tiles.shape[1:])
+
+        mosaic = np.zeros((*y_tiles.shape[:1], *y_tiles.shape[2:-2], *self.shape), np.float32)
+        for i, (ys, xs) in enumerate(self.tiles):
+            mosaic[..., ys, xs] += y_tiles[:, i] * self.weights
+
+        mosaic *= self.inverse_total_weight
+        return mosaic
+
+
+@lru_cache
+def get_tile_grid(shape: tuple[int, int], overlap: int = TILE_OVERLAP) -> TileGrid:
+    """Get the grid of model-sized tiles covering a domain
+
+    The grid is only computed once for each domain, so it is reused between the forecasts of a
+    long-running process.
+
+    Args:
+        shape: The (y, x) size of the domain in pixels
+        overlap: The minimum number of pixels adjacent tiles overlap by
+    """
+    return TileGrid(shape, overlap=overlap)
+
+
+def predict_tiled(
+    model: Callable[[torch.Tensor], torch.Tensor],
+    X: torch.Tensor,
+    tile_grid: TileGrid,
+    batch_size: int,
+    device: torch.device,
+) -> np.ndarray:
+    """Make predictions over a domain larger than the model input by running the model on tiles
+
+    Args:
+        model: The model
+        X: The inputs with dims (init_time, variable, time, y, x) covering the domain
+        tile_grid: The grid of tiles covering the domain
+        batch_size: The number of tiles run through the model at once
+        device: The device the model is on
+
+    Returns:
+        np.ndarray: The blended predictions with dims (init_time, variable, step, y, x)
+    """
+    X_tiles = tile_grid.split(X)
+
+    y_tiles = np.concatenate(
+        [
+            model(X_tiles[i:i + batch_size].to(device)).cpu().numpy()
+            for i in range(0, len(X_tiles), batch_size)
+        ],
+    )
+
+    return tile_grid.blend(y_tiles)
@@ -1,25 +1,58 @@
-"""Runs metric calculations on cloudcasting for a given input day and appends to zarr store
+"""Runs metric calculations on cloudcasting for a given input day and saves to zarr store
+
+The backfill() entrypoint scores a range of days, skipping any init-times already in the store.
 
 This app expects these environmental variables to be available:
  - SATELLITE_ICECHUNK_ARCHIVE (str): Path at which ground truth satellite data can be found
  - PREDICTION_SAVE_DIRECTORY (str): The directory where the cloudcasting forecasts are saved
  - METRIC_ZARR_PATH (str): The path where the metric values will be saved
 
- If the SATELLITE_ICECHUNK_ARCHIVE is an s3 path, then the environment variables 
+ Optionally:
+ - PREDICTION_ICECHUNK_ARCHIVE (str): If set, the forecasts are read from this icechunk archive
+   instead of from the PREDICTION_SAVE_DIRECTORY
+ - METRIC_NUM_WORKERS (int): The number of batches of forecasts to score concurrently. Defaults
+   to the number of CPUs
+ - METRIC_BATCH_SIZE (int): The number of forecasts scored together in each batch. Defaults to 2
+ - METRIC_STREAM_SATELLITE (bool): If "true", the satellite data is streamed in valid-time order
+   rather than preloaded, so only the frames needed by the unscored forecasts are held in memory
+ - METRIC_NAMES (str): A comma separated metric set to calculate from "mae", "rmse", "bias",
+   "persistence_skill" and "threshold". Defaults to "mae"
+ - METRIC_THRESHOLD (float): The threshold used in the "threshold" metric. Defaults to 0.5
+ - METRIC_REGIONS (str): Comma separated paths of GeoJSON files of regions. If set, the metrics
+   are also aggregated over each region
+ - METRIC_REGION_CACHE_DIR (str): The directory the rasterised regions are cached in. Defaults to
+   "region_cache"
+ - METRIC_ROLLUP_ZARR_PATH (str): If set, the daily, weekly and monthly rollups of the metrics are
+   updated in this zarr store after each day is scored. See cloudcasting_metrics.rollups
+ - METRIC_SUMMARY_PATH (str): If set, a JSON summary of the time, memory and I/O of each stage
+   of scoring is written to this path
+ - METRIC_START_DATE (str): The first day scored by backfill(). Defaults to yesterday
+ - METRIC_END_DATE (str): The last day scored by backfill(). Defaults to METRIC_START_DATE
+
+ If the SATELLITE_ICECHUNK_ARCHIVE is an s3 path, then the environment variables
  AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_REGION must also be set.
 """
 
 import os
 import re
+
 import fsspec
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-
 import xarray as xr
-import icechunk
 from loguru import logger
 
+from cloudcasting_inference.archive import open_icechunk
+from cloudcasting_inference.instrumentation import StageRecorder
+from cloudcasting_metrics.regions import load_region_labels, region_cache_dir
+from cloudcasting_metrics.rollups import update_rollups
+from cloudcasting_metrics.scoring import (
+    THRESHOLD,
+    ForecastScorer,
+    StreamingForecastScorer,
+    get_required_steps,
+)
+
 # ---------------------------------------------------------------------------
 
 # The forecast produces these horizon steps
@@ -28,161 +61,412 @@ FORECAST_STEPS = pd.timedelta_range(start="15min", end="180min", freq="15min")
 FORECAST_FREQ = pd.Timedelta("30min")
 
 
-def open_icechunk(path: str) -> xr.Dataset:
-    """Open an icechunk store to xarray Dataset
-    
+def find_forecast_files(
+    prediction_dir: str,
+    start_dt: pd.Timestamp,
+) -> list[tuple[pd.Timestamp, xr.Dataset]]:
+    """Lazily open the forecast zarrs made on the day starting at start_dt
+
     Args:
-        path: The path to the local or s3 icechunk store
+        prediction_dir: The directory where the cloudcasting forecasts are saved
+        start_dt: The start of the day
+
+    Returns:
+        list: Pairs of the init-time and the lazily opened forecast
     """
+    date_string = start_dt.strftime("%Y-%m-%d")
+    remote_path = f"{prediction_dir}/{date_string}*.zarr"
+    fs, path = fsspec.core.url_to_fs(remote_path)
 
-    if path.startswith("s3://"):
-        bucket, _, path = path.removeprefix("s3://").partition("/")
-        store = icechunk.s3_storage(
-            bucket=bucket,
-            prefix=path,
-            from_env=True,
-        )
-    else:
-        store = icechunk.local_filesystem_storage(path=path)
+    forecasts = []
 
-    repo = icechunk.Repository.open(store)
-    session = repo.readonly_session("main")
-    return xr.open_zarr(session.store)
+    for file in fs.glob(path):
+        # Find the datetime of this forecast
+        match = re.search(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}", file)
+        if match is None:
+            raise Exception(f"Could not derive datetime of file {file}")
 
+        forecasts.append((pd.Timestamp(match.group(0)), xr.open_zarr(fs.get_mapper(file))))
 
-def app(date: pd.Timestamp | None = None) -> None:
-    """Runs metric calculations on cloudcasting for a given input day and appends to zarr store
+    return forecasts
+
+
+def find_archived_forecasts(
+    path: str,
+    start_dt: pd.Timestamp,
+    end_dt: pd.Timestamp,
+) -> list[tuple[pd.Timestamp, xr.Dataset]]:
+    """Lazily select the forecasts made between start_dt and end_dt from the icechunk archive
 
     Args:
-        date: The day for which the cloudcasting predictions will be scored.
+        path: The path to the icechunk archive of forecasts
+        start_dt: The start of the period (inclusive)
+        end_dt: The end of the period (exclusive)
+
+    Returns:
+        list: Pairs of the init-time and the lazily opened forecast
     """
+    ds_forecasts = open_icechunk(path)
 
-    # Unpack environmental variables
-    sat_path = os.environ["SATELLITE_ICECHUNK_ARCHIVE"]
-    prediction_dir = os.environ["PREDICTION_SAVE_DIRECTORY"]
-    metric_zarr_path = os.environ["METRIC_ZARR_PATH"]
+    init_times = pd.DatetimeIndex(ds_forecasts.init_time.values)
+    init_times = init_times[(init_times >= start_dt) & (init_times < end_dt)].sort_values()
 
-    now = pd.Timestamp.now(tz="UTC").replace(tzinfo=None)
+    return [(t, ds_forecasts.sel(init_time=[t])) for t in init_times]
 
-    # Default to yesterday
-    if date is None:
-        date = now.floor("1D") - pd.Timedelta("1D")
-    
-    start_dt =  date.floor("1D")
-    end_dt = start_dt + pd.Timedelta("1D")
 
-    if now <= end_dt + FORECAST_STEPS.max():
-        raise Exception(
-            f"We cannot score forecast with init-time {end_dt} until after the last valid-time."
-        )
+def find_forecasts(
+    start_dt: pd.Timestamp,
+    end_dt: pd.Timestamp,
+) -> list[tuple[pd.Timestamp, xr.Dataset]]:
+    """Lazily open the forecasts made between start_dt and end_dt
 
-    # Open the satellite data store
-    ds_sat = open_icechunk(path=sat_path)
+    The forecasts are read from PREDICTION_ICECHUNK_ARCHIVE if it is set, otherwise from the files
+    in PREDICTION_SAVE_DIRECTORY.
 
-    # Slice to only the timesteps we need for scoring
-    ds_sat = ds_sat.sel(time=slice(start_dt, end_dt + FORECAST_STEPS.max()))
+    Args:
+        start_dt: The start of the day
+        end_dt: The end of the day
 
-    # It is better to preload if we have the RAM space
-    # - This eliminates any costs of repeatedly streaming data from the bucket
-    # - It's also faster
-    ds_sat = ds_sat.compute()
+    Returns:
+        list: Pairs of the init-time and the lazily opened forecast, in init-time order
+    """
+    forecast_archive_path = os.getenv("PREDICTION_ICECHUNK_ARCHIVE")
 
-    # Find recent forecasts
-    date_string = start_dt.strftime("%Y-%m-%d")
-    remote_path = f"{prediction_dir}/{date_string}*.zarr"
-    fs, path = fsspec.core.url_to_fs(remote_path)
+    if forecast_archive_path is not None:
+        forecasts = find_archived_forecasts(forecast_archive_path, start_dt, end_dt)
+    else:
+        forecasts = find_forecast_files(os.environ["PREDICTION_SAVE_DIRECTORY"], start_dt)
 
-    file_list = fs.glob(path)
+    return sorted(forecasts, key=lambda x: x[0])
 
-    # Filter forecasts
-    # - We only score forecasts we have the satellite data for
-    # - If we are missing one satellite image we will skip scoring all forecasts require that
-    forecasts_to_score = []
 
-    for file in file_list:
-        # Find the datetime of this forecast
-        match = re.search(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}', file)
-        if match is None:
-            raise Exception(f"Could not derive datetime of file {file}")
+def chunk_metrics(ds_maes: xr.Dataset) -> xr.Dataset:
+    """Chunk the MAE values ready for saving, with one chunk per day of init-times"""
+    return ds_maes.chunk({**dict.fromkeys(ds_maes.dims, -1), "init_time": 48})
+
+
+def get_scored_init_times(metric_zarr_path: str) -> pd.DatetimeIndex:
+    """Get the init-times which have already been scored in the MAE store
+
+    Init-times which are in the store but are all NaN have not been scored.
+
+    Args:
+        metric_zarr_path: The path of the MAE store
 
-        # Check the satellite data required to score it is present
-        init_time = pd.Timestamp(match.group(0))
-        if np.isin(init_time + FORECAST_STEPS, ds_sat.time).all():
-            forecasts_to_score.append(file)
+    Returns:
+        pd.DatetimeIndex: The scored init-times. This is empty if the store does not exist
+    """
+    fs, stripped = fsspec.core.url_to_fs(metric_zarr_path)
+    if not fs.exists(stripped):
+        return pd.DatetimeIndex([])
+
+    # Use the smallest of the metrics to check which init-times have been scored
+    ds_maes = xr.open_zarr(metric_zarr_path)
+    da = min(ds_maes.data_vars.values(), key=lambda da: da.size).compute()
+    is_scored = da.notnull().any(dim=[d for d in da.dims if d != "init_time"])
+
+    return pd.DatetimeIndex(da.init_time.values[is_scored.values])
+
+
+def _finish_realloc(fs: fsspec.AbstractFileSystem, stripped: str) -> None:
+    """Swap a complete rewrite of the MAE store into place and remove the old store
+
+    The rewrite at "<store>.realloc" is copied rather than moved into place, so it stays complete
+    until the new store is in place and this can be safely repeated if it is interrupted. The old
+    store, if it has been moved to "<store>.bak", is only removed once the new store is in place.
+
+    Args:
+        fs: The filesystem of the MAE store
+        stripped: The path of the MAE store without the protocol
+    """
+    realloc_path, backup_path = f"{stripped.rstrip('/')}.realloc", f"{stripped.rstrip('/')}.bak"
+
+    # The store may be the old store, or a partial copy of the rewrite
+    if fs.exists(stripped):
+        if fs.exists(backup_path):
+            fs.rm(stripped, recursive=True)
         else:
-            logger.warn(f"Cannot score {file} due to missing satellite data")
+            fs.mv(stripped, backup_path, recursive=True)
 
-    ds_mae_list = []
+    fs.copy(realloc_path, stripped, recursive=True)
 
-    for file in tqdm(forecasts_to_score):
-        ds_forecast = xr.open_zarr(fs.get_mapper(file)).compute()
+    if fs.exists(backup_path):
+        fs.rm(backup_path, recursive=True)
+    # Once it is no longer marked complete, any leftover rewrite is removed on the next run
+    fs.rm(f"{realloc_path}.complete")
+    fs.rm(realloc_path, recursive=True)
 
-        valid_times = pd.Timestamp(ds_forecast.init_time.item()) + ds_forecast.step
 
-        ds_forecast = (
-            ds_forecast
-            .assign_coords(time=valid_times)
-            .swap_dims({"step":"time"})
-        )
+def allocate_init_times(
+    metric_zarr_path: str,
+    ds_template: xr.Dataset,
+    init_times: pd.DatetimeIndex,
+) -> None:
+    """Extend the init-time axis of the MAE store to cover the init-times, filled with NaNs
 
-        ds_sat_sel = ds_sat.sel(
-            time=ds_forecast.time,
-            x_geostationary=ds_forecast.x_geostationary,
-            y_geostationary=ds_forecast.y_geostationary,
-            variable=ds_forecast.variable,
-        )
+    The store is created if it does not exist. New init-times after the end of the store are
+    appended. Since zarr arrays cannot be extended at their start, if there are new init-times
+    before the start of the store it is rewritten once with the earlier init-times prepended. The
+    rewrite is written next to the store and swapped in so the store is never lost, and an
+    interrupted rewrite is finished or removed on the next call. The axis is always extended by
+    whole days so the init-time chunks stay aligned with days.
 
-        da_mae = np.abs(
-            (ds_sat_sel.data - ds_forecast.sat_pred)
-            .swap_dims({"time":"step"})
-            .drop_vars("time")
+    Args:
+        metric_zarr_path: The path of the MAE store
+        ds_template: MAE values with the coords and dims of the store
+        init_times: The init-times the store should cover
+    """
+
+    def nan_metrics(init_times: pd.DatetimeIndex) -> xr.Dataset:
+        ds_nan = ds_template.isel(init_time=0, drop=True).chunk()
+        ds_nan = xr.full_like(ds_nan.expand_dims(init_time=init_times, axis=-1), np.nan)
+        return chunk_metrics(ds_nan.transpose(*ds_template.dims))
+
+    fs, stripped = fsspec.core.url_to_fs(metric_zarr_path)
+    realloc_path = f"{stripped.rstrip('/')}.realloc"
+
+    # Recover from a previous rewrite of the store which was interrupted
+    if fs.exists(f"{realloc_path}.complete"):
+        logger.warning(f"Finishing an interrupted rewrite of the MAE store {metric_zarr_path}")
+        _finish_realloc(fs, stripped)
+    elif fs.exists(realloc_path):
+        logger.warning(f"Removing an incomplete rewrite of the MAE store {metric_zarr_path}")
+        fs.rm(realloc_path, recursive=True)
+
+    # If it exists, open the archive of MAE values and check the coordinates against them
+    if not fs.exists(stripped):
+        nan_metrics(init_times).to_zarr(metric_zarr_path, mode="w")
+        return
+
+    ds_maes_archive = xr.open_zarr(metric_zarr_path)
+
+    for coord in ["variable", "step", "x_geostationary", "y_geostationary", "region"]:
+        in_template, in_archive = coord in ds_template.coords, coord in ds_maes_archive.coords
+        if in_template != in_archive or (
+            in_template
+            and not np.array_equal(ds_maes_archive[coord].values, ds_template[coord].values)
+        ):
+            raise Exception(f"Found differences in coord: {coord}")
+
+    archive_init_times = pd.DatetimeIndex(ds_maes_archive.init_time.values)
+
+    if init_times.min() < archive_init_times.min():
+        logger.info(
+            f"Rewriting the MAE store to add the init-times from {init_times.min()} before its "
+            f"first init-time {archive_init_times.min()}",
         )
+        prepend_init_times = pd.date_range(
+            init_times.min().floor("1D"), archive_init_times.min(), freq=FORECAST_FREQ,
+            inclusive="left",
+        )
+        for v in ds_maes_archive.variables.values():
+            v.encoding.clear()
+        ds_realloc = xr.concat([nan_metrics(prepend_init_times), ds_maes_archive], dim="init_time")
+
+        # Write the extended store next to the old one, mark it complete, then swap it in
+        chunk_metrics(ds_realloc).to_zarr(f"{metric_zarr_path.rstrip('/')}.realloc", mode="w")
+        fs.pipe_file(f"{realloc_path}.complete", b"")
+        _finish_realloc(fs, stripped)
+
+        archive_init_times = prepend_init_times.append(archive_init_times)
+
+    if init_times.max() <= archive_init_times.max():
+        return
+
+    new_init_times = pd.date_range(
+        archive_init_times.max() + FORECAST_FREQ, init_times.max(), freq=FORECAST_FREQ,
+    )
+    nan_metrics(new_init_times).to_zarr(metric_zarr_path, mode="a-", append_dim="init_time")
+
+
+def write_metrics(metric_zarr_path: str, ds_maes: xr.Dataset) -> None:
+    """Write the MAE values of a day into the allocated region of the MAE store
+
+    The whole day is written, keeping the values already in the store for init-times which were
+    not scored, so each write covers exactly one init-time chunk and different days can be written
+    concurrently.
+
+    Args:
+        metric_zarr_path: The path of the MAE store
+        ds_maes: The MAE values of init-times within a single day
+    """
+    ds_maes_archive = xr.open_zarr(metric_zarr_path)
+    archive_init_times = pd.DatetimeIndex(ds_maes_archive.init_time.values)
+
+    start_dt = pd.Timestamp(ds_maes.init_time.min().item()).floor("1D")
+    region = slice(
+        archive_init_times.searchsorted(start_dt),
+        archive_init_times.searchsorted(start_dt + pd.Timedelta("1D")),
+    )
+
+    ds_day = ds_maes_archive.isel(init_time=region).compute()
+    ds_day = ds_maes.reindex(init_time=ds_day.init_time).fillna(ds_day)
+
+    chunk_metrics(ds_day).drop_vars(
+        [v for v in ds_day.variables if "init_time" not in ds_day[v].dims],
+    ).to_zarr(metric_zarr_path, region={"init_time": region})
+
+
+def backfill(
+    start_date: pd.Timestamp | None = None,
+    end_date: pd.Timestamp | None = None,
+) -> None:
+    """Score the forecasts of a range of days which are missing from the MAE store
+
+    Init-times which have already been scored are skipped, so this can be safely rerun. The
+    satellite data is shared between adjacent days when it is streamed.
+
+    Args:
+        start_date: The first day to score. Defaults to the environmental variable
+            METRIC_START_DATE, or yesterday if that is not set
+        end_date: The last day to score (inclusive). Defaults to the environmental variable
+            METRIC_END_DATE, or the start date if that is not set
+    """
+
+    # Unpack environmental variables
+    sat_path = os.environ["SATELLITE_ICECHUNK_ARCHIVE"]
+    metric_zarr_path = os.environ["METRIC_ZARR_PATH"]
+    num_workers = int(os.getenv("METRIC_NUM_WORKERS", os.cpu_count() or 1))
+    batch_size = int(os.getenv("METRIC_BATCH_SIZE", 2))
+    stream_satellite = os.getenv("METRIC_STREAM_SATELLITE", "false").lower() == "true"
+    metrics = tuple(os.getenv("METRIC_NAMES", "mae").split(","))
+    threshold = float(os.getenv("METRIC_THRESHOLD", THRESHOLD))
+    region_paths = os.getenv("METRIC_REGIONS")
+    region_cache_path = os.getenv("METRIC_REGION_CACHE_DIR", region_cache_dir)
+    rollup_zarr_path = os.getenv("METRIC_ROLLUP_ZARR_PATH")
+
+    # Measure the time, memory and I/O of each stage
+    recorder = StageRecorder(summary_path=os.getenv("METRIC_SUMMARY_PATH"))
+
+    now = pd.Timestamp.now(tz="UTC").replace(tzinfo=None)
 
-        # Create reductions of the full MAE matrix
-        da_mae_step = da_mae.mean(dim=("x_geostationary", "y_geostationary", "variable"))
-        da_mae_variable = da_mae.mean(dim=("x_geostationary", "y_geostationary", "step"))
-        da_mae_spatial = da_mae.mean(dim=("step", "variable"))
-
-        ds_mae_reductions = xr.Dataset(
-            {
-                "mae_step": da_mae_step,
-                "mae_variable": da_mae_variable,
-                "mae_spatial": da_mae_spatial,
-            }
+    # Default to yesterday
+    if start_date is None:
+        start_date = pd.Timestamp(
+            os.getenv("METRIC_START_DATE", now.floor("1D") - pd.Timedelta("1D")),
         )
 
-        ds_mae_list.append(ds_mae_reductions)
+    if end_date is None:
+        end_date = pd.Timestamp(os.getenv("METRIC_END_DATE", start_date))
+
+    days = pd.date_range(start_date.floor("1D"), end_date.floor("1D"), freq="1D")
+    start_dt = days[0]
+    end_dt = days[-1] + pd.Timedelta("1D")
+
+    if now <= end_dt + FORECAST_STEPS.max():
+        raise Exception(
+            f"We cannot score forecast with init-time {end_dt} until after the last valid-time."
+        )
 
-    # Concat all the MAE scores and in-fill missing init times with NaNs
-    # - Filling with NaNs makes the chunking easier
-    ds_all_maes = xr.concat(ds_mae_list, dim="init_time")
     expected_init_times = pd.date_range(start_dt, end_dt, freq=FORECAST_FREQ, inclusive="left")
-    ds_all_maes = ds_all_maes.reindex(init_time=expected_init_times, method=None)
-
-    # Chunk the data ready for saving
-    ds_all_maes = ds_all_maes.chunk(
-        {
-            "x_geostationary": -1, 
-            "y_geostationary": -1, 
-            "step": -1, 
-            "variable": -1, 
-            "init_time": 48
-            }
-    )
+    scored_init_times = get_scored_init_times(metric_zarr_path)
+    required_steps = get_required_steps(FORECAST_STEPS, metrics)
 
-    # If it exists, open the archive of MAE values and check the coordinates against them
-    fs, stripped = fsspec.core.url_to_fs(metric_zarr_path)
-    if fs.exists(stripped):
-        ds_maes_archive = xr.open_zarr(metric_zarr_path)
+    # Open the satellite data store and slice to only the timesteps we need for scoring
+    ds_sat = open_icechunk(path=sat_path)
+    ds_sat = ds_sat.sel(time=slice(start_dt, end_dt + FORECAST_STEPS.max()))
 
-        if np.isin(ds_all_maes.init_time, ds_maes_archive.init_time).any():
-            raise Exception("init-times in new MAEs already exist in MAE store")
-        
-        for coord in ["variable", "step", "x_geostationary", "y_geostationary"]:
-            if not ds_maes_archive[coord].identical(ds_all_maes[coord]):
-                raise Exception("Found differences in coord: {coord}")
-                
-        ds_all_maes.to_zarr(metric_zarr_path, mode="a-", append_dim="init_time")
+    # When streaming, one scorer is used for all the days so the frames shared by adjacent days
+    # are only read once
+    scorer = None
+    regions = None
+    is_allocated = False
+
+    for day_start in days:
+        day_end = day_start + pd.Timedelta("1D")
+        day = str(day_start.date())
+
+        # Filter forecasts
+        # - We skip forecasts which have already been scored
+        # - We only score forecasts we have the satellite data for
+        # - If we are missing one satellite image we will skip scoring all forecasts require that
+        forecasts_to_score = []
+
+        with recorder.stage("find_forecasts", day=day) as stage:
+            for init_time, ds_forecast in find_forecasts(day_start, day_end):
+                if init_time in scored_init_times:
+                    continue
+                # Check the satellite data required to score it is present
+                if np.isin(init_time + required_steps, ds_sat.time).all():
+                    forecasts_to_score.append(ds_forecast)
+                else:
+                    logger.warning(
+                        f"Cannot score forecast for {init_time} due to missing satellite data",
+                    )
+            stage.add(forecasts=len(forecasts_to_score))
+
+        if len(forecasts_to_score) == 0:
+            logger.info(f"There are no new forecasts to score for {day_start.date()}")
+            continue
+
+        logger.info(f"Scoring {len(forecasts_to_score)} forecasts for {day_start.date()}")
+
+        # Rasterise the regions onto the forecast grid, or load them from the cache
+        if region_paths is not None and regions is None:
+            with recorder.stage("load_regions"):
+                regions = load_region_labels(
+                    region_paths.split(","),
+                    x=forecasts_to_score[0].x_geostationary,
+                    y=forecasts_to_score[0].y_geostationary,
+                    area=ds_sat.data.attrs["area"],
+                    cache_dir=region_cache_path,
+                )
+
+        scorer_kwargs = {"metrics": metrics, "threshold": threshold, "regions": regions}
+
+        if stream_satellite:
+            # Each frame is streamed from the bucket once, when it is first needed
+            if scorer is None:
+                scorer = StreamingForecastScorer(ds_sat, forecasts_to_score[0], **scorer_kwargs)
+        else:
+            # It is better to preload if we have the RAM space
+            # - This eliminates any costs of repeatedly streaming data from the bucket
+            # - It's also faster
+            with recorder.stage("load_satellite", day=day) as stage:
+                ds_sat_day = ds_sat.sel(time=slice(day_start, day_end + FORECAST_STEPS.max()))
+                scorer = ForecastScorer(
+                    ds_sat_day.compute(), forecasts_to_score[0], **scorer_kwargs,
+                )
+                stage.add(frames=len(ds_sat_day.time))
+
+        # Score the forecasts in batches against the satellite data, which is aligned to the
+        # forecast grid only once. The results are returned in init-time order
+        with recorder.stage("score", day=day) as stage:
+            # When streaming, the satellite frames are read while scoring
+            num_frames_read = scorer.num_frames_read if stream_satellite else 0
+            ds_maes = scorer.score(
+                forecasts_to_score, batch_size=batch_size, num_workers=num_workers,
+            )
+            stage.add(
+                forecasts=len(forecasts_to_score),
+                frames=len(forecasts_to_score) * len(FORECAST_STEPS),
+            )
+            if stream_satellite:
+                stage.add(satellite_frames=scorer.num_frames_read - num_frames_read)
+
+        with recorder.stage("write_metrics", day=day):
+            # Allocate all the init-times of the range before the first write
+            if not is_allocated:
+                allocate_init_times(metric_zarr_path, ds_maes, expected_init_times)
+                is_allocated = True
+
+            write_metrics(metric_zarr_path, ds_maes)
+
+        if rollup_zarr_path is not None:
+            with recorder.stage("update_rollups", day=day):
+                update_rollups(rollup_zarr_path, metric_zarr_path, day_start)
+
+    logger.info(f"Scoring from {start_dt.date()} to {days[-1].date()} complete", **recorder.timings)
+    recorder.write_summary()
 
-    else:
-        ds_all_maes.to_zarr(metric_zarr_path, mode="w")
\ No newline at end of file
+
+def app(date: pd.Timestamp | None = None) -> None:
+    """Runs metric calculations on cloudcasting for a given input day and saves to zarr store
+
+    Args:
+        date: The day for which the cloudcasting predictions will be scored. Defaults to yesterday
+    """
+    if date is None:
+        date = pd.Timestamp.now(tz="UTC").replace(tzinfo=None).floor("1D") - pd.Timedelta("1D")
+
+    backfill(start_date=date, end_date=date)
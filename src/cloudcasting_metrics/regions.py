@@ -0,0 +1,164 @@
+"""Rasterisation of named regions onto the geostationary grid of the forecasts
+
+Regions are read from GeoJSON files of Polygon and MultiPolygon features in longitude and latitude,
+where the name of each region is the "name" property of its feature. Each file is a layer of
+regions which should not overlap, e.g. countries or land and sea. Regions in different layers may
+overlap.
+
+Each layer is rasterised once into an array of labels, which gives the index of the region each
+pixel falls in, or -1 if it is in no region. The labels are cached on disk keyed on the grid and
+the region definitions.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import xarray as xr
+from loguru import logger
+from ocf_data_sampler.select.geospatial import lon_lat_to_geostationary_area_coords
+
+region_cache_dir = "region_cache"
+
+
+def _get_rings(geometry: dict) -> list[np.ndarray]:
+    """Get the rings of a Polygon or MultiPolygon GeoJSON geometry as arrays of lon-lat points"""
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        raise ValueError(f"Unsupported region geometry type {geometry['type']}")
+
+    return [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon]
+
+
+def rasterise_rings(
+    rings: list[np.ndarray],
+    x: np.ndarray,
+    y: np.ndarray,
+) -> np.ndarray:
+    """Find the grid points inside the rings using the even-odd rule
+
+    Each row of the grid is filled between pairs of crossings of the ring edges, so the holes of
+    polygons and the parts of multi-polygons are handled.
+
+    Args:
+        rings: The closed rings of points in the coordinates of the grid
+        x: The x coords of the grid
+        y: The y coords of the grid
+
+    Returns:
+        np.ndarray: A boolean mask with shape (y, x)
+    """
+    start = np.concatenate([ring[:-1] for ring in rings])
+    end = np.concatenate([ring[1:] for ring in rings])
+
+    mask = np.zeros((len(y), len(x)), dtype=bool)
+
+    for i, y_row in enumerate(y):
+        # Find the x coords where the edges cross this row
+        crosses = (start[:, 1] <= y_row) != (end[:, 1] <= y_row)
+        (x1, y1), (x2, y2) = start[crosses].T, end[crosses].T
+        x_crossings = np.sort(x1 + (y_row - y1) * (x2 - x1) / (y2 - y1))
+
+        # Points with an odd number of crossings to their left are inside
+        mask[i] = np.searchsorted(x_crossings, x) % 2 == 1
+
+    return mask
+
+
+def rasterise_regions(
+    path: str,
+    x: np.ndarray,
+    y: np.ndarray,
+    area: str,
+) -> tuple[list[str], np.ndarray]:
+    """Rasterise the regions of a GeoJSON file onto the geostationary grid
+
+    Args:
+        path: The path of the GeoJSON file
+        x: The x_geostationary coords of the grid
+        y: The y_geostationary coords of the grid
+        area: The yaml geostationary area definition of the grid
+
+    Returns:
+        tuple: The region names, and the labels of the grid points with shape (y, x). Points in
+            more than one region take the label of the first.
+    """
+    with open(path, encoding="utf-8") as f:
+        features = json.load(f)["features"]
+
+    names = []
+    labels = np.full((len(y), len(x)), -1, dtype=np.int32)
+
+    for feature in features:
+        rings = []
+        for ring in _get_rings(feature["geometry"]):
+            ring_x, ring_y = lon_lat_to_geostationary_area_coords(ring[:, 0], ring[:, 1], area)
+            if not (np.isfinite(ring_x).all() and np.isfinite(ring_y).all()):
+                raise ValueError(
+                    f"Region {feature['properties']['name']} is not within the satellite view",
+                )
+            rings.append(np.stack([ring_x, ring_y], axis=1))
+
+        mask = rasterise_rings(rings, x, y) & (labels == -1)
+        labels[mask] = len(names)
+        names.append(feature["properties"]["name"])
+
+    return names, labels
+
+
+def load_region_labels(
+    paths: list[str],
+    x: xr.DataArray,
+    y: xr.DataArray,
+    area: str,
+    cache_dir: str = region_cache_dir,
+) -> tuple[list[str], np.ndarray]:
+    """Load the labels of the layers of regions on the grid, rasterising them if not cached
+
+    Args:
+        paths: The paths of the GeoJSON files, with one layer of regions in each
+        x: The x_geostationary coords of the grid
+        y: The y_geostationary coords of the grid
+        area: The yaml geostationary area definition of the grid
+        cache_dir: The directory the rasterised labels are cached in
+
+    Returns:
+        tuple: The names of the regions across all the layers, and the labels of each layer with
+            shape (layer, y, x). The labels index into the names.
+    """
+    names = []
+    layer_labels = []
+
+    for path in paths:
+        with open(path, "rb") as f:
+            regions_bytes = f.read()
+
+        key = hashlib.sha256()
+        for b in [x.values.tobytes(), y.values.tobytes(), area.encode(), regions_bytes]:
+            key.update(b)
+        cache_path = f"{cache_dir}/{key.hexdigest()}.npz"
+
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                layer_names, labels = [str(n) for n in cached["names"]], cached["labels"]
+        else:
+            logger.info(f"Rasterising regions from {path}")
+            layer_names, labels = rasterise_regions(path, x.values, y.values, area)
+
+            # Write to a temporary file and move it into place so a partial file is not cached
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(f"{cache_path}.tmp", "wb") as f:
+                np.savez(f, names=np.array(layer_names), labels=labels)
+            os.replace(f"{cache_path}.tmp", cache_path)
+
+        layer_labels.append(np.where(labels >= 0, labels + len(names), -1))
+        names.extend(layer_names)
+
+    if len(set(names)) != len(names):
+        raise ValueError("The region names must be unique")
+
+    return names, np.stack(layer_labels)
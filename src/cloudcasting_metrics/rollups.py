@@ -0,0 +1,252 @@
+"""Rollups of the metrics over daily, weekly and monthly periods, and range queries over them
+
+The rollups hold the sum and count of the valid values of each metric over the init-times of each
+period, e.g. "mae_step_sum" and "mae_step_count". The spatial metrics are also coarsened into
+blocks of pixels. Each level of rollups is a group in the rollup zarr store with a `period`
+dimension of the period start times. Weeks start on Mondays.
+
+The daily rollups are made from the metric store, and the weekly and monthly rollups from the
+daily rollups, so they can be updated incrementally and rebuilt safely when a day is rescored.
+
+Range queries are answered by combining the coarsest rollups which fit within the range, e.g. a
+query over a year uses the monthly rollups, plus the weekly and daily rollups of any part months.
+"""
+
+import fsspec
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+LEVELS = ("daily", "weekly", "monthly")
+
+# The factor the spatial metrics are coarsened by in the rollups
+COARSEN_FACTOR = 8
+
+
+def get_period_start(level: str, dt: pd.Timestamp) -> pd.Timestamp:
+    """Get the start of the period of the level which contains dt"""
+    day = dt.floor("1D")
+    if level == "daily":
+        return day
+    elif level == "weekly":
+        return day - pd.Timedelta(days=day.weekday())
+    elif level == "monthly":
+        return day.replace(day=1)
+    raise ValueError(f"Unknown rollup level {level}. Must be one of {LEVELS}")
+
+
+def get_period_end(level: str, period_start: pd.Timestamp) -> pd.Timestamp:
+    """Get the end of the period of the level which starts at period_start"""
+    if level == "daily":
+        return period_start + pd.Timedelta("1D")
+    elif level == "weekly":
+        return period_start + pd.Timedelta("7D")
+    elif level == "monthly":
+        return period_start + pd.DateOffset(months=1)
+    raise ValueError(f"Unknown rollup level {level}. Must be one of {LEVELS}")
+
+
+def rollup_metrics(
+    ds_maes: xr.Dataset,
+    period_start: pd.Timestamp,
+    coarsen_factor: int = COARSEN_FACTOR,
+) -> xr.Dataset:
+    """Sum and count the valid values of the metrics over their init-times
+
+    Args:
+        ds_maes: The metrics of the init-times in the period
+        period_start: The start of the period
+        coarsen_factor: The factor to coarsen the spatial metrics by. Pixels at the edges which do
+            not fill a block are dropped
+
+    Returns:
+        xr.Dataset: The rollup of the period
+    """
+    ds_sum = ds_maes.fillna(0)
+    ds_count = ds_maes.notnull().astype(np.int64)
+
+    if "x_geostationary" in ds_maes.dims:
+        coarsen_dims = {"x_geostationary": coarsen_factor, "y_geostationary": coarsen_factor}
+        ds_sum = ds_sum.coarsen(coarsen_dims, boundary="trim").sum()
+        ds_count = ds_count.coarsen(coarsen_dims, boundary="trim").sum()
+
+    ds_rollup = xr.merge(
+        [
+            ds_sum.sum("init_time", dtype=np.float64).rename({v: f"{v}_sum" for v in ds_maes}),
+            ds_count.sum("init_time").rename({v: f"{v}_count" for v in ds_maes}),
+        ],
+    )
+
+    return ds_rollup.expand_dims(period=[period_start])
+
+
+def _open_level(rollup_zarr_path: str, level: str) -> xr.Dataset | None:
+    """Lazily open a level of the rollups, or return None if it does not exist yet"""
+    fs, stripped = fsspec.core.url_to_fs(rollup_zarr_path)
+    if not fs.exists(f"{stripped}/{level}"):
+        return None
+    return xr.open_zarr(rollup_zarr_path, group=level)
+
+
+def _write_level(rollup_zarr_path: str, level: str, ds_rollup: xr.Dataset) -> None:
+    """Write the rollups of some periods into a level, replacing any for the same periods
+
+    Periods which are already in the level are overwritten with region writes, and new periods are
+    appended, so only the updated periods are written. The periods of a level are in the order
+    they were first written.
+    """
+    for v in ds_rollup.variables:
+        ds_rollup[v].encoding.clear()
+
+    ds_level = _open_level(rollup_zarr_path, level)
+
+    if ds_level is None:
+        ds_rollup.to_zarr(rollup_zarr_path, group=level, mode="w-")
+        return
+
+    level_periods = pd.DatetimeIndex(ds_level.period.values)
+    is_new = ~pd.DatetimeIndex(ds_rollup.period.values).isin(level_periods)
+
+    for period in ds_rollup.period.values[~is_new]:
+        i = level_periods.get_loc(period)
+        ds_period = ds_rollup.sel(period=[period])
+        ds_period.drop_vars(
+            [v for v in ds_period.variables if "period" not in ds_period[v].dims],
+        ).to_zarr(rollup_zarr_path, group=level, region={"period": slice(i, i + 1)})
+
+    if is_new.any():
+        ds_rollup.isel(period=is_new).to_zarr(
+            rollup_zarr_path, group=level, mode="a-", append_dim="period",
+        )
+
+
+def update_rollups(
+    rollup_zarr_path: str,
+    metric_zarr_path: str,
+    day: pd.Timestamp,
+    coarsen_factor: int = COARSEN_FACTOR,
+) -> None:
+    """Update the rollups of the periods containing the day from the metric store
+
+    Args:
+        rollup_zarr_path: The path of the rollup store. This is created if it does not exist
+        metric_zarr_path: The path of the metric store
+        day: The day whose metrics have been written
+        coarsen_factor: The factor to coarsen the spatial metrics by
+    """
+    day = day.floor("1D")
+
+    ds_maes = xr.open_zarr(metric_zarr_path)
+    ds_maes = ds_maes.sel(init_time=slice(day, day + pd.Timedelta("1D") - pd.Timedelta("1ns")))
+    ds_daily = rollup_metrics(ds_maes.compute(), day, coarsen_factor=coarsen_factor)
+    _write_level(rollup_zarr_path, "daily", ds_daily)
+
+    # The coarser levels are the sums of the daily rollups in their periods. Only the daily
+    # rollups of these periods are loaded
+    ds_daily = _open_level(rollup_zarr_path, "daily")
+    daily_periods = pd.DatetimeIndex(ds_daily.period.values)
+
+    for level in ["weekly", "monthly"]:
+        period_start = get_period_start(level, day)
+        in_period = (daily_periods >= period_start) & (
+            daily_periods < get_period_end(level, period_start)
+        )
+        ds_rollup = ds_daily.isel(period=in_period).sum("period").compute()
+        _write_level(rollup_zarr_path, level, ds_rollup.expand_dims(period=[period_start]))
+
+
+def _cover(start: pd.Timestamp, end: pd.Timestamp) -> dict[str, list[pd.Timestamp]]:
+    """Cover the days from start to end with the fewest periods, using the coarsest levels first
+
+    Returns:
+        dict: The start times of the periods used for each level
+    """
+    periods = {level: [] for level in LEVELS}
+    gaps = [(start, end)]
+
+    for level in LEVELS[::-1]:
+        remaining_gaps = []
+
+        for gap_start, gap_end in gaps:
+            # Find the periods of this level which are inside the gap
+            period_start = get_period_start(level, gap_start)
+            if period_start < gap_start:
+                period_start = get_period_end(level, period_start)
+
+            first_start = period_start
+            while get_period_end(level, period_start) <= gap_end:
+                periods[level].append(period_start)
+                period_start = get_period_end(level, period_start)
+
+            if period_start == first_start:
+                remaining_gaps.append((gap_start, gap_end))
+            else:
+                remaining_gaps.extend([(gap_start, first_start), (period_start, gap_end)])
+
+        gaps = [(s, e) for s, e in remaining_gaps if s < e]
+
+    return periods
+
+
+def query_metric(
+    rollup_zarr_path: str,
+    name: str,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    freq: str | None = None,
+) -> xr.DataArray:
+    """Get the mean of a metric over the init-times in a range of days
+
+    A FileNotFoundError is raised if the rollup store, or any level of it, does not exist.
+
+    Args:
+        rollup_zarr_path: The path of the rollup store
+        name: The name of the metric, e.g. "mae_step"
+        start: The start of the range. This is floored to the day
+        end: The end of the range (exclusive). This is floored to the day
+        freq: If given, the mean is calculated for each period of this pandas frequency within
+            the range, e.g. "1D", "7D" or "MS". Otherwise the mean over the whole range is returned
+
+    Returns:
+        xr.DataArray: The mean of the metric. This has a `time` dim of the period starts if freq
+            is given. It is NaN where there are no rollups in the range
+    """
+    start, end = start.floor("1D"), end.floor("1D")
+    if start >= end:
+        raise ValueError(f"The query range must cover at least one day, got {start} to {end}")
+
+    ds_levels = {level: _open_level(rollup_zarr_path, level) for level in LEVELS}
+    for level, ds in ds_levels.items():
+        if ds is None:
+            raise FileNotFoundError(f"The {level} rollups do not exist in {rollup_zarr_path}")
+
+    # The sums start from zero, so the mean is NaN where there are no rollups in the range
+    da_zeros = xr.zeros_like(ds_levels["daily"][f"{name}_sum"].isel(period=0, drop=True)).compute()
+
+    def range_mean(range_start: pd.Timestamp, range_end: pd.Timestamp) -> xr.DataArray:
+        da_sum = da_zeros
+        da_count = da_zeros
+        for level, period_starts in _cover(range_start, range_end).items():
+            if len(period_starts) == 0:
+                continue
+            ds = ds_levels[level]
+            ds = ds.sel(period=ds.period.isin(pd.DatetimeIndex(period_starts))).compute()
+            da_sum = da_sum + ds[f"{name}_sum"].sum("period")
+            da_count = da_count + ds[f"{name}_count"].sum("period")
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (da_sum / da_count).rename(name)
+
+    if freq is None:
+        return range_mean(start, end)
+
+    # The first period may be a part period, e.g. if start is not the start of a month
+    period_starts = pd.date_range(start, end, freq=freq, inclusive="left")
+    if len(period_starts) == 0 or period_starts[0] != start:
+        period_starts = period_starts.insert(0, start)
+    period_ends = [*period_starts[1:], end]
+
+    return xr.concat(
+        [range_mean(s, e) for s, e in zip(period_starts, period_ends, strict=True)],
+        dim=pd.Index(period_starts, name="time"),
+    )
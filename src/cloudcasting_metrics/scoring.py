@@ -0,0 +1,476 @@
+"""Vectorised scoring of cloudcasting forecasts against the ground truth satellite data
+
+The spatial and variable alignment between the forecasts and the satellite data is resolved once,
+and each forecast init-time is mapped to integer offsets into the satellite time dimension. The
+errors and their reductions are then computed for batches of forecasts as stacked numpy operations.
+
+All of the metrics in the metric set are computed in a single pass over each batch:
+ - "mae": The mean absolute error
+ - "rmse": The root mean squared error
+ - "bias": The mean of the forecast minus the ground truth
+ - "persistence_skill": The MAE of a persistence forecast of the init-time satellite frame, and the
+   skill of the forecast against it, which is 1 - MAE / persistence MAE
+ - "threshold": The counts of hits, false alarms and misses of the forecast exceeding a threshold
+
+Each metric is reduced over different dimensions, e.g. "mae" gives the variables "mae_step",
+"mae_variable" and "mae_spatial". If regions are given, the metrics are also aggregated over each
+region for each step, e.g. "mae_region", using label-indexed sums of the pixels.
+
+The satellite data can either be preloaded, or streamed in valid-time order so that only the frames
+still needed by the unscored forecasts are held in memory.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tqdm import tqdm
+
+# The order of the dimensions of the forecast arrays used in scoring
+FORECAST_DIMS = ("step", "variable", "y_geostationary", "x_geostationary")
+
+SPATIAL_COORDS = ("variable", "y_geostationary", "x_geostationary")
+
+METRICS = ("mae", "rmse", "bias", "persistence_skill", "threshold")
+
+# The default threshold of the "threshold" metric, in the units of the satellite data
+THRESHOLD = 0.5
+
+# The dims of the metrics for each reduction
+REDUCTIONS = {
+    "step": ("init_time", "step"),
+    "variable": ("init_time", "variable"),
+    "spatial": ("init_time", "y_geostationary", "x_geostationary"),
+    "region": ("init_time", "step", "region"),
+}
+
+
+def get_required_steps(steps: pd.TimedeltaIndex, metrics: tuple[str, ...]) -> pd.TimedeltaIndex:
+    """Get the steps after the init-time at which satellite data is needed to score a forecast
+
+    Args:
+        steps: The steps of the forecast
+        metrics: The metric set
+
+    Returns:
+        pd.TimedeltaIndex: The steps, including the init-time if a persistence forecast is used
+    """
+    if "persistence_skill" in metrics:
+        return steps.insert(0, pd.Timedelta(0))
+    return steps
+
+
+def _region_sums(
+    pixel_sums: np.ndarray,
+    region_labels: np.ndarray,
+    num_regions: int,
+) -> np.ndarray:
+    """Sum the values of the (init_time, step, y, x) array over each region
+
+    Args:
+        pixel_sums: The values to sum
+        region_labels: The region index of each pixel for each layer of regions with shape
+            (layer, y, x), or -1 for pixels in no region
+        num_regions: The number of regions across all the layers
+
+    Returns:
+        np.ndarray: The sums with shape (init_time, step, region)
+    """
+    flat_sums = pixel_sums.reshape(-1, region_labels[0].size)
+    region_sums = np.zeros((len(flat_sums), num_regions))
+
+    for labels in region_labels.reshape(len(region_labels), -1):
+        in_region = labels >= 0
+        # Offset the labels of each (init_time, step) so they are summed with one bincount
+        index = labels[in_region] + num_regions * np.arange(len(flat_sums))[:, None]
+        region_sums += np.bincount(
+            index.ravel(), weights=flat_sums[:, in_region].ravel(), minlength=region_sums.size,
+        ).reshape(region_sums.shape)
+
+    return region_sums.reshape(*pixel_sums.shape[:2], num_regions)
+
+
+def _sums(
+    values: np.ndarray,
+    region_labels: np.ndarray | None = None,
+    num_regions: int = 0,
+) -> dict[str, np.ndarray]:
+    """Sum the values of the (init_time, step, variable, y, x) array for each reduction"""
+    pixel_sums = values.sum(axis=2, dtype=np.float64)
+
+    sums = {
+        "step": pixel_sums.sum(axis=(2, 3)),
+        "variable": values.sum(axis=(1, 3, 4), dtype=np.float64),
+        "spatial": pixel_sums.sum(axis=1),
+    }
+
+    if region_labels is not None:
+        sums["region"] = _region_sums(pixel_sums, region_labels, num_regions)
+
+    return sums
+
+
+def _divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Divide the arrays, giving NaN where there are no valid values"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return numerator / denominator
+
+
+def _persistence_sums(
+    truth: np.ndarray,
+    truth_t0: np.ndarray,
+    region_labels: np.ndarray | None = None,
+    num_regions: int = 0,
+) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+    """Sum the absolute errors and valid counts of a persistence forecast for each reduction
+
+    This is calculated one step at a time to avoid allocating another full sized array.
+
+    Args:
+        truth: The ground truth with shape (init_time, step, variable, y, x)
+        truth_t0: The ground truth at the init-times with shape (init_time, variable, y, x)
+        region_labels: The region labels, as used in `_sums()`
+        num_regions: The number of regions
+    """
+    err = np.empty_like(truth_t0)
+    step_sums = []
+    step_counts = []
+
+    for i in range(truth.shape[1]):
+        np.subtract(truth[:, i], truth_t0, out=err)
+        np.abs(err, out=err)
+        valid = ~np.isnan(err)
+        np.nan_to_num(err, copy=False, nan=0)
+
+        step_sums.append(_sums(err[:, None], region_labels, num_regions))
+        step_counts.append(_sums(valid[:, None], region_labels, num_regions))
+
+    def combine_steps(step_values: list[dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+        return {
+            r: (
+                np.concatenate([v[r] for v in step_values], axis=1)
+                if "step" in REDUCTIONS[r] else sum(v[r] for v in step_values)
+            )
+            for r in step_values[0]
+        }
+
+    return combine_steps(step_sums), combine_steps(step_counts)
+
+
+class ForecastScorer:
+    """Scores batches of forecasts against the ground truth satellite data"""
+
+    def __init__(
+        self,
+        ds_sat: xr.Dataset,
+        ds_template: xr.Dataset,
+        metrics: tuple[str, ...] = ("mae",),
+        threshold: float = THRESHOLD,
+        regions: tuple[list[str], np.ndarray] | None = None,
+    ):
+        """Scores batches of forecasts against the ground truth satellite data
+
+        Args:
+            ds_sat: The preloaded ground truth satellite data
+            ds_template: A forecast whose step, variable and spatial coords are shared by all the
+                forecasts which will be scored
+            metrics: The metric set to calculate. Each must be one of METRICS
+            threshold: The threshold used in the "threshold" metric
+            regions: The region names and the region labels on the grid of the forecasts, as from
+                `cloudcasting_metrics.regions.load_region_labels()`. If given, the metrics are
+                also aggregated over each region
+        """
+        for metric in metrics:
+            if metric not in METRICS:
+                raise ValueError(f"Unknown metric {metric}. Must be one of {METRICS}")
+
+        self.metrics = tuple(metrics)
+        self.threshold = threshold
+
+        self.steps = pd.TimedeltaIndex(ds_template.step.values)
+        self.required_steps = get_required_steps(self.steps, self.metrics)
+        self.coords = {c: ds_template[c] for c in SPATIAL_COORDS}
+
+        self.region_labels = None
+        self.num_regions = 0
+        if regions is not None:
+            region_names, self.region_labels = regions
+            self.num_regions = len(region_names)
+            self.coords["region"] = xr.DataArray(region_names, dims="region")
+
+        self.time_index = pd.DatetimeIndex(ds_sat.time.values)
+
+        # The output dims follow the order of the satellite data, as they did when scored with
+        # xarray, so the metrics can be appended to existing archives
+        self.output_dim_order = [
+            "step" if d == "time" else d for d in ds_sat.data.dims
+        ] + ["region", "init_time"]
+
+        # Resolve the spatial and variable alignment once
+        self.da_truth = self.align(ds_sat)
+        self.load_truth()
+
+    def load_truth(self) -> None:
+        """Load all of the aligned satellite data into memory"""
+        self.truth = self.da_truth.values
+
+    def align(self, ds_sat: xr.Dataset) -> xr.DataArray:
+        """Select the satellite data on the forecast grid with dims (time, variable, y, x)"""
+        return (
+            ds_sat.data
+            .sel({c: self.coords[c].values for c in SPATIAL_COORDS})
+            .transpose("time", *SPATIAL_COORDS)
+        )
+
+    def get_offsets(self, init_times: pd.DatetimeIndex) -> np.ndarray:
+        """Get the index of the satellite time for each init-time and required step
+
+        Returns:
+            np.ndarray: Integer offsets with shape (init_time, step)
+        """
+        valid_times = (init_times.values[:, None] + self.required_steps.values[None, :]).ravel()
+        offsets = self.time_index.get_indexer(valid_times).reshape(len(init_times), -1)
+        if (offsets < 0).any():
+            raise Exception("Some valid times of the forecasts are missing in the satellite data")
+        return offsets
+
+    def get_truth(self, init_times: pd.DatetimeIndex) -> np.ndarray:
+        """Gather the ground truth for the forecasts at the required steps
+
+        Returns:
+            np.ndarray: A new array with shape (init_time, step, variable, y, x)
+        """
+        return self.truth[self.get_offsets(init_times)]
+
+    def load_forecasts(self, forecasts: list[xr.Dataset]) -> tuple[pd.DatetimeIndex, np.ndarray]:
+        """Load a batch of forecasts into one array
+
+        Returns:
+            tuple: The init-times and the forecasts with shape (init_time, step, variable, y, x)
+        """
+        init_times = []
+        y_hat = []
+
+        for ds_forecast in forecasts:
+            for c in ["step", *SPATIAL_COORDS]:
+                if not np.array_equal(ds_forecast[c].values, self.coords.get(c, self.steps).values):
+                    raise Exception(f"Forecasts have different coords: {c}")
+
+            da = ds_forecast.sat_pred.transpose("init_time", *FORECAST_DIMS)
+            init_times.append(pd.Timestamp(da.init_time.values[0]))
+            y_hat.append(da.values[0])
+
+        return pd.DatetimeIndex(init_times), np.stack(y_hat)
+
+    def score_batch(
+        self,
+        forecasts: list[xr.Dataset],
+        truth: np.ndarray | None = None,
+    ) -> xr.Dataset:
+        """Calculate the metric set of a batch of forecasts
+
+        Args:
+            forecasts: The forecasts to score
+            truth: The ground truth for the forecasts, as from `get_truth()`. This is gathered if
+                not provided. It is overwritten with the errors
+
+        Returns:
+            xr.Dataset: The metrics reduced over different dimensions
+        """
+        init_times, y_hat = self.load_forecasts(forecasts)
+
+        # Gather the ground truth for every forecast with shape (init_time, step, variable, y, x)
+        # - This is a copy, so the errors can be computed in place
+        truth = self.get_truth(init_times) if truth is None else truth
+        truth = truth.astype(np.result_type(truth, y_hat), copy=False)
+
+        dtype = truth.dtype
+        data_vars = {}
+
+        def add_metric(name: str, values: dict[str, np.ndarray]) -> None:
+            for reduction, dims in REDUCTIONS.items():
+                if reduction in values:
+                    data_vars[f"{name}_{reduction}"] = (dims, values[reduction])
+
+        if "persistence_skill" in self.metrics:
+            truth_t0, truth = truth[:, 0], truth[:, 1:]
+            persistence_sums, persistence_counts = _persistence_sums(
+                truth, truth_t0, self.region_labels, self.num_regions,
+            )
+            persistence_mae = {
+                r: _divide(persistence_sums[r], persistence_counts[r]).astype(dtype)
+                for r in persistence_sums
+            }
+
+        if "threshold" in self.metrics:
+            # Counts of the forecasts and ground truth exceeding the threshold for each channel
+            # - Comparisons with NaN are False, so missing values are not counted
+            y_hat_exceeds = y_hat >= self.threshold
+            truth_exceeds = truth >= self.threshold
+            truth_below = truth < self.threshold
+            for name, values in [
+                ("hits", y_hat_exceeds & truth_exceeds),
+                ("false_alarms", y_hat_exceeds & truth_below),
+                ("misses", ~y_hat_exceeds & truth_exceeds & ~np.isnan(y_hat)),
+            ]:
+                add_metric(name, {"variable": values.sum(axis=(1, 3, 4), dtype=np.float64)})
+            del y_hat_exceeds, truth_exceeds, truth_below
+
+        # Compute the errors in place
+        err = truth
+        np.subtract(err, y_hat, out=err)
+        del y_hat
+
+        valid = ~np.isnan(err)
+        np.nan_to_num(err, copy=False, nan=0)
+        counts = _sums(valid, self.region_labels, self.num_regions)
+        del valid
+
+        if "bias" in self.metrics:
+            # The errors are the ground truth minus the forecast
+            bias_sums = _sums(err, self.region_labels, self.num_regions)
+            add_metric(
+                "bias", {r: -_divide(bias_sums[r], counts[r]).astype(dtype) for r in counts},
+            )
+
+        np.abs(err, out=err)
+
+        if "mae" in self.metrics or "persistence_skill" in self.metrics:
+            mae_sums = _sums(err, self.region_labels, self.num_regions)
+            mae = {r: _divide(mae_sums[r], counts[r]).astype(dtype) for r in counts}
+
+        if "mae" in self.metrics:
+            add_metric("mae", mae)
+
+        if "rmse" in self.metrics:
+            np.square(err, out=err)
+            squared_sums = _sums(err, self.region_labels, self.num_regions)
+            add_metric(
+                "rmse",
+                {r: np.sqrt(_divide(squared_sums[r], counts[r])).astype(dtype) for r in counts},
+            )
+
+        if "persistence_skill" in self.metrics:
+            add_metric("persistence_mae", persistence_mae)
+            add_metric(
+                "mae_skill",
+                {r: (1 - _divide(mae[r], persistence_mae[r])).astype(dtype) for r in counts},
+            )
+
+        return xr.Dataset(
+            data_vars,
+            coords={"init_time": init_times, "step": self.steps, **self.coords},
+        )
+
+    def combine(self, ds_mae_list: list[xr.Dataset]) -> xr.Dataset:
+        """Concatenate the MAE reductions of the batches along init-time"""
+        ds_mae = xr.concat(ds_mae_list, dim="init_time")
+        return ds_mae.transpose(*[d for d in self.output_dim_order if d in ds_mae.dims])
+
+    def score(
+        self,
+        forecasts: list[xr.Dataset],
+        batch_size: int = 2,
+        num_workers: int = 1,
+    ) -> xr.Dataset:
+        """Calculate the MAE reductions of all the forecasts
+
+        Batches of forecasts are scored concurrently in threads, which share the satellite data.
+
+        Args:
+            forecasts: The forecasts to score
+            batch_size: The number of forecasts to score in each batch
+            num_workers: The number of batches to score concurrently
+
+        Returns:
+            xr.Dataset: The MAE reductions in the order of the forecasts
+        """
+        batches = [forecasts[i:i+batch_size] for i in range(0, len(forecasts), batch_size)]
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            ds_mae_list = list(tqdm(executor.map(self.score_batch, batches), total=len(batches)))
+
+        return self.combine(ds_mae_list)
+
+
+class StreamingForecastScorer(ForecastScorer):
+    """Scores batches of forecasts while streaming the ground truth satellite data
+
+    The forecasts must be scored in init-time order. The satellite frames are read as they are
+    first needed and dropped once no later forecast needs them, so each frame is read once and the
+    memory used is set by the forecast horizon rather than the number of forecasts.
+    """
+
+    def load_truth(self) -> None:
+        """Set up an empty buffer of the satellite frames, which are read as they are needed"""
+        # The frames which have been read and may still be needed, in time order
+        self.frames: dict[pd.Timestamp, np.ndarray] = {}
+        self.num_frames_read = 0
+
+    def get_truth(self, init_times: pd.DatetimeIndex) -> np.ndarray:
+        """Gather the ground truth for the forecasts, reading any frames not in the buffer
+
+        Frames before the first valid-time of these forecasts are dropped from the buffer, so the
+        forecasts must be passed in init-time order.
+
+        Returns:
+            np.ndarray: A new array with shape (init_time, step, variable, y, x)
+        """
+        offsets = self.get_offsets(init_times)
+        valid_times = self.time_index[offsets.ravel()]
+
+        if len(self.frames) > 0 and valid_times.min() < min(self.frames):
+            raise Exception("Forecasts must be scored in init-time order when streaming")
+
+        # Drop the frames which are not needed by these or later forecasts
+        for t in [t for t in self.frames if t < valid_times.min()]:
+            del self.frames[t]
+
+        # Read all the new frames in one selection
+        new_times = valid_times.unique().difference(pd.DatetimeIndex(list(self.frames)))
+        if len(new_times) > 0:
+            new_frames = self.da_truth.sel(time=new_times).values
+            self.frames.update(zip(new_times, new_frames, strict=True))
+            self.num_frames_read += len(new_times)
+
+        return np.stack([self.frames[t] for t in valid_times]).reshape(
+            *offsets.shape, *self.da_truth.shape[1:],
+        )
+
+    def score(
+        self,
+        forecasts: list[xr.Dataset],
+        batch_size: int = 2,
+        num_workers: int = 1,
+    ) -> xr.Dataset:
+        """Calculate the MAE reductions of all the forecasts
+
+        The ground truth is gathered in order in this thread. At most `num_workers` batches are
+        scored concurrently, to bound the memory used.
+
+        Args:
+            forecasts: The forecasts to score in init-time order
+            batch_size: The number of forecasts to score in each batch
+            num_workers: The number of batches to score concurrently
+
+        Returns:
+            xr.Dataset: The MAE reductions in the order of the forecasts
+        """
+        batches = [forecasts[i:i+batch_size] for i in range(0, len(forecasts), batch_size)]
+
+        ds_mae_list = []
+        futures = deque()
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for batch in tqdm(batches):
+                init_times = pd.DatetimeIndex([ds.init_time.values[0] for ds in batch])
+                futures.append(executor.submit(self.score_batch, batch, self.get_truth(init_times)))
+
+                if len(futures) >= num_workers:
+                    ds_mae_list.append(futures.popleft().result())
+
+            ds_mae_list.extend(future.result() for future in futures)
+
+        return self.combine(ds_mae_list)
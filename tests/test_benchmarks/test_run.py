@@ -0,0 +1,46 @@
+import pytest
+
+from benchmarks.run import (
+    benchmark_inference,
+    benchmark_metrics,
+    compare_results,
+    get_results_path,
+    get_version,
+)
+
+
+def test_benchmark_inference(tmp_path):
+    result = benchmark_inference(str(tmp_path), num_init_times=2)
+
+    stages = result["stages"]
+    assert {"sync_satellite", "load_satellite", "prepare_inputs", "predict", "save"} <= set(stages)
+    assert stages["predict"]["forecasts"] == 2
+    assert stages["save"]["seconds"] > 0
+
+    # The results are named by the version of the code, or its git commit if it is not installed
+    version = get_version()
+    assert version != "v?"
+    results = {"version": version, "time": "2025-01-01T12:00:00+00:00", "inference": result}
+    assert get_results_path(str(tmp_path), results) == f"{tmp_path}/{version}_20250101T120000.json"
+
+
+@pytest.mark.parametrize("forecast_source", ["files", "icechunk"])
+def test_benchmark_metrics(tmp_path, forecast_source):
+    result = benchmark_metrics(
+        str(tmp_path), num_days=2, grid_stride=32, forecast_source=forecast_source,
+    )
+
+    assert result["stages"]["score"]["forecasts"] == 96
+    assert result["peak_rss_mb"] > 0
+
+
+def test_compare_results():
+    def results(seconds, peak_rss_mb):
+        stages = {"score": {"seconds": seconds, "peak_rss_mb": peak_rss_mb}}
+        return {"metrics": {"1_days": {"stages": stages}}}
+
+    assert compare_results(results(1.0, 100), results(1.1, 110)) == []
+    assert compare_results(results(1.0, 100), results(2.0, 300)) == [
+        "metrics 1_days score seconds: 1.0 -> 2.0",
+        "metrics 1_days score peak_rss_mb: 100 -> 300",
+    ]
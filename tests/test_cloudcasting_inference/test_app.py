@@ -1,16 +1,30 @@
+import json
 import os
 
+import fsspec
 import numpy as np
+import pandas as pd
+import pytest
 import xarray as xr
 import zarr
+from fsspec.implementations.local import LocalFileSystem
 
-from cloudcasting_inference.app import app
+from cloudcasting_inference.app import (
+    app,
+    open_latest_forecast,
+    publish_latest,
+    save_forecast,
+)
+from tests.utils import make_sat_data
 
 
-def test_app(sat_5_data, tmp_path, init_time):
+@pytest.mark.parametrize("direct_read", ["false", "true"])
+def test_app(sat_5_data, tmp_path, init_time, direct_read, monkeypatch):
 
     os.chdir(tmp_path)
 
+    monkeypatch.setenv("SATELLITE_DIRECT_READ", direct_read)
+
     # In production sat zarr is zipped
     os.environ["SATELLITE_ZARR_PATH"] = "temp_sat.zarr.zip"
 
@@ -44,3 +58,134 @@ def test_app(sat_5_data, tmp_path, init_time):
 
     # Make sure all of the predictions are finite
     assert np.isfinite(ds_y_hat.sat_pred).all()
+
+    # The forecast is chunked by step and variable
+    assert ds_y_hat.sat_pred.encoding["chunks"][:3]==(1, 1, 1)
+
+
+def test_app_multiple_init_times(tmp_path, init_time, monkeypatch):
+
+    os.chdir(tmp_path)
+
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", f"{tmp_path}")
+    monkeypatch.setenv("INFERENCE_SUMMARY_PATH", f"{tmp_path}/summary.json")
+
+    # Satellite data which covers the inputs for the two latest init-times
+    times = pd.date_range(init_time - pd.Timedelta("195min"), init_time, freq="5min")
+    with zarr.storage.ZipStore("temp_sat.zarr.zip", mode="x") as store:
+        make_sat_data(times).to_zarr(store)
+
+    # The earliest init-time does not have all the satellite data required so is skipped
+    init_times = [init_time - pd.Timedelta(f"{30*i}min") for i in range(3)]
+    app(init_times, batch_size=1)
+
+    for t in init_times[:2]:
+        assert os.path.exists(t.strftime(f"{tmp_path}/%Y-%m-%dT%H:%M.zarr"))
+    assert not os.path.exists(init_times[2].strftime(f"{tmp_path}/%Y-%m-%dT%H:%M.zarr"))
+
+    # Only the most recent forecast is saved as the latest
+    ds_y_hat = xr.open_zarr(f"{tmp_path}/latest.zarr")
+    assert ds_y_hat.init_time == init_time
+
+    # The stages of the run are summarised
+    with open(f"{tmp_path}/summary.json") as f:
+        stages = {s["stage"]: s for s in json.load(f)["stages"]}
+    assert {"sync_satellite", "load_satellite", "prepare_data", "predict", "save"} <= set(stages)
+    assert stages["predict"]["forecasts"] == 2
+
+    # Catching up on an older init-time does not replace the newer latest forecast
+    app(init_times[1])
+    ds_y_hat = xr.open_zarr(f"{tmp_path}/latest.zarr")
+    assert ds_y_hat.init_time == init_time
+
+
+def test_app_tiled(tmp_path, init_time, monkeypatch):
+
+    os.chdir(tmp_path)
+
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", f"{tmp_path}")
+    monkeypatch.setenv("INFERENCE_SUMMARY_PATH", f"{tmp_path}/summary.json")
+    monkeypatch.setenv("INFERENCE_DOMAIN", "-30,35,30,78")
+
+    # Satellite data which covers a wider area than the model input
+    pad = 30
+    ds = make_sat_data(pd.date_range(init_time - pd.Timedelta("3h"), init_time, freq="5min"))
+    extended_coords = {}
+    for dim in ["x_geostationary", "y_geostationary"]:
+        coord = ds[dim].values
+        step = coord[1] - coord[0]
+        extended_coords[dim] = np.concatenate(
+            [coord[0] + step * np.arange(-pad, 0), coord, coord[-1] + step * np.arange(1, pad + 1)],
+        )
+    ds = ds.reindex(extended_coords, fill_value=0)
+
+    with zarr.storage.ZipStore("temp_sat.zarr.zip", mode="x") as store:
+        ds.to_zarr(store)
+
+    app(init_time)
+
+    # The forecast covers the whole domain, which is made of 2x2 tiles
+    ds_y_hat = xr.open_zarr(f"{tmp_path}/latest.zarr")
+    assert ds_y_hat.sizes["y_geostationary"]==372 + 2 * pad
+    assert ds_y_hat.sizes["x_geostationary"]==614 + 2 * pad
+    assert (ds_y_hat.x_geostationary==ds.x_geostationary).all()
+    assert np.isfinite(ds_y_hat.sat_pred).all()
+
+    with open(f"{tmp_path}/summary.json") as f:
+        stages = {s["stage"]: s for s in json.load(f)["stages"]}
+    assert stages["predict"]["tiles"] == 4
+
+
+@pytest.mark.parametrize("out_dir", ["local", "memory://forecasts"])
+def test_publish_latest(sat_5_data, tmp_path, out_dir):
+
+    if out_dir=="local":
+        out_dir = str(tmp_path)
+
+    fs = fsspec.open(out_dir).fs
+
+    ds = sat_5_data.isel(time=slice(0, 2))
+    for i in range(2):
+        t0 = pd.Timestamp(ds.time.values[i])
+        ds.isel(time=[i]).to_zarr(f"{out_dir}/{i}.zarr")
+        publish_latest(fs, f"{out_dir}/{i}.zarr", f"{out_dir}/latest.zarr", t0)
+
+        # The forecast is not copied, the pointer names it
+        with fs.open(f"{out_dir}/latest.json") as f:
+            assert json.load(f) == {"path": f"{i}.zarr", "init_time": t0.isoformat()}
+
+        ds_latest = open_latest_forecast(f"{out_dir}/latest.zarr")
+        assert ds_latest.time.values==ds.time.values[i]
+
+        # The latest path can still be opened directly. On a local filesystem it is a symlink to
+        # the forecast
+        assert xr.open_zarr(f"{out_dir}/latest.zarr").time.values==ds.time.values[i]
+        assert os.path.islink(f"{out_dir}/latest.zarr") == isinstance(fs, LocalFileSystem)
+
+
+@pytest.mark.parametrize("out_dir", ["local", "memory://forecasts_rerun"])
+def test_save_forecast_rerun(sat_5_data, tmp_path, out_dir, monkeypatch):
+
+    if out_dir=="local":
+        out_dir = str(tmp_path)
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", out_dir)
+
+    t0 = pd.Timestamp(sat_5_data.time.values[-1])
+    ds = sat_5_data.isel(time=-1)
+    y_hat = np.zeros(
+        (len(ds.variable), 12, len(ds.y_geostationary), len(ds.x_geostationary)), dtype=np.float32,
+    )
+
+    save_forecast(y_hat, t0, ds, use_5_minute=True)
+
+    # Make the forecast again while the first one is published
+    save_forecast(y_hat + 1, t0, ds, use_5_minute=True)
+
+    ds_latest = open_latest_forecast(f"{out_dir}/latest.zarr")
+    assert (ds_latest.sat_pred==1).all()
+    assert (xr.open_zarr(f"{out_dir}/latest.zarr").sat_pred==1).all()
+
+    fs = fsspec.open(out_dir).fs
+    assert not fs.exists(t0.strftime(f"{out_dir}/%Y-%m-%dT%H:%M.zarr.staging"))
@@ -0,0 +1,84 @@
+import icechunk
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from cloudcasting_inference import archive
+from cloudcasting_inference.archive import append_forecast, get_icechunk_storage
+
+
+def make_forecast(init_time, value):
+    return xr.Dataset(
+        {"sat_pred": (
+            ("init_time", "variable", "step", "y_geostationary", "x_geostationary"),
+            np.full((1, 2, 12, 4, 5), value, dtype=np.float32),
+        )},
+        coords={
+            "init_time": [init_time],
+            "variable": ["IR_016", "IR_039"],
+            "step": pd.timedelta_range(start="15min", end="180min", freq="15min"),
+            "y_geostationary": np.arange(4.),
+            "x_geostationary": np.arange(5.),
+        },
+    )
+
+
+def open_archive(path, group=None):
+    repo = icechunk.Repository.open(get_icechunk_storage(path))
+    return xr.open_zarr(repo.readonly_session("main").store, group=group)
+
+
+def test_append_forecast(tmp_path, init_time):
+
+    path = f"{tmp_path}/forecasts.icechunk"
+    init_times = [init_time - pd.Timedelta("30min"), init_time]
+
+    for i, t in enumerate(init_times):
+        append_forecast(make_forecast(t, i), path)
+
+    ds = open_archive(path)
+    assert (ds.init_time.values==pd.DatetimeIndex(init_times)).all()
+    assert (ds.sat_pred.sel(init_time=init_times[1])==1).all()
+
+    # Re-running an init-time overwrites it in place
+    append_forecast(make_forecast(init_times[1], 5), path)
+
+    ds = open_archive(path)
+    assert len(ds.init_time)==2
+    assert (ds.sat_pred.sel(init_time=init_times[1])==5).all()
+
+    # Forecasts from the 15-minutely data are saved in their own group
+    append_forecast(make_forecast(init_time, 2), path, group="0-deg")
+    assert len(open_archive(path, group="0-deg").init_time)==1
+    assert len(open_archive(path).init_time)==2
+
+    # A new init-time before the last init-time in the archive is refused, so the archive can
+    # still be sliced by init-time
+    with pytest.raises(ValueError):
+        append_forecast(make_forecast(init_time - pd.Timedelta("1h"), 3), path)
+
+    ds = open_archive(path)
+    assert len(ds.sel(init_time=slice(init_times[0], init_times[1])).init_time)==2
+
+
+def test_append_forecast_conflict(tmp_path, init_time, monkeypatch):
+
+    path = f"{tmp_path}/forecasts.icechunk"
+    init_times = [init_time - pd.Timedelta(f"{30*i}min") for i in range(3)][::-1]
+    append_forecast(make_forecast(init_times[0], 0), path)
+
+    # Another writer appends a forecast after we have written ours but before we commit
+    def to_icechunk(*args, **kwargs):
+        monkeypatch.setattr(archive, "to_icechunk", real_to_icechunk)
+        real_to_icechunk(*args, **kwargs)
+        append_forecast(make_forecast(init_times[1], 1), path)
+
+    real_to_icechunk = archive.to_icechunk
+    monkeypatch.setattr(archive, "to_icechunk", to_icechunk)
+
+    append_forecast(make_forecast(init_times[2], 2), path)
+
+    ds = open_archive(path)
+    assert (ds.init_time.values==pd.DatetimeIndex(init_times)).all()
+    assert (ds.sat_pred.values[:, 0, 0, 0, 0]==[0, 1, 2]).all()
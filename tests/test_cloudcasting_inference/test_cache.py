@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pandas as pd
+import zarr
+
+from cloudcasting_inference import cache as cache_module
+from cloudcasting_inference.cache import FrameCache, ModelCache, SatelliteCache, open_sat_zarr
+
+
+def test_open_sat_zarr(sat_5_data, tmp_path):
+
+    zip_path = f"{tmp_path}/sat.zarr.zip"
+    with zarr.storage.ZipStore(zip_path, mode="x") as store:
+        sat_5_data.to_zarr(store)
+
+    ds = open_sat_zarr(zip_path)
+    assert (ds.time.values==sat_5_data.time.values).all()
+
+
+def test_satellite_cache(sat_5_data, tmp_path, init_time):
+
+    cache = SatelliteCache(f"{tmp_path}/cache", max_age=pd.Timedelta("60min"))
+
+    # Remote archive which does not yet contain the last frame
+    zip_path = f"{tmp_path}/sat_1.zarr.zip"
+    with zarr.storage.ZipStore(zip_path, mode="x") as store:
+        sat_5_data.isel(time=slice(None, -1)).to_zarr(store)
+
+    # Only the frames within the cache window are synced
+    new_times = cache.sync(zip_path, init_time)
+    expected_times = pd.date_range(init_time - pd.Timedelta("60min"), init_time, freq="5min")[:-1]
+    assert (new_times==expected_times).all()
+    assert (cache.timestamps==expected_times).all()
+
+    # Syncing again from the full remote only fetches the new frame
+    zip_path = f"{tmp_path}/sat_2.zarr.zip"
+    with zarr.storage.ZipStore(zip_path, mode="x") as store:
+        sat_5_data.to_zarr(store)
+
+    new_times = cache.sync(zip_path, init_time)
+    assert (new_times==pd.DatetimeIndex([init_time])).all()
+
+    ds = cache.open()
+    assert (ds.time.values==expected_times.append(new_times)).all()
+    assert ds.data.attrs["area"]==sat_5_data.data.attrs["area"]
+
+    # Frames too old for the next init-time are evicted
+    old_times = cache.evict(init_time + pd.Timedelta("30min"))
+    assert len(old_times)==6
+    assert not os.path.exists(cache.frame_path(old_times[0]))
+    assert cache.timestamps.min()==init_time - pd.Timedelta("30min")
+
+
+def test_frame_cache(tmp_path, init_time):
+
+    cache = FrameCache(f"{tmp_path}/frames", max_age=pd.Timedelta("60min"))
+    cache.validate("key_1")
+
+    times = pd.date_range(init_time - pd.Timedelta("90min"), init_time, freq="15min")
+    frames = np.random.default_rng(0).random((len(times), 2, 3, 4))
+    for t, frame in zip(times, frames):
+        cache.put(t, frame)
+
+    assert (cache.timestamps==times).all()
+
+    loaded = cache.load(times[-2:])
+    assert isinstance(loaded[0], np.memmap)
+    assert loaded[0].dtype==np.float32
+    np.testing.assert_array_equal(loaded[1], frames[-1].astype(np.float32))
+
+    # Frames too old for the next init-time are evicted
+    old_times = cache.evict(init_time)
+    assert (old_times==times[:2]).all()
+    assert not os.path.exists(cache.frame_path(old_times[0]))
+
+    # The frames are removed if the grid or channels change
+    cache.validate("key_1")
+    assert len(cache.timestamps)==len(times) - 2
+    cache.validate("key_2")
+    assert len(cache.timestamps)==0
+    assert not os.path.exists(cache.frame_path(times[-1]))
+
+
+def test_model_cache(tmp_path, monkeypatch):
+    for name, contents in [("config.yaml", b"config"), ("weights", b"weights"), ("copy", b"config")]:
+        with open(f"{tmp_path}/{name}", "wb") as f:
+            f.write(contents)
+
+    cache = ModelCache(f"{tmp_path}/model_cache")
+    assert cache.get("org/model", "rev_1") is None
+
+    files = {name: f"{tmp_path}/{name}" for name in ["config.yaml", "weights", "copy"]}
+    paths = cache.put("org/model", "rev_1", files)
+    assert cache.get("org/model", "rev_1")==paths
+    assert cache.get("org/model", "rev_2") is None
+
+    # Files with the same contents are stored once
+    assert paths["config.yaml"]==paths["copy"]
+    with open(paths["weights"], "rb") as f:
+        assert f.read()==b"weights"
+
+    # The checksums are only checked again once the files are modified
+    def file_checksum(path):
+        raise AssertionError("The checksum should not be checked again")
+
+    with monkeypatch.context() as m:
+        m.setattr(cache_module, "_file_checksum", file_checksum)
+        assert cache.get("org/model", "rev_1")==paths
+
+    # Corrupt files are detected by their checksum, or only by their size if not verifying
+    with open(paths["weights"], "wb") as f:
+        f.write(b"corrupt")
+    assert cache.get("org/model", "rev_1", verify=False)==paths
+    assert cache.get("org/model", "rev_1") is None
+
+    os.remove(paths["weights"])
+    assert cache.get("org/model", "rev_1") is None
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+import zarr
+
+from cloudcasting_inference.cli import validate_inputs
+from tests.utils import make_sat_data
+
+# Libraries which are slow to import and should only be imported by the subcommands using them
+HEAVY_MODULES = [
+    "torch", "huggingface_hub", "hydra", "safetensors", "icechunk", "s3fs", "ocf_data_sampler",
+]
+
+# Runs the CLI and reports which of the heavy libraries were imported
+CLI_SCRIPT = f"""
+import sys
+from cloudcasting_inference.cli import main
+try:
+    main(sys.argv[1:])
+finally:
+    loaded = [m for m in {HEAVY_MODULES} if m in sys.modules]
+    print("LOADED_MODULES=" + ",".join(loaded), file=sys.stderr)
+"""
+
+
+def run_cli(*args: str) -> tuple[int, list[str]]:
+    # Use the same import paths as the tests, since the working directory may have changed
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    result = subprocess.run(
+        [sys.executable, "-c", CLI_SCRIPT, *args],
+        capture_output=True, text=True, check=False, env=env,
+    )
+    line = next(l for l in result.stderr.splitlines() if l.startswith("LOADED_MODULES="))
+    loaded = line.removeprefix("LOADED_MODULES=")
+    return result.returncode, loaded.split(",") if loaded else []
+
+
+@pytest.fixture()
+def sat_5_zip(tmp_path, monkeypatch, sat_5_data):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", "predictions")
+    with zarr.storage.ZipStore("temp_sat.zarr.zip", mode="x") as store:
+        sat_5_data.to_zarr(store)
+
+
+def test_help_imports_no_heavy_modules():
+    returncode, loaded = run_cli("--help")
+    assert returncode == 0
+    assert loaded == []
+
+
+def test_validate_inputs(sat_5_zip, init_time):
+    assert validate_inputs([str(init_time)])
+    assert not validate_inputs([str(init_time + pd.Timedelta("30min"))])
+
+
+def test_validate_inputs_cli(sat_5_zip, init_time):
+    returncode, loaded = run_cli("validate-inputs", "--init-time", str(init_time))
+    assert returncode == 0
+    assert loaded == []
+
+    returncode, _ = run_cli("dry-run", "--init-time", str(init_time + pd.Timedelta("30min")))
+    assert returncode == 1
+
+
+def test_validate_inputs_missing_env_var(sat_5_zip, init_time, monkeypatch):
+    monkeypatch.delenv("PREDICTION_SAVE_DIRECTORY")
+    assert not validate_inputs([str(init_time)])
@@ -0,0 +1,87 @@
+import os
+
+import pandas as pd
+import zarr
+
+from cloudcasting_inference import daemon
+from cloudcasting_inference.daemon import run_cycle, run_daemon, satellite_frame_available
+
+
+def test_run_daemon(sat_5_data, tmp_path, init_time, monkeypatch):
+
+    os.chdir(tmp_path)
+
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", f"{tmp_path}")
+    monkeypatch.setenv("DAEMON_POLL_INTERVAL", "1s")
+
+    with zarr.storage.ZipStore("temp_sat.zarr.zip", mode="x") as store:
+        sat_5_data.to_zarr(store)
+
+    assert satellite_frame_available(init_time)
+    assert not satellite_frame_available(init_time + pd.Timedelta("30min"))
+
+    run_daemon(max_cycles=1)
+
+    assert os.path.exists(init_time.strftime(f"{tmp_path}/%Y-%m-%dT%H:%M.zarr"))
+
+
+def test_run_cycle_late_frame(monkeypatch):
+    # The cycle starts before the init-time, and the frame at the init-time lands late
+    t0 = pd.Timestamp("2024-06-01 12:00")
+    frame_landed = t0 + pd.Timedelta("4min")
+    clock = {"now": t0 - pd.Timedelta("10min")}
+    attempts = []
+
+    def sleep(seconds):
+        clock["now"] += pd.Timedelta(seconds=seconds)
+
+    def app(t0, model):
+        attempts.append(clock["now"])
+        # The first attempt fails, e.g. as the 15-minutely frames have not landed yet
+        if len(attempts) == 1:
+            raise ValueError("Some required timestamps missing")
+
+    monkeypatch.setattr(daemon, "_now", lambda: clock["now"])
+    monkeypatch.setattr(daemon.time, "sleep", sleep)
+    monkeypatch.setattr(daemon, "satellite_frame_available", lambda t: clock["now"] >= frame_landed)
+    monkeypatch.setattr(daemon, "app", app)
+
+    poll_interval = pd.Timedelta("30s")
+
+    assert run_cycle(t0, None, t0 + pd.Timedelta("20min"), poll_interval)
+    assert attempts == [frame_landed, frame_landed + poll_interval]
+
+    # The frame for the next init-time never lands, so we give up at the deadline
+    frame_landed = t0 + pd.Timedelta("1h")
+    t1 = t0 + pd.Timedelta("30min")
+
+    assert not run_cycle(t1, None, t1 + pd.Timedelta("20min"), poll_interval)
+    assert len(attempts) == 2
+    assert clock["now"] == t1 + pd.Timedelta("20min")
+
+
+def test_run_cycle_poll_error(monkeypatch):
+    t0 = pd.Timestamp("2024-06-01 12:00")
+    clock = {"now": t0}
+    polls = []
+
+    def sleep(seconds):
+        clock["now"] += pd.Timedelta(seconds=seconds)
+
+    def satellite_frame_available(t):
+        polls.append(clock["now"])
+        # The first poll fails, e.g. due to a transient network error
+        if len(polls) == 1:
+            raise OSError("Connection reset")
+        return True
+
+    monkeypatch.setattr(daemon, "_now", lambda: clock["now"])
+    monkeypatch.setattr(daemon.time, "sleep", sleep)
+    monkeypatch.setattr(daemon, "satellite_frame_available", satellite_frame_available)
+    monkeypatch.setattr(daemon, "app", lambda t0, model: None)
+
+    poll_interval = pd.Timedelta("30s")
+
+    assert run_cycle(t0, None, t0 + pd.Timedelta("20min"), poll_interval)
+    assert polls == [t0, t0 + poll_interval]
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import zarr
+
+from cloudcasting_inference.cache import INPUT_WINDOW
+from cloudcasting_inference.data import (
+    SatelliteDownloader,
+    get_batched_input_data,
+    get_input_data,
+)
+from tests.utils import make_sat_data
+
+
+def test_get_batched_input_data(sat_5_data, init_time):
+
+    ds = sat_5_data.transpose("variable", "time", "y_geostationary", "x_geostationary")
+    ds["data"] = ds.data.copy(data=np.random.default_rng(0).random(ds.data.shape))
+
+    init_times = pd.DatetimeIndex([init_time - pd.Timedelta("30min"), init_time])
+
+    X = get_batched_input_data(ds, init_times)
+
+    assert X.shape==(2, *get_input_data(ds, init_time).shape)
+    for i, t0 in enumerate(init_times):
+        assert (X[i]==get_input_data(ds, t0)).all()
+
+
+def test_prepared_frames_reused(tmp_path, init_time, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+
+    # Satellite data which covers the inputs for the two latest init-times
+    ds = make_sat_data(pd.date_range(init_time - pd.Timedelta("195min"), init_time, freq="5min"))
+    ds["data"] = ds.data.copy(data=np.random.default_rng(0).random(ds.data.shape))
+    ds["data"][-1, 0, 0, 0] = np.nan
+    with zarr.storage.ZipStore("temp_sat.zarr.zip", mode="x") as store:
+        ds.to_zarr(store)
+
+    init_times = [init_time - pd.Timedelta("30min"), init_time]
+
+    # The first run prepares all the frames, and the second only the new frames
+    for t0, expected_new_frames in zip(init_times, [12, 2]):
+        downloader = SatelliteDownloader()
+        ds_prepared = downloader.prepare_satellite_data(t0)
+
+        stages = {s.name: s for s in downloader.recorder.stages}
+        assert stages["prepare_frames"].counts["frames"]==expected_new_frames
+
+    # The inputs match those made from the satellite data directly
+    X = get_batched_input_data(ds_prepared, pd.DatetimeIndex([init_time]))
+
+    monkeypatch.setenv("SATELLITE_DIRECT_READ", "true")
+    ds_direct = SatelliteDownloader().prepare_satellite_data(init_time)
+
+    assert (X[0]==get_input_data(ds_direct, init_time)).all()
+
+
+def test_only_chosen_source_synced(tmp_path, init_time, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+    monkeypatch.setenv("SATELLITE_15_ZARR_PATH", "temp_sat_15.zarr.zip")
+
+    # The 15-minutely data lags the 5-minutely data so the 5-minutely data is used
+    start = init_time - pd.Timedelta("4h")
+    lagged_end = init_time - pd.Timedelta("15min")
+    for path, times in [
+        ("temp_sat.zarr.zip", pd.date_range(start, init_time, freq="5min")),
+        ("temp_sat_15.zarr.zip", pd.date_range(start, lagged_end, freq="15min")),
+    ]:
+        with zarr.storage.ZipStore(path, mode="x") as store:
+            make_sat_data(times).to_zarr(store)
+
+    downloader = SatelliteDownloader()
+    ds = downloader.prepare_satellite_data(init_time)
+
+    assert downloader.use_5_minute
+
+    # Only the input frames of the 5-minutely data are fetched
+    expected_times = pd.date_range(init_time - INPUT_WINDOW, init_time, freq="15min")
+    assert (pd.DatetimeIndex(ds.time.values)==expected_times).all()
+    assert (downloader.sat_5_cache.timestamps==expected_times).all()
+    assert len(downloader.sat_15_cache.timestamps)==0
+
+    stages = [s for s in downloader.recorder.stages if s.name=="sync_satellite"]
+    assert [s.fields["source"] for s in stages]==["5-min"]
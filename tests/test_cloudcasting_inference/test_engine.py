@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from cloudcasting_inference import engine
+from cloudcasting_inference.engine import (
+    Int8WeightConv,
+    check_equivalence,
+    compile_model,
+    get_example_input,
+    set_precision,
+)
+
+
+class ConvModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(11, 11, kernel_size=(1, 3, 3), padding=(0, 1, 1))
+
+    def forward(self, x):
+        return torch.sigmoid(self.conv(x))
+
+
+def test_compile_model_torchscript(tmp_path):
+
+    model = ConvModel().eval()
+
+    compiled = compile_model(model, "torchscript", cache_dir=f"{tmp_path}/compiled")
+
+    assert isinstance(compiled, torch.jit.ScriptModule)
+    assert len(os.listdir(f"{tmp_path}/compiled"))==1
+    assert check_equivalence(model, compiled) < 1e-4
+
+    # The second time the compiled model is loaded from the cache
+    compiled = compile_model(model, "torchscript", cache_dir=f"{tmp_path}/compiled")
+    assert isinstance(compiled, torch.jit.ScriptModule)
+
+
+def test_compile_model_eager(tmp_path):
+    model = ConvModel().eval()
+    assert compile_model(model, "eager", cache_dir=f"{tmp_path}/compiled") is model
+
+
+class LinearModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(614, 614)
+
+    def forward(self, x):
+        return torch.sigmoid(self.linear(x))
+
+
+@pytest.fixture()
+def reference_input(tmp_path, monkeypatch):
+    path = f"{tmp_path}/reference_input.npy"
+    np.save(path, get_example_input()[0].numpy())
+    monkeypatch.setenv("INFERENCE_REFERENCE_INPUT", path)
+
+
+def test_set_precision(reference_input):
+    model = ConvModel().eval()
+
+    assert set_precision(model, "fp32") is model
+
+    model_bf16 = set_precision(model, "bf16")
+    assert model_bf16(get_example_input()).dtype==torch.float32
+
+    # The accuracy gate refuses the reduced precision model if the threshold is too strict
+    with pytest.raises(ValueError):
+        set_precision(model, "bf16", max_mae=0)
+
+    # The weights of the convolutions are stored in int8
+    model_int8 = set_precision(ConvModel().eval(), "int8")
+    assert isinstance(model_int8.conv, Int8WeightConv)
+    assert model_int8.conv.weight_int8.dtype==torch.int8
+
+    model_int8 = set_precision(LinearModel().eval(), "int8")
+    assert isinstance(model_int8.linear, torch.ao.nn.quantized.dynamic.Linear)
+
+    # A model with no layers which can be quantised is refused
+    with pytest.raises(ValueError):
+        set_precision(torch.nn.Sequential(torch.nn.Sigmoid()), "int8")
+
+
+def test_set_precision_requires_reference_input(monkeypatch):
+    monkeypatch.delenv("INFERENCE_REFERENCE_INPUT", raising=False)
+    with pytest.raises(ValueError):
+        set_precision(ConvModel().eval(), "bf16")
+
+
+def test_set_precision_cached_gate(reference_input, tmp_path, monkeypatch):
+    set_precision(ConvModel().eval(), "int8", cache_dir=f"{tmp_path}/gate")
+    assert os.path.exists(f"{tmp_path}/gate/accuracy_gate.json")
+
+    # The second time the result of the accuracy check is read from the cache
+    def check_accuracy(*args, **kwargs):
+        raise AssertionError("The accuracy check should not be rerun")
+
+    monkeypatch.setattr(engine, "check_accuracy", check_accuracy)
+    model_int8 = set_precision(ConvModel().eval(), "int8", cache_dir=f"{tmp_path}/gate")
+    assert isinstance(model_int8.conv, Int8WeightConv)
+
+    # But the cached result is still checked against the maximum MAE
+    with pytest.raises(ValueError):
+        set_precision(ConvModel().eval(), "int8", max_mae=0, cache_dir=f"{tmp_path}/gate")
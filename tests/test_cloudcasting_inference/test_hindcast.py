@@ -0,0 +1,48 @@
+import os
+
+import icechunk
+import numpy as np
+import pandas as pd
+import xarray as xr
+from icechunk.xarray import to_icechunk
+
+from cloudcasting_inference.hindcast import hindcast
+from tests.utils import make_sat_data
+
+
+def test_hindcast(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SATELLITE_ICECHUNK_ARCHIVE", f"{tmp_path}/sat.icechunk")
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", f"{tmp_path}/predictions")
+    monkeypatch.setenv("INFERENCE_HINDCAST_CHUNK_SIZE", "2")
+    os.makedirs(f"{tmp_path}/predictions")
+
+    # An archive of historical satellite data which covers the inputs of 3 init-times
+    start = pd.Timestamp("2024-06-01 09:00")
+    end = pd.Timestamp("2024-06-01 10:00")
+    times = pd.date_range(start - pd.Timedelta("165min"), end, freq="15min")
+
+    repo = icechunk.Repository.create(icechunk.local_filesystem_storage(f"{tmp_path}/sat.icechunk"))
+    session = repo.writable_session("main")
+    to_icechunk(make_sat_data(times), session)
+    session.commit("Add satellite data")
+
+    # The earliest init-time does not have all its inputs in the archive so is skipped
+    init_times = pd.date_range(start - pd.Timedelta("30min"), end, freq="30min")
+    hindcast(init_times[0], init_times[-1])
+
+    for t in init_times[1:]:
+        ds_y_hat = xr.open_zarr(t.strftime(f"{tmp_path}/predictions/%Y-%m-%dT%H:%M.zarr"))
+        assert ds_y_hat.init_time == t
+        assert len(ds_y_hat.step)==12
+        assert np.isfinite(ds_y_hat.sat_pred).all()
+
+    assert not os.path.exists(init_times[0].strftime(f"{tmp_path}/predictions/%Y-%m-%dT%H:%M.zarr"))
+    assert not os.path.exists(f"{tmp_path}/predictions/latest.zarr")
+
+    # The forecasts which have already been made are skipped when the hindcast is rerun
+    def model(X):
+        raise AssertionError("The model should not be run")
+
+    hindcast(init_times[0], init_times[-1], model=model)
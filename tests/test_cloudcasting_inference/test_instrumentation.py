@@ -0,0 +1,47 @@
+import json
+import sys
+
+import numpy as np
+import pytest
+
+from cloudcasting_inference.instrumentation import StageRecorder
+
+
+def test_stage_recorder(tmp_path):
+    summary_path = f"{tmp_path}/summary.json"
+    recorder = StageRecorder(summary_path=summary_path)
+
+    with recorder.stage("outer", day="2024-01-01") as outer:
+        with recorder.stage("inner") as inner:
+            # Allocate and touch 64MB
+            x = np.ones(2**23)
+            inner.add(frames=2)
+            inner.add(frames=3)
+            del x
+
+        with open(f"{tmp_path}/data.bin", "wb") as f:
+            f.write(b"0" * 2**20)
+
+    with pytest.raises(ValueError), recorder.stage("failed"):
+        raise ValueError
+
+    assert [s.name for s in recorder.stages] == ["inner", "outer", "failed"]
+    assert inner.counts == {"frames": 5}
+    assert outer.seconds >= inner.seconds
+
+    # The memory of the outer stage includes the inner stage
+    assert inner.peak_rss_bytes >= 2**26
+    assert outer.peak_rss_bytes >= inner.peak_rss_bytes
+
+    if sys.platform == "linux":
+        assert outer.bytes_written >= 2**20
+
+    recorder.write_summary()
+    with open(summary_path) as f:
+        summary = json.load(f)
+
+    assert [s["stage"] for s in summary["stages"]] == ["inner", "outer", "failed"]
+    assert summary["stages"][0]["frames"] == 5
+    assert summary["stages"][1]["day"] == "2024-01-01"
+    assert summary["peak_rss_mb"] >= 64
+    assert set(recorder.timings) == {"inner_seconds", "outer_seconds", "failed_seconds"}
@@ -0,0 +1,61 @@
+import pytest
+import torch
+import yaml
+from safetensors.torch import save_model
+
+from cloudcasting_inference import model as model_module
+from cloudcasting_inference.model import (
+    MODEL_CONFIG_FILE,
+    MODEL_WEIGHTS_FILE,
+    get_model_files,
+    load_model,
+)
+
+
+@pytest.fixture()
+def model_dir(tmp_path):
+    model = torch.nn.Conv3d(2, 2, kernel_size=1)
+    save_model(model, f"{tmp_path}/{MODEL_WEIGHTS_FILE}")
+
+    config = {"_target_": "torch.nn.Conv3d", "in_channels": 2, "out_channels": 2, "kernel_size": 1}
+    with open(f"{tmp_path}/{MODEL_CONFIG_FILE}", "w") as f:
+        yaml.safe_dump(config, f)
+
+    return tmp_path, model
+
+
+def test_load_model(model_dir):
+    path, model = model_dir
+
+    loaded = load_model(f"{path}/{MODEL_CONFIG_FILE}", f"{path}/{MODEL_WEIGHTS_FILE}")
+
+    assert set(loaded.state_dict())==set(model.state_dict())
+    for key, value in model.state_dict().items():
+        assert loaded.state_dict()[key].device.type=="cpu"
+        assert torch.equal(loaded.state_dict()[key], value)
+
+
+def test_get_model_files(model_dir, tmp_path, monkeypatch):
+    path, _ = model_dir
+    monkeypatch.setenv("INFERENCE_MODEL_CACHE_DIR", f"{tmp_path}/model_cache")
+
+    calls = []
+
+    def snapshot_download(**kwargs):
+        calls.append(kwargs)
+        return str(path)
+
+    monkeypatch.setattr(model_module, "snapshot_download", snapshot_download)
+
+    # The hub is only contacted the first time the revision is used
+    paths = get_model_files()
+    assert get_model_files()==paths
+    assert len(calls)==1
+    assert not calls[0]["local_files_only"]
+
+    assert load_model(paths[MODEL_CONFIG_FILE], paths[MODEL_WEIGHTS_FILE]) is not None
+
+    # In offline mode only local files are used
+    monkeypatch.setenv("INFERENCE_MODEL_CACHE_DIR", f"{tmp_path}/other_model_cache")
+    get_model_files(offline=True)
+    assert calls[1]["local_files_only"]
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import zarr
+
+from cloudcasting_inference.app import app
+from cloudcasting_inference.pyramid import make_pyramid, parse_pyramid_factors
+
+
+def test_parse_pyramid_factors():
+    assert parse_pyramid_factors(None) == []
+    assert parse_pyramid_factors("2,4,8") == [2, 4, 8]
+
+    with pytest.raises(ValueError):
+        parse_pyramid_factors("2,3")
+
+
+def test_make_pyramid():
+    values = np.random.default_rng(0).random((1, 2, 3, 10, 13)).astype(np.float32)
+    ds_y_hat = xr.DataArray(
+        values,
+        dims=["init_time", "variable", "step", "y_geostationary", "x_geostationary"],
+        coords={
+            "init_time": [pd.Timestamp("2024-06-01 12:00")],
+            "variable": ["IR_016", "VIS006"],
+            "step": pd.timedelta_range("15min", periods=3, freq="15min"),
+            "y_geostationary": np.arange(10) * 3000.0,
+            "x_geostationary": np.arange(13) * -3000.0,
+        },
+        attrs={"units": "1"},
+    ).to_dataset(name="sat_pred")
+
+    levels = make_pyramid(ds_y_hat, [2, 4])
+    assert list(levels) == ["pyramid_2", "pyramid_4"]
+
+    # Each level is the block mean, where the blocks at the ends are averaged over fewer pixels
+    expected = ds_y_hat.coarsen(y_geostationary=4, x_geostationary=4, boundary="pad").mean()
+
+    ds_level = levels["pyramid_4"]
+    assert ds_level.sat_pred.shape == (1, 2, 3, 3, 4)
+    np.testing.assert_allclose(ds_level.sat_pred.values, expected.sat_pred.values, rtol=1e-5)
+    np.testing.assert_allclose(ds_level.x_geostationary, expected.x_geostationary)
+    assert ds_level.sat_pred.attrs["units"] == "1"
+    assert ds_level.attrs["coarsening_factor"] == 4
+
+
+def test_app_pyramid(sat_5_data, tmp_path, init_time, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SATELLITE_ZARR_PATH", "temp_sat.zarr.zip")
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", f"{tmp_path}")
+    monkeypatch.setenv("PREDICTION_PYRAMID_FACTORS", "2,4,8")
+
+    with zarr.storage.ZipStore("temp_sat.zarr.zip", mode="x") as store:
+        sat_5_data.to_zarr(store)
+
+    app()
+
+    t0_string_zarr_path = init_time.strftime(f"{tmp_path}/%Y-%m-%dT%H:%M.zarr")
+    ds_y_hat = xr.open_zarr(t0_string_zarr_path)
+
+    paths = [d["path"] for d in ds_y_hat.attrs["multiscales"][0]["datasets"]]
+    assert paths == ["", "pyramid_2", "pyramid_4", "pyramid_8"]
+
+    for factor in [2, 4, 8]:
+        ds_level = xr.open_zarr(t0_string_zarr_path, group=f"pyramid_{factor}")
+        assert ds_level.sat_pred.shape[-2:] == (
+            -(-len(ds_y_hat.y_geostationary) // factor),
+            -(-len(ds_y_hat.x_geostationary) // factor),
+        )
+        assert np.isfinite(ds_level.sat_pred).all()
+
+    # The latest forecast has the pyramid levels too
+    ds_level = xr.open_zarr(f"{tmp_path}/latest.zarr", group="pyramid_8")
+    assert ds_level.attrs["coarsening_factor"] == 8
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import torch
+
+from cloudcasting_inference.tiling import TileGrid, get_tile_starts, predict_tiled
+
+
+def test_get_tile_starts():
+    assert list(get_tile_starts(8, 8, overlap=2))==[0]
+    assert list(get_tile_starts(25, 8, overlap=2))==[0, 6, 11, 17]
+
+    with pytest.raises(ValueError):
+        get_tile_starts(7, 8, overlap=2)
+
+
+def test_tile_grid():
+    grid = TileGrid((10, 25), tile_shape=(4, 8), overlap=2)
+
+    assert len(grid)==4 * 4
+
+    # Every pixel is covered and the tiles are flush with the edges of the domain
+    assert np.isfinite(grid.inverse_total_weight).all()
+    assert grid.starts[-1]==(6, 17)
+
+    X = torch.rand(2, 3, 5, 10, 25)
+    X_tiles = grid.split(X)
+    assert X_tiles.shape==(2 * 16, 3, 5, 4, 8)
+    assert torch.equal(X_tiles[16 + 5], X[1, ..., 2:6, 6:14])
+
+    # Blending the tiles back together reconstructs the domain
+    np.testing.assert_allclose(grid.blend(X_tiles.numpy()), X.numpy(), rtol=1e-6)
+
+
+def test_predict_tiled():
+    grid = TileGrid((10, 25), tile_shape=(4, 8), overlap=2)
+
+    X = torch.rand(3, 2, 5, 10, 25)
+    y_hat = predict_tiled(lambda x: 2 * x, X, grid, batch_size=5, device=torch.device("cpu"))
+
+    np.testing.assert_allclose(y_hat, 2 * X.numpy(), rtol=1e-6)
@@ -3,6 +3,7 @@ import pytest
 from cloudcasting_metrics.app import FORECAST_STEPS, FORECAST_FREQ
 from tests.utils import get_sat_shell, make_sat_data
 import icechunk
+import xarray as xr
 from icechunk.xarray import to_icechunk
 
 
@@ -37,6 +38,32 @@ def forecast_directory(tmp_path_factory, init_times_tuple) -> str:
     yield pred_dir
 
 
+@pytest.fixture()
+def forecast_icechunk_path(tmp_path, forecast_directory, init_times_tuple) -> str:
+    forecast_icechunk_path = str(tmp_path / "forecasts.icechunk")
+
+    all_init_times = [t for ts in init_times_tuple for t in ts]
+
+    ds_forecasts = xr.concat(
+        [
+            xr.open_zarr(init_time.strftime(f"{forecast_directory}/%Y-%m-%dT%H:%M.zarr"))
+            for init_time in all_init_times
+        ],
+        dim="init_time",
+    )
+    for v in ds_forecasts.variables:
+        ds_forecasts[v].encoding.clear()
+
+    store = icechunk.local_filesystem_storage(forecast_icechunk_path)
+    repo = icechunk.Repository.create(store)
+    session = repo.writable_session(branch="main")
+
+    to_icechunk(ds_forecasts, session)
+    session.commit("Commit test forecasts")
+
+    yield forecast_icechunk_path
+
+
 @pytest.fixture()
 def sat_icechunk_path(tmp_path, init_times_tuple) -> str:
     sat_icechunk_path = str(tmp_path / "sat.icechunk")
@@ -1,7 +1,9 @@
 import os
+import shutil
+import numpy as np
 import pandas as pd
 import xarray as xr
-from cloudcasting_metrics.app import app
+from cloudcasting_metrics.app import allocate_init_times, app, backfill
 from cloudcasting_metrics.app import FORECAST_STEPS, FORECAST_FREQ
 
 
@@ -62,3 +64,87 @@ def test_app(tmp_path, forecast_directory, sat_icechunk_path, today, init_times_
 
     for coord in ["x_geostationary", "y_geostationary", "variable"]:
         assert (ds_mae[coord].values==sat_shell[coord].values).all()
+
+
+def test_app_forecast_archive(
+    tmp_path, forecast_directory, forecast_icechunk_path, sat_icechunk_path, today, monkeypatch,
+):
+
+    os.environ["SATELLITE_ICECHUNK_ARCHIVE"] = sat_icechunk_path
+    os.environ["PREDICTION_SAVE_DIRECTORY"] = forecast_directory
+
+    # Score the forecast files
+    monkeypatch.setenv("METRIC_ZARR_PATH", str(tmp_path / "mae_files.zarr"))
+    app(date=today-pd.Timedelta("2D"))
+
+    # Score the same forecasts from the archive
+    monkeypatch.setenv("METRIC_ZARR_PATH", str(tmp_path / "mae_archive.zarr"))
+    monkeypatch.setenv("PREDICTION_ICECHUNK_ARCHIVE", forecast_icechunk_path)
+    app(date=today-pd.Timedelta("2D"))
+
+    ds_mae_files = xr.open_zarr(tmp_path / "mae_files.zarr").compute()
+    ds_mae_archive = xr.open_zarr(tmp_path / "mae_archive.zarr").compute()
+    xr.testing.assert_identical(ds_mae_files, ds_mae_archive)
+
+
+def test_backfill(
+    tmp_path, forecast_directory, sat_icechunk_path, today, init_times_tuple, monkeypatch,
+):
+
+    monkeypatch.setenv("SATELLITE_ICECHUNK_ARCHIVE", sat_icechunk_path)
+    monkeypatch.setenv("PREDICTION_SAVE_DIRECTORY", forecast_directory)
+
+    # Score the days one at a time
+    monkeypatch.setenv("METRIC_ZARR_PATH", str(tmp_path / "mae_daily.zarr"))
+    app(date=today-pd.Timedelta("2D"))
+    app(date=today-pd.Timedelta("1D"))
+
+    # Score both days at once
+    mae_path = str(tmp_path / "mae_backfill.zarr")
+    monkeypatch.setenv("METRIC_ZARR_PATH", mae_path)
+    backfill(start_date=today-pd.Timedelta("2D"), end_date=today-pd.Timedelta("1D"))
+
+    ds_mae_daily = xr.open_zarr(tmp_path / "mae_daily.zarr").compute()
+    ds_mae = xr.open_zarr(mae_path).compute()
+    xr.testing.assert_identical(ds_mae_daily, ds_mae)
+
+    # Rerunning is safe and leaves the scores unchanged
+    backfill(start_date=today-pd.Timedelta("2D"), end_date=today-pd.Timedelta("1D"))
+    xr.testing.assert_identical(xr.open_zarr(mae_path).compute(), ds_mae)
+
+    # Remove the scores of one init-time and check they are filled in again
+    init_time = init_times_tuple[1][1]
+    index = int((ds_mae.init_time.values == init_time).argmax())
+    ds_gap = ds_mae.isel(init_time=[index])
+    ds_gap = xr.full_like(ds_gap, np.nan).drop_vars(
+        [v for v in ds_gap.variables if "init_time" not in ds_gap[v].dims],
+    )
+    ds_gap.to_zarr(mae_path, region={"init_time": slice(index, index + 1)})
+    assert xr.open_zarr(mae_path).mae_step.sel(init_time=init_time).isnull().all()
+
+    backfill(start_date=today-pd.Timedelta("2D"), end_date=today-pd.Timedelta("1D"))
+    xr.testing.assert_identical(xr.open_zarr(mae_path).compute(), ds_mae)
+
+    # Score the days in reverse order, so the earlier day is before the start of the store
+    reverse_path = str(tmp_path / "mae_reverse.zarr")
+    monkeypatch.setenv("METRIC_ZARR_PATH", reverse_path)
+    app(date=today-pd.Timedelta("1D"))
+    app(date=today-pd.Timedelta("2D"))
+    xr.testing.assert_identical(xr.open_zarr(reverse_path).compute(), ds_mae)
+
+    # Interrupt a rewrite of the store after the old store was moved to the backup. The rewrite is
+    # finished on the next run
+    shutil.copytree(reverse_path, f"{reverse_path}.realloc")
+    open(f"{reverse_path}.realloc.complete", "w").close()
+    shutil.move(reverse_path, f"{reverse_path}.bak")
+
+    app(date=today-pd.Timedelta("1D"))
+    xr.testing.assert_identical(xr.open_zarr(reverse_path).compute(), ds_mae)
+    for suffix in [".realloc", ".realloc.complete", ".bak"]:
+        assert not os.path.exists(f"{reverse_path}{suffix}")
+
+    # An incomplete rewrite is removed on the next run
+    shutil.copytree(reverse_path, f"{reverse_path}.realloc")
+    allocate_init_times(reverse_path, ds_mae, pd.DatetimeIndex(ds_mae.init_time.values))
+    xr.testing.assert_identical(xr.open_zarr(reverse_path).compute(), ds_mae)
+    assert not os.path.exists(f"{reverse_path}.realloc")
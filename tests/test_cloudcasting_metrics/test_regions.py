@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from cloudcasting_metrics import regions
+from cloudcasting_metrics.regions import load_region_labels, rasterise_rings
+from ocf_data_sampler.select.geospatial import lon_lat_to_geostationary_area_coords
+from tests.utils import make_sat_data
+
+
+def box(x_min, x_max, y_min, y_max):
+    return [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max], [x_min, y_min]]
+
+
+def test_rasterise_rings():
+    x = np.arange(10.0)[::-1]
+    y = np.arange(8.0)
+
+    # A square with a square hole
+    rings = [np.array(box(0.5, 7.5, 0.5, 6.5)), np.array(box(2.5, 4.5, 2.5, 4.5))]
+    mask = rasterise_rings(rings, x, y)
+
+    xx, yy = np.meshgrid(x, y)
+    in_outer = (xx > 0.5) & (xx < 7.5) & (yy > 0.5) & (yy < 6.5)
+    in_hole = (xx > 2.5) & (xx < 4.5) & (yy > 2.5) & (yy < 4.5)
+    assert (mask == (in_outer & ~in_hole)).all()
+
+
+@pytest.fixture()
+def regions_path(tmp_path):
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"name": "west"},
+            "geometry": {"type": "Polygon", "coordinates": [box(-5, 0, 50, 55)]},
+        },
+        {
+            "type": "Feature",
+            "properties": {"name": "east"},
+            "geometry": {"type": "MultiPolygon", "coordinates": [[box(0, 5, 50, 55)]]},
+        },
+    ]
+    path = tmp_path / "regions.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    return str(path)
+
+
+def test_load_region_labels(tmp_path, regions_path, monkeypatch):
+    ds = make_sat_data(pd.DatetimeIndex(["2024-01-01"]))
+    area = ds.data.attrs["area"]
+    cache_dir = str(tmp_path / "region_cache")
+
+    names, labels = load_region_labels(
+        [regions_path], ds.x_geostationary, ds.y_geostationary, area, cache_dir=cache_dir,
+    )
+
+    assert names == ["west", "east"]
+    assert labels.shape == (1, len(ds.y_geostationary), len(ds.x_geostationary))
+
+    # Check a point inside each region is labelled
+    for label, (lon, lat) in enumerate([(-2.5, 52.5), (2.5, 52.5)]):
+        x, y = lon_lat_to_geostationary_area_coords(lon, lat, area)
+        i = np.abs(ds.y_geostationary.values - y).argmin()
+        j = np.abs(ds.x_geostationary.values - x).argmin()
+        assert labels[0, i, j] == label
+
+    assert (labels == -1).any()
+
+    # The second load is from the cache
+    def fail(*args, **kwargs):
+        raise AssertionError("Regions should be loaded from the cache")
+
+    monkeypatch.setattr(regions, "rasterise_regions", fail)
+
+    cached_names, cached_labels = load_region_labels(
+        [regions_path], ds.x_geostationary, ds.y_geostationary, area, cache_dir=cache_dir,
+    )
+    assert cached_names == names
+    assert (cached_labels == labels).all()
@@ -0,0 +1,123 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from cloudcasting_metrics.app import FORECAST_FREQ, FORECAST_STEPS
+from cloudcasting_metrics.rollups import _cover, query_metric, update_rollups
+
+
+def test_cover():
+    ts = pd.Timestamp
+
+    # A whole month with part months either side
+    periods = _cover(ts("2024-01-29"), ts("2024-03-06"))
+    assert periods["monthly"] == [ts("2024-02-01")]
+    assert periods["weekly"] == []
+    assert periods["daily"] == [
+        *pd.date_range("2024-01-29", "2024-01-31"), *pd.date_range("2024-03-01", "2024-03-05"),
+    ]
+
+    # Whole weeks starting on Mondays
+    periods = _cover(ts("2024-01-01"), ts("2024-01-16"))
+    assert periods["monthly"] == []
+    assert periods["weekly"] == [ts("2024-01-01"), ts("2024-01-08")]
+    assert periods["daily"] == [ts("2024-01-15")]
+
+
+@pytest.fixture()
+def metric_zarr_path(tmp_path):
+    rng = np.random.default_rng(0)
+    init_times = pd.date_range("2024-01-25", "2024-02-12", freq=FORECAST_FREQ, inclusive="left")
+
+    mae_step = rng.random((len(FORECAST_STEPS), len(init_times)))
+    mae_step[:, :10] = np.nan
+    mae_spatial = rng.random((16, 16, len(init_times)))
+    mae_spatial[0, 0, :] = np.nan
+
+    ds_maes = xr.Dataset(
+        {
+            "mae_step": (("step", "init_time"), mae_step),
+            "mae_spatial": (("x_geostationary", "y_geostationary", "init_time"), mae_spatial),
+        },
+        coords={
+            "step": FORECAST_STEPS,
+            "x_geostationary": np.arange(16.0),
+            "y_geostationary": np.arange(16.0),
+            "init_time": init_times,
+        },
+    )
+
+    path = str(tmp_path / "mae.zarr")
+    ds_maes.to_zarr(path)
+    return path
+
+
+def test_query_metric(tmp_path, metric_zarr_path):
+    rollup_zarr_path = str(tmp_path / "rollups.zarr")
+
+    for day in pd.date_range("2024-01-25", "2024-02-11"):
+        update_rollups(rollup_zarr_path, metric_zarr_path, day)
+
+    # Rebuilding the rollups of a day is safe, and only rewrites the periods containing it
+    chunk_paths = glob.glob(f"{rollup_zarr_path}/daily/mae_step_sum/c/0/**", recursive=True)
+    mtimes = {p: os.stat(p).st_mtime_ns for p in chunk_paths}
+
+    update_rollups(rollup_zarr_path, metric_zarr_path, pd.Timestamp("2024-02-05"))
+
+    assert len(mtimes) > 0
+    assert mtimes == {p: os.stat(p).st_mtime_ns for p in chunk_paths}
+
+    ds_maes = xr.open_zarr(metric_zarr_path).compute()
+
+    for start, end, freq in [
+        ("2024-01-25", "2024-02-12", None),
+        ("2024-01-28", "2024-02-10", "7D"),
+        ("2024-01-25", "2024-02-12", "MS"),
+        ("2024-02-01", "2024-02-03", "1D"),
+    ]:
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        period_starts = pd.date_range(start, end, freq=freq or "100D", inclusive="left")
+        period_starts = period_starts.union([start])
+        period_ends = [*period_starts[1:], end]
+
+        da_mae_step = query_metric(rollup_zarr_path, "mae_step", start, end, freq=freq)
+        da_mae_spatial = query_metric(rollup_zarr_path, "mae_spatial", start, end, freq=freq)
+
+        if freq is None:
+            da_mae_step = da_mae_step.expand_dims(time=period_starts)
+            da_mae_spatial = da_mae_spatial.expand_dims(time=period_starts)
+
+        assert (da_mae_step.time.values == period_starts).all()
+
+        for i, (period_start, period_end) in enumerate(zip(period_starts, period_ends)):
+            ds_period = ds_maes.sel(
+                init_time=slice(period_start, period_end - pd.Timedelta("1ns")),
+            )
+            np.testing.assert_allclose(
+                da_mae_step.isel(time=i).values,
+                ds_period.mae_step.mean("init_time").values,
+            )
+            np.testing.assert_allclose(
+                da_mae_spatial.isel(time=i).transpose("x_geostationary", "y_geostationary").values,
+                ds_period.mae_spatial
+                .coarsen(x_geostationary=8, y_geostationary=8).mean()
+                .mean("init_time").values,
+            )
+
+    # A range with no rollups has a NaN mean
+    da_mae_step = query_metric(
+        rollup_zarr_path, "mae_step", pd.Timestamp("2023-06-01"), pd.Timestamp("2023-07-01"),
+    )
+    assert da_mae_step.dims == ("step",)
+    assert da_mae_step.isnull().all()
+
+
+def test_query_metric_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        query_metric(
+            str(tmp_path / "rollups.zarr"), "mae_step", pd.Timestamp("2024-01-01"),
+            pd.Timestamp("2024-01-02"),
+        )
@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from cloudcasting_metrics.app import FORECAST_STEPS
+from cloudcasting_metrics.scoring import METRICS, ForecastScorer, StreamingForecastScorer
+
+
+@pytest.fixture()
+def ds_sat():
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2024-01-01 00:00", "2024-01-01 06:00", freq="15min")
+    data = rng.random((4, 20, 15, len(times))).astype(np.float32)
+    data[0, 1, 2, 5] = np.nan
+
+    return xr.Dataset(
+        {"data": (("variable", "x_geostationary", "y_geostationary", "time"), data)},
+        coords={
+            "variable": [f"channel_{i}" for i in range(4)],
+            "x_geostationary": np.arange(20.0),
+            "y_geostationary": np.arange(15.0),
+            "time": times,
+        },
+    )
+
+
+@pytest.fixture()
+def forecasts(ds_sat):
+    rng = np.random.default_rng(1)
+    init_times = pd.date_range("2024-01-01 00:00", freq="30min", periods=5)
+
+    return [
+        xr.Dataset(
+            {
+                "sat_pred": (
+                    ("init_time", "variable", "step", "y_geostationary", "x_geostationary"),
+                    rng.random((1, 4, len(FORECAST_STEPS), 10, 12)).astype(np.float32),
+                ),
+            },
+            coords={
+                "init_time": [init_time],
+                "variable": ds_sat.variable.values,
+                "step": FORECAST_STEPS,
+                "y_geostationary": ds_sat.y_geostationary.values[2:12],
+                "x_geostationary": ds_sat.x_geostationary.values[3:15],
+            },
+        )
+        for init_time in init_times
+    ]
+
+
+def test_score(ds_sat, forecasts):
+
+    ds_mae = ForecastScorer(ds_sat, forecasts[0]).score(forecasts, batch_size=2, num_workers=2)
+
+    # The output dims follow the order of the satellite data
+    assert ds_mae.mae_spatial.dims == ("x_geostationary", "y_geostationary", "init_time")
+    assert ds_mae.mae_step.dims == ("step", "init_time")
+    assert ds_mae.mae_variable.dims == ("variable", "init_time")
+
+    for i, ds_forecast in enumerate(forecasts):
+        init_time = pd.Timestamp(ds_forecast.init_time.item())
+
+        # Score the forecast with label based selection
+        da_sat = (
+            ds_sat.data.sel(
+                time=init_time + FORECAST_STEPS,
+                x_geostationary=ds_forecast.x_geostationary,
+                y_geostationary=ds_forecast.y_geostationary,
+            )
+            .rename(time="step")
+            .assign_coords(step=FORECAST_STEPS)
+        )
+        da_mae = np.abs(da_sat - ds_forecast.sat_pred.isel(init_time=0, drop=True))
+
+        xr.testing.assert_allclose(
+            ds_mae.mae_step.isel(init_time=i, drop=True),
+            da_mae.mean(dim=("x_geostationary", "y_geostationary", "variable")),
+        )
+        xr.testing.assert_allclose(
+            ds_mae.mae_variable.isel(init_time=i, drop=True),
+            da_mae.mean(dim=("x_geostationary", "y_geostationary", "step")),
+        )
+        xr.testing.assert_allclose(
+            ds_mae.mae_spatial.isel(init_time=i, drop=True),
+            da_mae.mean(dim=("step", "variable")).transpose("x_geostationary", "y_geostationary"),
+        )
+
+
+@pytest.mark.parametrize("num_workers", [2, 8])
+def test_score_concurrent(ds_sat, forecasts, num_workers):
+    # Scoring the batches concurrently gives the same results, in init-time order
+    scorer = ForecastScorer(ds_sat, forecasts[0])
+    ds_mae_serial = scorer.score(forecasts, batch_size=1, num_workers=1)
+    ds_mae = scorer.score(forecasts, batch_size=1, num_workers=num_workers)
+
+    xr.testing.assert_identical(ds_mae, ds_mae_serial)
+    assert (ds_mae.init_time.values == [f.init_time.values[0] for f in forecasts]).all()
+
+
+def test_score_metrics(ds_sat, forecasts):
+
+    scorer = ForecastScorer(ds_sat, forecasts[0], metrics=METRICS, threshold=0.5)
+    ds_scores = scorer.score(forecasts)
+
+    reductions = {
+        "step": ("x_geostationary", "y_geostationary", "variable"),
+        "variable": ("x_geostationary", "y_geostationary", "step"),
+        "spatial": ("step", "variable"),
+    }
+
+    for i, ds_forecast in enumerate(forecasts):
+        init_time = pd.Timestamp(ds_forecast.init_time.item())
+        da_y_hat = ds_forecast.sat_pred.isel(init_time=0, drop=True)
+
+        da_sat = ds_sat.data.sel(
+            x_geostationary=ds_forecast.x_geostationary,
+            y_geostationary=ds_forecast.y_geostationary,
+        )
+        da_truth = (
+            da_sat.sel(time=init_time + FORECAST_STEPS)
+            .rename(time="step")
+            .assign_coords(step=FORECAST_STEPS)
+        )
+        da_persistence_err = np.abs(da_truth - da_sat.sel(time=init_time, drop=True))
+
+        for reduction, dims in reductions.items():
+            da_mae = np.abs(da_y_hat - da_truth).mean(dims)
+            expected = {
+                "mae": da_mae,
+                "rmse": np.sqrt(((da_y_hat - da_truth)**2).mean(dims)),
+                "bias": (da_y_hat - da_truth).mean(dims),
+                "persistence_mae": da_persistence_err.mean(dims),
+                "mae_skill": 1 - da_mae / da_persistence_err.mean(dims),
+            }
+            for name, da_expected in expected.items():
+                da_score = ds_scores[f"{name}_{reduction}"].isel(init_time=i, drop=True)
+                xr.testing.assert_allclose(
+                    da_score, da_expected.transpose(*da_score.dims), rtol=1e-4, atol=1e-6,
+                )
+
+        # The threshold counts are for each channel
+        dims = reductions["variable"]
+        y_hat_exceeds = da_y_hat >= 0.5
+        truth_exceeds = da_truth >= 0.5
+        expected = {
+            "hits": (y_hat_exceeds & truth_exceeds).sum(dims),
+            "false_alarms": (y_hat_exceeds & (da_truth < 0.5)).sum(dims),
+            "misses": (~y_hat_exceeds & truth_exceeds).sum(dims),
+        }
+        for name, da_expected in expected.items():
+            da_score = ds_scores[f"{name}_variable"].isel(init_time=i, drop=True)
+            np.testing.assert_array_equal(da_score.values, da_expected.values)
+
+
+def test_score_regions(ds_sat, forecasts):
+
+    # Two overlapping layers of regions on the forecast grid
+    rng = np.random.default_rng(2)
+    shape = (len(forecasts[0].y_geostationary), len(forecasts[0].x_geostationary))
+    region_labels = np.stack([rng.integers(-1, 2, shape), rng.integers(2, 4, shape)])
+    region_names = ["a", "b", "c", "d"]
+
+    scorer = ForecastScorer(
+        ds_sat, forecasts[0], metrics=("mae", "bias"), regions=(region_names, region_labels),
+    )
+    ds_scores = scorer.score(forecasts)
+
+    assert ds_scores.mae_region.dims == ("step", "region", "init_time")
+    assert list(ds_scores.region.values) == region_names
+
+    # Check against the mean over the pixels of each region
+    ds_mae = ForecastScorer(ds_sat, forecasts[0], metrics=("mae",)).score(forecasts)
+    for i, ds_forecast in enumerate(forecasts):
+        init_time = pd.Timestamp(ds_forecast.init_time.item())
+        da_truth = (
+            ds_sat.data.sel(
+                time=init_time + FORECAST_STEPS,
+                x_geostationary=ds_forecast.x_geostationary,
+                y_geostationary=ds_forecast.y_geostationary,
+            )
+            .rename(time="step")
+            .assign_coords(step=FORECAST_STEPS)
+        )
+        err = np.abs(ds_forecast.sat_pred.isel(init_time=0, drop=True) - da_truth)
+        err = err.transpose("step", "variable", "y_geostationary", "x_geostationary").values
+
+        for region, name in enumerate(region_names):
+            in_region = (region_labels == region).any(axis=0)
+            expected = np.nanmean(err[:, :, in_region], axis=(1, 2))
+            np.testing.assert_allclose(
+                ds_scores.mae_region.isel(init_time=i).sel(region=name).values,
+                expected,
+                rtol=1e-5,
+            )
+
+    # The other reductions are unchanged
+    xr.testing.assert_identical(ds_scores[list(ds_mae.data_vars)], ds_mae)
+
+
+def test_score_missing_satellite_data(ds_sat, forecasts):
+
+    scorer = ForecastScorer(ds_sat.isel(time=slice(0, 20)), forecasts[0])
+
+    with pytest.raises(Exception, match="missing in the satellite data"):
+        scorer.score(forecasts)
+
+
+def test_score_different_coords(ds_sat, forecasts):
+
+    forecasts[1] = forecasts[1].assign_coords(x_geostationary=forecasts[1].x_geostationary + 1)
+
+    with pytest.raises(Exception, match="different coords"):
+        ForecastScorer(ds_sat, forecasts[0]).score(forecasts)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_streaming_score(ds_sat, forecasts, batch_size):
+
+    ds_mae = ForecastScorer(ds_sat, forecasts[0]).score(forecasts)
+
+    scorer = StreamingForecastScorer(ds_sat.chunk({"time": 1}), forecasts[0])
+    ds_mae_streamed = scorer.score(forecasts, batch_size=batch_size, num_workers=2)
+
+    xr.testing.assert_identical(ds_mae, ds_mae_streamed)
+
+    # Each frame needed was read once and only the frames of the last batch are kept
+    init_times = pd.DatetimeIndex([ds.init_time.item() for ds in forecasts])
+    valid_times = {t for init_time in init_times for t in init_time + FORECAST_STEPS}
+    assert scorer.num_frames_read == len(valid_times)
+    last_batch_init_time = init_times[(len(init_times) - 1) // batch_size * batch_size]
+    assert min(scorer.frames) == last_batch_init_time + FORECAST_STEPS[0]
+
+
+def test_streaming_score_out_of_order(ds_sat, forecasts):
+
+    scorer = StreamingForecastScorer(ds_sat, forecasts[0])
+
+    with pytest.raises(Exception, match="init-time order"):
+        scorer.score(forecasts[::-1], batch_size=1)